@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import time
+import zipfile
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Optional
+
+SESSION_VERSION = 1
+SESSIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory", "sessions")
+# Outputs larger than this go to a deduplicated blob (hierarchy dumps, screenshots)
+INLINE_OUTPUT_LIMIT = 1024
+# Commands that change what is on screen; replay moves to the next recorded screen state
+STATE_COMMANDS = ("shell input ", "shell am start ", "shell am force-stop ", "shell monkey ", "shell pm clear ")
+
+class TransportResult:
+    """What subprocess.run returns, as far as the runner uses it."""
+    def __init__(self, args, returncode: int = 0, stdout="", stderr=""):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+def command_key(argv: List[str]) -> str:
+    """The command without the program and its device selection, so sessions replay on any serial."""
+    parts = list(argv[1:])
+    for flag in ("-s", "--device"):
+        if flag in parts:
+            i = parts.index(flag)
+            del parts[i:i + 2]
+    return " ".join(parts)
+
+class SubprocessTransport:
+    """Runs adb (and maestro) for real."""
+    def run(self, argv: List[str], **kwargs):
+        kwargs.setdefault("capture_output", True)
+        kwargs.setdefault("text", True)
+        return subprocess.run(argv, **kwargs)
+
+class RecordingTransport:
+    """
+    Passes commands to another transport and records each one with its output and timing, and the
+    screen state it ran in. save() writes a session archive that ReplayTransport serves back.
+    """
+
+    def __init__(self, inner=None):
+        self.inner = inner or SubprocessTransport()
+        self.calls: List[Dict] = []
+        self.blobs: Dict[str, bytes] = {}
+        self.state = 0
+        self.started = time.time()
+        self.run_start: Optional[Dict] = None # Mode, memory and device facts the run started with
+        self._lock = threading.Lock()
+
+    def start_run(self, mode: str, memory_json: str, device_info: Optional[Dict] = None):
+        """
+        Note how the run started, so a replay takes the same path: its mode, a copy of its memory and
+        the device facts the runner already knew (it doesn't ask the device for those again).
+        """
+        with self._lock:
+            self.run_start = {"mode": mode, "memory": self._store(memory_json.encode()), "device_info": dict(device_info or {})}
+
+    def _store(self, output):
+        if output is None:
+            return None
+        binary = isinstance(output, bytes)
+        if len(output) <= INLINE_OUTPUT_LIMIT and not binary:
+            return output
+        data = output if binary else output.encode()
+        digest = hashlib.sha1(data).hexdigest()
+        self.blobs.setdefault(digest, data)
+        return {"blob": digest, "binary": binary}
+
+    def run(self, argv: List[str], **kwargs):
+        start = time.time()
+        result = self.inner.run(argv, **kwargs)
+        key = command_key(argv)
+        with self._lock:
+            self.calls.append({
+                "program": os.path.basename(argv[0]),
+                "cmd": key,
+                "state": self.state,
+                "rc": result.returncode,
+                "out": self._store(result.stdout),
+                "err": self._store(result.stderr),
+                "at_ms": int((start - self.started) * 1000),
+                "ms": int((time.time() - start) * 1000)
+            })
+            if key.startswith(STATE_COMMANDS):
+                self.state += 1
+        return result
+
+    def save(self, path: str, **meta) -> str:
+        """Write the session archive: session.json plus one compressed file per distinct large output."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._lock:
+            session = {"version": SESSION_VERSION, "created_at": self.started, **meta, "run_start": self.run_start,
+                       "calls": list(self.calls)}
+            blobs = dict(self.blobs)
+        tmp = f"{path}.tmp"
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("session.json", json.dumps(session))
+            for digest, data in blobs.items():
+                archive.writestr(f"blobs/{digest}", data)
+        os.replace(tmp, path)
+        return path
+
+class ReplayTransport:
+    """
+    Serves a recorded session back without a device. A command is answered from the recordings of
+    the same command in the current screen state, in recorded order (so polling loops see the screen
+    settle as it did), else from the latest earlier state. Input commands advance the state.
+    """
+
+    def __init__(self, path: str, realtime: bool = False):
+        self.path = path
+        self.realtime = realtime # Sleep for the recorded duration of each command, and for the runner's waits
+        with zipfile.ZipFile(path) as archive:
+            self.session = json.loads(archive.read("session.json"))
+            self.blobs = {name[len("blobs/"):]: archive.read(name) for name in archive.namelist() if name.startswith("blobs/")}
+        if self.session.get("version") != SESSION_VERSION:
+            raise ValueError(f"Unsupported session version: {self.session.get('version')}")
+
+        self._responses: Dict = {} # (program, cmd) -> {state: [calls]}
+        for call in self.session["calls"]:
+            self._responses.setdefault((call["program"], call["cmd"]), {}).setdefault(call["state"], []).append(call)
+        self._served: Dict = {} # (program, cmd, state) -> calls served so far
+        self.state = 0
+        self.stats = {"calls": 0, "misses": 0, "recorded_ms": 0, "skipped_sleep_ms": 0}
+        self._elapsed = 0.0 # Seconds of recorded command time and waiting skipped (not realtime)
+        self._lock = threading.Lock()
+
+    @property
+    def recorded_mode(self) -> Optional[str]:
+        return (self.session.get("run_start") or {}).get("mode")
+
+    @property
+    def recorded_device_info(self) -> Dict:
+        return (self.session.get("run_start") or {}).get("device_info") or {}
+
+    def recorded_memory(self) -> Optional[bytes]:
+        """The memory file the run started with (JSON), or None for sessions recorded without it."""
+        stored = (self.session.get("run_start") or {}).get("memory")
+        return self._load(stored, False) if stored else None
+
+    def _load(self, stored, text: bool):
+        if not isinstance(stored, dict):
+            return stored if text or stored is None else stored.encode()
+        data = self.blobs[stored["blob"]]
+        return data.decode() if text and not stored["binary"] else data
+
+    def _lookup(self, program: str, key: str) -> Optional[Dict]:
+        by_state = self._responses.get((program, key))
+        if not by_state:
+            return None
+        earlier = [s for s in by_state if s <= self.state]
+        state = max(earlier) if earlier else min(by_state)
+        calls = by_state[state]
+        served = self._served.get((program, key, state), 0)
+        self._served[(program, key, state)] = served + 1
+        return calls[min(served, len(calls) - 1)]
+
+    def run(self, argv: List[str], **kwargs):
+        key = command_key(argv)
+        text = kwargs.get("text", True)
+        with self._lock:
+            call = self._lookup(os.path.basename(argv[0]), key)
+            self.stats["calls"] += 1
+            if key.startswith(STATE_COMMANDS):
+                self.state += 1
+            if call is None:
+                self.stats["misses"] += 1
+        if call is None:
+            if key.startswith(STATE_COMMANDS):
+                return TransportResult(argv, 0, "" if text else b"", "" if text else b"")
+            print(f"[DEBUG] Replay: no recording for '{key}'")
+            return TransportResult(argv, 1, "" if text else b"", "not recorded" if text else b"not recorded")
+        self.stats["recorded_ms"] += call["ms"]
+        if self.realtime:
+            time.sleep(call["ms"] / 1000)
+        else:
+            with self._lock:
+                self._elapsed += call["ms"] / 1000
+        return TransportResult(argv, call["rc"], self._load(call["out"], text), self._load(call["err"], text))
+
+    def sleep(self, seconds: float):
+        """The runner's waits between commands: kept in realtime replay, else skipped and counted."""
+        if self.realtime:
+            time.sleep(seconds)
+            return
+        with self._lock:
+            self._elapsed += seconds
+            self.stats["skipped_sleep_ms"] += int(seconds * 1000)
+
+    def time(self) -> float:
+        """Wall time plus the command time and waits skipped so far, so deadlines pass as they did when recorded."""
+        return time.time() + self._elapsed
+
+# Transport of runs that don't bring their own
+transport = SubprocessTransport()
+
+def session_path(run_id: str) -> str:
+    return os.path.join(SESSIONS_DIR, f"{run_id}.zip")
+
+def replay_session(path: str, realtime: bool = False, base_dir: Optional[str] = None):
+    """
+    Re-run the flow of a recorded session offline. Yields the run's SSE lines; returns replay stats.
+    The run uses a throwaway copy of the memory it was recorded with, in the recorded mode, so the
+    replay takes the recorded path and leaves the host's memory and run history untouched.
+    Sessions recorded without that state replay in LEARN mode on empty memory.
+    """
+    import runner
+    from intelligence import TestMemory
+    replay = ReplayTransport(path, realtime=realtime)
+    flow = replay.session.get("flow") or {}
+    if not flow.get("yaml_content"):
+        raise ValueError("Session has no flow to replay")
+    with tempfile.TemporaryDirectory(prefix="ratt-replay-") as scratch:
+        memory_path = os.path.join(scratch, "memory.json")
+        recorded = replay.recorded_memory()
+        if recorded:
+            with open(memory_path, "wb") as f:
+                f.write(recorded)
+        memory = TestMemory(memory_path)
+        # A serial of its own, so device facts come from the recording rather than this process's cache
+        device = f"replay-{os.urandom(3).hex()}"
+        try:
+            with runner.recorded_device(device, replay.recorded_device_info):
+                yield from runner.run_yaml_custom(flow["yaml_content"], filename=flow.get("filename", ""),
+                                                  device=device, base_dir=base_dir or flow.get("base_dir"),
+                                                  transport=replay, memory=memory, mode=replay.recorded_mode or "LEARN")
+        finally:
+            memory.drain()
+    return replay.stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and replay recorded device sessions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    replay = sub.add_parser("replay", help="Re-run a recorded flow against its session, without a device")
+    replay.add_argument("session")
+    replay.add_argument("--realtime", action="store_true", help="Wait the recorded duration of every command")
+    replay.add_argument("--base-dir", help="Folder of runFlow files, if not the recorded one")
+    info = sub.add_parser("info", help="Summarize a session archive")
+    info.add_argument("session")
+    args = parser.parse_args(argv)
+
+    if args.command == "info":
+        session = ReplayTransport(args.session).session
+        calls = session["calls"]
+        print(json.dumps({
+            "flow": (session.get("flow") or {}).get("filename"),
+            "run_id": session.get("run_id"),
+            "calls": len(calls),
+            "screen_states": (calls[-1]["state"] + 1) if calls else 0,
+            "device_ms": sum(c["ms"] for c in calls),
+            "archive_bytes": os.path.getsize(args.session)
+        }, indent=2))
+        return 0
+
+    start = time.time()
+    passed = False
+    stream = replay_session(args.session, realtime=args.realtime, base_dir=args.base_dir)
+    try:
+        while True:
+            msg = next(stream)
+            text = msg[len("data: "):] if msg.startswith("data: ") else msg
+            text = text.rstrip("\n")
+            print(text)
+            if text.startswith("[DONE] EXIT_CODE:"):
+                passed = text.endswith("0")
+    except StopIteration as done:
+        stats = done.value or {}
+    wall_ms = int((time.time() - start) * 1000)
+    print(json.dumps({"passed": passed, "wall_ms": wall_ms, **stats}, indent=2))
+    return 0 if passed else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from services.llm_service import ask_llm_json
 
 class FailureAnalyzer:
@@ -42,7 +42,7 @@ Return a strictly valid JSON object:
 If no fix is possible, set suggested_fix to null.
 """
 
-    def analyze(self, step: Dict, error: str, xml_hierarchy: str, history: List[Dict]) -> Dict:
+    def analyze(self, step: Dict, error: str, xml_hierarchy: str, history: List[Dict], api_key: Optional[str] = None) -> Dict:
         """
         Analyzes a failure using the LLM.
         """
@@ -59,7 +59,7 @@ PREVIOUS 5 STEPS:
 CURRENT XML HIERARCHY (Snippet):
 {xml_hierarchy[:10000]}
 """
-        return ask_llm_json(self.SYSTEM_PROMPT, user_content)
+        return ask_llm_json(self.SYSTEM_PROMPT, user_content, api_key=api_key)
 
 # Singleton instance
 failure_analyzer = FailureAnalyzer()
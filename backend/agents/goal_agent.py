@@ -31,14 +31,14 @@ Return a structured JSON report:
 }}
 """
 
-    def plan_steps(self, goal: str, hierarchy_data: Dict, history: List = None) -> Dict:
+    def plan_steps(self, goal: str, hierarchy_data: Dict, history: List = None, api_key: Optional[str] = None) -> Dict:
         # Extract candidates for the LLM to keep context window small
         candidates = self._extract_candidates(hierarchy_data)
         
         user_content = f"Goal: {goal}\nCandidates: {json.dumps(candidates)}\nHistory: {json.dumps(history or [])}"
         
         try:
-            result = ask_llm_json(self.system_prompt.format(goal=goal, candidates=json.dumps(candidates), history=json.dumps(history or [])), user_content)
+            result = ask_llm_json(self.system_prompt.format(goal=goal, candidates=json.dumps(candidates), history=json.dumps(history or [])), user_content, api_key=api_key)
             if not result:
                 return {
                     "plan": [],
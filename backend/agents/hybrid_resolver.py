@@ -61,7 +61,7 @@ OUTPUT FORMAT (JSON):
             print(f"[HybridResolver] XML Parse Error: {e}")
             return []
 
-    def semantic_resolve(self, target: str, candidates: List[Dict]) -> Optional[Dict]:
+    def semantic_resolve(self, target: str, candidates: List[Dict], api_key: Optional[str] = None) -> Optional[Dict]:
         """Use LLM to find the best match based on meaning, not just exact strings."""
         if not candidates:
             return None
@@ -79,7 +79,7 @@ OUTPUT FORMAT (JSON):
         user_content = f"Target: {target}\nCandidates: {json.dumps(simplified_candidates)}"
         
         try:
-            result = ask_llm_json(self.system_prompt, user_content)
+            result = ask_llm_json(self.system_prompt, user_content, api_key=api_key)
             idx = result.get("best_match_index")
             confidence = result.get("confidence", 0)
             
@@ -94,7 +94,7 @@ OUTPUT FORMAT (JSON):
             print(f"[HybridResolver] Semantic resolving failed: {e}")
             return None
 
-    def resolve_with_json(self, query: str, data: Dict) -> Optional[Dict]:
+    def resolve_with_json(self, query: str, data: Dict, api_key: Optional[str] = None) -> Optional[Dict]:
         """Resolve query using the JSON hierarchy dictionary."""
         candidates = self.parse_json_to_candidates(data)
         
@@ -112,7 +112,7 @@ OUTPUT FORMAT (JSON):
 
         # 2. Try Semantic AI Matching (The Brain)
         print(f"[HybridResolver] No exact match for '{query}'. Trying semantic resolving...")
-        semantic_match = self.semantic_resolve(query, candidates)
+        semantic_match = self.semantic_resolve(query, candidates, api_key=api_key)
         if semantic_match:
             return semantic_match["node"]
 
@@ -149,7 +149,7 @@ OUTPUT FORMAT (JSON):
         traverse(data)
         return candidates
 
-    def resolve_with_root(self, query: str, root) -> Optional[Dict]:
+    def resolve_with_root(self, query: str, root, api_key: Optional[str] = None) -> Optional[Dict]:
         """Resolve query using a pre-parsed ElementTree root."""
         candidates = self.parse_root_to_candidates(root)
         
@@ -167,7 +167,7 @@ OUTPUT FORMAT (JSON):
 
         # 2. Try Semantic AI Matching (The Brain)
         print(f"[HybridResolver] No exact match for '{query}'. Trying semantic resolving...")
-        semantic_match = self.semantic_resolve(query, candidates)
+        semantic_match = self.semantic_resolve(query, candidates, api_key=api_key)
         if semantic_match:
             return semantic_match["node"]
 
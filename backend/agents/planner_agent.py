@@ -24,21 +24,18 @@ Return a structured JSON report:
 }
 """
 
-    def plan_execution(self, yaml_content, history=None) -> dict:
+    def plan_execution(self, yaml_content, history=None, api_key=None) -> dict:
         try:
             # Handle string vs already parsed data
             if isinstance(yaml_content, str):
-                if "---" in yaml_content:
-                    parts = yaml_content.split("---")
-                    yaml_data = yaml.safe_load(parts[1]) if len(parts) > 1 else yaml.safe_load(parts[0])
-                else:
-                    yaml_data = yaml.safe_load(yaml_content)
+                from flow_compiler import compile_flow
+                yaml_data = compile_flow(yaml_content).raw_steps()
             else:
                 yaml_data = yaml_content
             
             user_content = f"Test Flow:\n{yaml.dump(yaml_data)}\n\nHistorical Context:\n{json.dumps(history or {})}"
             
-            result = ask_llm_json(self.system_prompt, user_content)
+            result = ask_llm_json(self.system_prompt, user_content, api_key=api_key)
             return result
         except Exception as e:
             print(f"[PlannerAgent] Planning failed: {e}")
@@ -0,0 +1,283 @@
+"""
+Microbenchmarks for the code that runs on every hierarchy poll.
+
+    python benchmarks/hot_path.py              # compare with baseline.json, exit 1 on regression
+    python benchmarks/hot_path.py --update     # record a new baseline on this machine
+    python benchmarks/hot_path.py --quick      # checked-in dumps and the 1k tree only
+
+Each benchmark runs in calibrated samples with GC off, each followed by a fixed reference
+workload. The gate compares time relative to that reference, which holds across machine speed
+and drift, and the tracemalloc peak of one call. Absolute timings are reported alongside; record
+the baseline on the kind of machine that runs the gate.
+"""
+import os
+import re
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import runner
+from healer import healer
+from intelligence import TestMemory
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DUMPS = [
+    os.path.join(BACKEND_DIR, "uidump.xml"),
+    os.path.join(BACKEND_DIR, "uidump_live.xml"),
+    os.path.join(BACKEND_DIR, "..", "window_dump.xml")
+]
+SYNTHETIC_SIZES = (1000, 5000, 20000)
+# A tracked path regresses when its relative time or peak allocation grows by more than this
+DEFAULT_THRESHOLD = float(os.getenv("RATT_BENCH_THRESHOLD", "0.3"))
+SAMPLES = 9
+SAMPLE_TARGET_S = 0.05 # Calls per sample are calibrated to take about this long
+
+# --- Workloads ---
+
+def synthetic_xml(nodes: int, seed: int = 7) -> str:
+    """A dump-shaped tree: nested layouts with buttons, texts and ids, about `nodes` nodes."""
+    rng = random.Random(seed)
+    classes = ["android.widget.FrameLayout", "android.widget.LinearLayout", "android.view.ViewGroup",
+               "android.widget.TextView", "android.widget.Button", "android.widget.ImageView"]
+    count = 0
+    parts = []
+
+    def node(depth, top):
+        nonlocal count
+        count += 1
+        i = count
+        cls = classes[rng.randrange(3)] if depth < 8 and count < nodes else classes[3 + rng.randrange(3)]
+        clickable = "true" if cls == "android.widget.Button" or rng.random() < 0.1 else "false"
+        text = f"Item {i}" if cls != "android.widget.ImageView" and rng.random() < 0.6 else ""
+        rid = f"com.bench.app:id/view_{i % 500}" if rng.random() < 0.5 else ""
+        left, height = rng.randrange(0, 500), rng.randrange(20, 200)
+        parts.append(
+            f'<node index="{i}" text="{text}" resource-id="{rid}" class="{cls}" package="com.bench.app" '
+            f'content-desc="" checkable="false" checked="false" clickable="{clickable}" enabled="true" '
+            f'focusable="{clickable}" focused="false" scrollable="false" long-clickable="false" password="false" '
+            f'selected="false" bounds="[{left},{top}][{left + 500},{top + height}]">'
+        )
+        if cls in classes[:3]:
+            for _ in range(rng.randrange(2, 6)):
+                if count >= nodes:
+                    break
+                node(depth + 1, top + rng.randrange(0, 2000))
+        parts.append("</node>")
+
+    while count < nodes:
+        node(0, 0)
+    return ("<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation=\"0\">"
+            + "".join(parts) + "</hierarchy>")
+
+def _xml_root(xml: str):
+    return ET.fromstring(xml[xml.find("<hierarchy"):])
+
+def _nodes(tree):
+    stack = [tree]
+    while stack:
+        n = stack.pop()
+        yield n
+        stack.extend(n.get("children", []))
+
+class Workload:
+    """One or more parsed trees plus queries picked from them, so every benchmark has a hit."""
+
+    def __init__(self, name: str, xmls):
+        self.name = name
+        self.roots = [_xml_root(x) for x in xmls]
+        self.trees = [runner.parse_xml_node(r) for r in self.roots]
+        self.bounds = [n.get("bounds") for r in self.roots for n in r.iter("node") if n.get("bounds")]
+        nodes = [n for t in self.trees for n in _nodes(t)]
+        texts = [n["attributes"].get("text") for n in nodes if n["attributes"].get("text")]
+        clickable = [n for n in nodes if n["attributes"].get("clickable") == "true" and n["attributes"].get("text")]
+        ids = [n["attributes"].get("resource-id") for n in nodes if n["attributes"].get("resource-id")]
+        target = (clickable or nodes)[len(clickable or nodes) // 2]
+        self.exact = target["attributes"].get("text") or texts[0]
+        # The end of a late text, so the substring pass has to walk most of the tree
+        late = texts[-1] if texts else self.exact
+        self.substring = late[len(late) // 2:] or late
+        self.regex = f"regexp:{re.escape(ids[-1]) if ids else '.*'}"
+        self.indexed = ids[len(ids) // 2] if ids else self.exact
+        self.cached = {"bounds": target["bounds"], "class": target["attributes"].get("class")}
+        self.expected = {"text": self.exact + "x", "resource_id": target["attributes"].get("resource-id")}
+
+def workloads(quick: bool = False):
+    dumps = []
+    for path in DUMPS:
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                dumps.append(f.read())
+    yield Workload("dumps", dumps)
+    for size in SYNTHETIC_SIZES[:1] if quick else SYNTHETIC_SIZES:
+        yield Workload(f"synthetic-{size // 1000}k", [synthetic_xml(size)])
+
+def benchmarks(w: Workload, memory: TestMemory):
+    """(name, callable) pairs for one workload."""
+    learned = {"n": 0}
+
+    def learn():
+        # A new screen every call, dropped again so memory doesn't grow
+        screen_id = f"bench-{learned['n']}"
+        learned["n"] += 1
+        for tree in w.trees:
+            memory._learn_elements(screen_id, tree, "bench")
+        memory.raw_data["elements"].pop(screen_id, None)
+        memory._element_index.pop(screen_id, None)
+
+    for tree in w.trees:
+        memory._learn_elements(f"saved-{w.name}", tree, "bench")
+
+    return [
+        ("parse_xml_node", lambda: [runner.parse_xml_node(r) for r in w.roots]),
+        ("parse_bounds", lambda: [runner.parse_bounds(b) for b in w.bounds]),
+        ("get_screen_hash", lambda: [runner.get_screen_hash(t) for t in w.trees]),
+        ("find_element.fast", lambda: [runner.find_element(t, w.exact) for t in w.trees]),
+        ("find_element.substring", lambda: [runner.find_element(t, w.substring) for t in w.trees]),
+        ("find_element.regex", lambda: [runner.find_element(t, w.regex) for t in w.trees]),
+        ("find_element.indexed", lambda: [runner.find_element(t, w.indexed, index=1) for t in w.trees]),
+        ("find_fuzzy_successor", lambda: [runner.find_fuzzy_successor(t, w.exact, w.cached) for t in w.trees]),
+        ("healer._attempt_healing", lambda: [healer._attempt_healing(w.expected, t) for t in w.trees]),
+        ("intelligence._learn_elements", learn),
+        ("TestMemory.save", lambda: memory.save())
+    ]
+
+# --- Measurement ---
+
+def _quiet(fn):
+    """Run fn with stdout discarded; some tracked paths print debug lines."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        return fn()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def reference_work():
+    """Fixed pure-Python work shaped like the hot path; timings are also expressed relative to it."""
+    nodes = [{"attributes": {"text": f"Item {i}", "class": "android.widget.TextView"}, "children": []} for i in range(200)]
+    return "|".join(f"{n['attributes']['class']}:{n['attributes']['text']}".lower() for n in nodes)
+
+def _calibrate(fn) -> int:
+    """Calls per sample so one sample takes about SAMPLE_TARGET_S."""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        if time.perf_counter() - start >= SAMPLE_TARGET_S or loops >= 1 << 16:
+            return loops
+        loops *= 2
+
+def measure(fn) -> dict:
+    """
+    Microseconds per call (median and fastest sample), the median ratio to reference_work timed
+    right after each sample, and the tracemalloc peak bytes of one call. The ratio cancels out
+    machine speed and drift (CPU frequency, noisy neighbours), so it is what the gate compares.
+    """
+    fn() # Warm up caches and lazy imports
+    loops, ref_loops = _calibrate(fn), _calibrate(reference_work)
+
+    samples, ratios = [], []
+    gc.disable()
+    try:
+        for _ in range(SAMPLES):
+            start = time.perf_counter()
+            for _ in range(loops):
+                fn()
+            per_call = (time.perf_counter() - start) / loops
+            start = time.perf_counter()
+            for _ in range(ref_loops):
+                reference_work()
+            ratios.append(per_call / ((time.perf_counter() - start) / ref_loops))
+            samples.append(per_call * 1e6)
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "median_us": round(statistics.median(samples), 2),
+        "min_us": round(min(samples), 2),
+        "stdev_pct": round(statistics.pstdev(samples) / statistics.mean(samples) * 100, 1),
+        "relative": round(statistics.median(ratios), 3),
+        "peak_bytes": peak,
+        "loops": loops
+    }
+
+def run_suite(quick: bool = False, only: str = None) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = TestMemory(os.path.join(tmp, "bench_memory.json"))
+        for w in workloads(quick):
+            for name, fn in benchmarks(w, memory):
+                key = f"{name}[{w.name}]"
+                if only and only not in key:
+                    continue
+                results[key] = _quiet(lambda: measure(fn))
+                r = results[key]
+                print(f"{key:<48} {r['median_us']:>12.1f} us  ±{r['stdev_pct']:>4.1f}%  x{r['relative']:>9.2f}  {r['peak_bytes'] / 1024:>10.1f} KiB")
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Regressions of tracked paths: (key, metric, baseline, current) beyond the threshold."""
+    regressions = []
+    for key, base in baseline.get("results", {}).items():
+        current = results.get(key)
+        if not current:
+            continue
+        for metric in ("relative", "peak_bytes"):
+            if base[metric] and current[metric] > base[metric] * (1 + threshold):
+                regressions.append((key, metric, base[metric], current[metric]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hierarchy hot path microbenchmarks")
+    parser.add_argument("--update", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--quick", action="store_true", help="Checked-in dumps and the 1k tree only")
+    parser.add_argument("--only", help="Run benchmarks whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Allowed growth, 0.3 = 30%%")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run_suite(quick=args.quick, only=args.only)
+    report = {"python": sys.version.split()[0], "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.update:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update first")
+        return 0
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for key, metric, base, current in regressions:
+        print(f"REGRESSION {key} {metric}: {base} -> {current} (+{(current / base - 1) * 100:.0f}%)")
+    if regressions:
+        return 1
+    print(f"No regressions beyond {args.threshold * 100:.0f}% against {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
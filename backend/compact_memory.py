@@ -0,0 +1,16 @@
+import json
+import sys
+from intelligence import memory_registry
+
+# Usage: python compact_memory.py [--dry-run] [partition ...]
+# Applies the retention policy (RATT_MEMORY_* env overrides) to the intelligence memory partitions.
+
+args = [a for a in sys.argv[1:] if not a.startswith("--")]
+keys = args or memory_registry.partition_keys()
+
+if "--dry-run" in sys.argv:
+    metrics = {key: memory_registry.get_partition(key).memory_metrics() for key in keys}
+    print(json.dumps({"policy": memory_registry.retention.dict(), "metrics": metrics}, indent=2))
+else:
+    report = {key: memory_registry.get_partition(key).compact() for key in keys}
+    print(json.dumps(report, indent=2))
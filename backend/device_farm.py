@@ -0,0 +1,398 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import struct
+import argparse
+import statistics
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError: # Windows: device state files are not locked across adb processes
+    fcntl = None
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# Sample dumps the virtual devices walk through
+DEFAULT_SCREENS = [
+    os.path.join(BACKEND_DIR, "uidump.xml"),
+    os.path.join(BACKEND_DIR, "uidump_live.xml"),
+    os.path.join(BACKEND_DIR, "..", "window_dump.xml")
+]
+DEFAULT_CONFIG = {
+    "latency_ms": 20, # Every adb call
+    "jitter_ms": 10,
+    "dump_latency_ms": 250, # uiautomator dump on top of latency_ms
+    "failure_rate": 0.0, # Share of calls that fail as if the device dropped
+    "dump_failure_rate": 0.0, # Share of uiautomator dumps that fail
+    "size": "1080x2424",
+    "density": 420,
+    "model": "RATT Virtual Device"
+}
+LAUNCHER = "com.android.launcher3"
+KEY_BACK = ("4", "KEYCODE_BACK")
+KEY_HOME = ("3", "KEYCODE_HOME")
+
+ADB_SCRIPT = """#!{python}
+import sys
+sys.path.insert(0, {backend!r})
+import device_farm
+sys.exit(device_farm.adb_main(sys.argv[1:], {farm!r}))
+"""
+
+# --- Screen graph ---
+
+class Screen:
+    def __init__(self, index: int, xml: str):
+        self.index = index
+        self.xml = xml
+        root = ET.fromstring(xml[xml.find("<hierarchy"):])
+        nodes = list(root.iter("node"))
+        self.package = next((n.get("package") for n in nodes if n.get("package")), LAUNCHER)
+        self.activity = f"{self.package}/.Screen{index}"
+        # (left, top, right, bottom, key) of clickable nodes, innermost last
+        self.targets = []
+        for node in nodes:
+            match = re.match(r"\[(\d+),(\d+)\]\[(\d+),(\d+)\]", node.get("bounds", ""))
+            if match and node.get("clickable") == "true":
+                key = node.get("resource-id") or node.get("text") or node.get("content-desc") or node.get("bounds")
+                self.targets.append((*map(int, match.groups()), key))
+
+    def target_at(self, x: int, y: int) -> Optional[str]:
+        hits = [t for t in self.targets if t[0] <= x <= t[2] and t[1] <= y <= t[3]]
+        if not hits:
+            return None
+        return min(hits, key=lambda t: (t[2] - t[0]) * (t[3] - t[1]))[4]
+
+def launcher_xml(packages: List[str], size: str) -> str:
+    w, h = size.split("x")
+    icons = "".join(
+        f'<node index="{i}" text="{p}" resource-id="" class="android.widget.TextView" package="{LAUNCHER}" '
+        f'content-desc="{p}" clickable="true" enabled="true" bounds="[0,{200 + i * 200}][{w},{400 + i * 200}]" />'
+        for i, p in enumerate(packages)
+    )
+    return (f"<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation=\"0\">"
+            f'<node index="0" text="" resource-id="" class="android.widget.FrameLayout" package="{LAUNCHER}" '
+            f'content-desc="" clickable="false" enabled="true" bounds="[0,0][{w},{h}]">{icons}</node></hierarchy>')
+
+class ScreenGraph:
+    """
+    Screens from sample dumps. Tapping a clickable element moves to a screen picked by a hash of the
+    element, so every virtual device walks the same deterministic graph; other taps stay put.
+    """
+
+    def __init__(self, paths: List[str], size: str):
+        self.screens = []
+        for path in paths:
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    self.screens.append(Screen(len(self.screens), f.read()))
+        self.packages = sorted({s.package for s in self.screens})
+        self.home = Screen(-1, launcher_xml(self.packages, size))
+
+    def screen(self, index: int) -> Screen:
+        return self.home if index < 0 or index >= len(self.screens) else self.screens[index]
+
+    def launch(self, package: str) -> int:
+        return next((s.index for s in self.screens if s.package == package), 0 if self.screens else -1)
+
+    def after_tap(self, index: int, x: int, y: int) -> int:
+        screen = self.screen(index)
+        key = screen.target_at(x, y)
+        if key is None:
+            return index
+        if screen is self.home:
+            return self.launch(key)
+        same_app = [s.index for s in self.screens if s.package == screen.package]
+        return same_app[zlib.crc32(key.encode()) % len(same_app)]
+
+# --- Fake device state ---
+
+def _png(seed: int, width: int = 270, height: int = 606) -> bytes:
+    """A small gradient PNG, different per screen, so screenshot consumers get real image bytes."""
+    r, g, b = (seed * 67) % 256, (seed * 131) % 256, (seed * 29) % 256
+    rows = b"".join(b"\x00" + bytes(((r + y) % 256, g, (b + y // 3) % 256)) * width for y in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 9)) + chunk(b"IEND", b"")
+
+class FarmDevice:
+    """One virtual device. State lives in a file so every adb process sees the same screen."""
+
+    def __init__(self, farm_dir: str, serial: str):
+        self.path = os.path.join(farm_dir, "state", f"{serial}.json")
+        self.serial = serial
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, "a+")
+        if fcntl:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._file.seek(0)
+        content = self._file.read()
+        self.state = json.loads(content) if content else {"screen": -1, "stack": [], "files": {}}
+        return self
+
+    def __exit__(self, *exc):
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(json.dumps(self.state))
+        self._file.flush()
+        if fcntl:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+    def go(self, index: int):
+        if index != self.state["screen"]:
+            self.state["stack"] = (self.state["stack"] + [self.state["screen"]])[-20:]
+            self.state["screen"] = index
+
+def load_config(farm_dir: str) -> Dict:
+    with open(os.path.join(farm_dir, "farm.json"), "r") as f:
+        config = {**DEFAULT_CONFIG, **json.load(f)}
+    # Environment overrides, so a load test can change conditions without reinstalling
+    for key in ("latency_ms", "jitter_ms", "dump_latency_ms", "failure_rate", "dump_failure_rate"):
+        value = os.getenv(f"RATT_FARM_{key.upper()}")
+        if value is not None:
+            config[key] = float(value)
+    return config
+
+def _shell(device: FarmDevice, graph: ScreenGraph, config: Dict, args: List[str]):
+    """Run a device shell command. Returns (returncode, stdout, stderr); stdout may be bytes."""
+    state = device.state
+    screen = graph.screen(state["screen"])
+    command = " ".join(args)
+    if not args:
+        return 0, "", ""
+    if args[0] == "uiautomator" and "dump" in args:
+        time.sleep(config["dump_latency_ms"] / 1000)
+        if random.random() < config["dump_failure_rate"]:
+            return 1, "", "ERROR: could not get idle state."
+        path = args[-1] if args[-1].startswith("/") else "/sdcard/window_dump.xml"
+        state["files"][path] = {"screen": screen.index}
+        return 0, f"UI hierchary dumped to: {path}\n", ""
+    if args[0] == "cat" and len(args) > 1:
+        stored = state["files"].get(args[1])
+        if stored is None:
+            return 1, "", f"cat: {args[1]}: No such file or directory"
+        if stored.get("png"):
+            return 0, _png(stored["screen"] + 2), ""
+        return 0, graph.screen(stored["screen"]).xml, ""
+    if args[0] == "rm":
+        for path in args[1:]:
+            state["files"].pop(path, None)
+        return 0, "", ""
+    if args[0] == "screencap":
+        if args[-1].startswith("/"):
+            state["files"][args[-1]] = {"screen": screen.index, "png": True}
+            return 0, "", ""
+        return 0, _png(screen.index + 2), ""
+    if args[0] == "dumpsys" and "window" in args:
+        return 0, f"  mCurrentFocus=Window{{1a2b3c u0 {screen.activity}}}\n", ""
+    if args[0] == "wm":
+        if "size" in args:
+            return 0, f"Physical size: {config['size']}\n", ""
+        return 0, f"Physical density: {config['density']}\n", ""
+    if args[0] == "getprop":
+        return 0, f"{config['model']}\n" if "ro.product.model" in command else "\n", ""
+    if args[0] == "input":
+        if len(args) >= 4 and args[1] == "tap":
+            device.go(graph.after_tap(screen.index, int(float(args[2])), int(float(args[3]))))
+        elif len(args) >= 3 and args[1] == "keyevent":
+            if args[2] in KEY_BACK and state["stack"]:
+                state["screen"] = state["stack"].pop()
+            elif args[2] in KEY_HOME:
+                device.go(-1)
+        return 0, "", ""
+    if args[0] == "monkey" and "-p" in args:
+        device.go(graph.launch(args[args.index("-p") + 1]))
+        return 0, "Events injected: 1\n", ""
+    if args[0] == "am" and len(args) >= 3 and args[1] == "force-stop":
+        if screen.package == args[2]:
+            device.go(-1)
+        return 0, "", ""
+    if args[0] == "pm" and len(args) >= 2:
+        if args[1] == "list":
+            return 0, "".join(f"package:{p}\n" for p in graph.packages if p != LAUNCHER), ""
+        if args[1] == "clear":
+            return 0, "Success\n", ""
+    return 0, "", ""
+
+def adb_main(argv: List[str], farm_dir: str) -> int:
+    """Entry point of the fake adb executable."""
+    config = load_config(farm_dir)
+    serials = config["devices"]
+    time.sleep(max(0.0, config["latency_ms"] + random.uniform(-1, 1) * config["jitter_ms"]) / 1000)
+
+    args = list(argv)
+    serial = os.getenv("ANDROID_SERIAL")
+    if len(args) >= 2 and args[0] == "-s":
+        serial = args[1]
+        args = args[2:]
+    if not args or args[0] == "devices":
+        sys.stdout.write("List of devices attached\n" + "".join(f"{s}\tdevice\n" for s in serials) + "\n")
+        return 0
+    if args[0] in ("start-server", "kill-server", "wait-for-device"):
+        return 0
+    # Real adb refuses to guess with several devices; the farm picks the first so /hierarchy works
+    serial = serial or serials[0]
+    if serial not in serials:
+        sys.stderr.write(f"adb: device '{serial}' not found\n")
+        return 1
+    if random.random() < config["failure_rate"]:
+        sys.stderr.write(f"error: device '{serial}' offline\n")
+        return 1
+    if args[0] not in ("shell", "exec-out"):
+        return 0
+
+    graph = ScreenGraph(config.get("screens") or DEFAULT_SCREENS, config["size"])
+    with FarmDevice(farm_dir, serial) as device:
+        code, out, err = _shell(device, graph, config, args[1:])
+    if isinstance(out, bytes):
+        sys.stdout.buffer.write(out)
+    else:
+        sys.stdout.write(out)
+    sys.stderr.write(err)
+    return code
+
+def install(farm_dir: str, devices: int = 4, **config) -> str:
+    """Write a farm: farm.json, per-device state and an `adb` executable. Returns the directory to put on PATH."""
+    farm_dir = os.path.abspath(farm_dir)
+    os.makedirs(os.path.join(farm_dir, "state"), exist_ok=True)
+    for name in os.listdir(os.path.join(farm_dir, "state")):
+        os.remove(os.path.join(farm_dir, "state", name))
+    settings = {**DEFAULT_CONFIG, **{k: v for k, v in config.items() if v is not None}}
+    settings["devices"] = [f"emulator-{5554 + 2 * i}" for i in range(devices)]
+    settings.setdefault("screens", [os.path.abspath(p) for p in DEFAULT_SCREENS if os.path.exists(p)])
+    with open(os.path.join(farm_dir, "farm.json"), "w") as f:
+        json.dump(settings, f, indent=2)
+    adb_path = os.path.join(farm_dir, "adb")
+    with open(adb_path, "w") as f:
+        f.write(ADB_SCRIPT.format(python=sys.executable, backend=BACKEND_DIR, farm=farm_dir))
+    os.chmod(adb_path, 0o755)
+    return farm_dir
+
+# --- Load driver ---
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def default_flow(farm_dir: str) -> str:
+    """launchApp plus an assertion on the first text of the app's first screen."""
+    config = load_config(farm_dir)
+    graph = ScreenGraph(config.get("screens") or DEFAULT_SCREENS, config["size"])
+    apps = [p for p in graph.packages if "launcher" not in p] or graph.packages
+    app = apps[0]
+    first = graph.screen(graph.launch(app))
+    text = next((n.get("text") for n in ET.fromstring(first.xml[first.xml.find("<hierarchy"):]).iter("node") if n.get("text")), None)
+    steps = ["- launchApp"] + ([f"- assertVisible: {json.dumps(text)}"] if text else [])
+    return f"appId: {app}\nname: farm-load\n---\n" + "\n".join(steps) + "\n"
+
+def run_load(url: str, devices: List[str], flow: str, runs: int, hierarchy: int, screenshots: int, concurrency: int) -> Dict:
+    """
+    Fire /run, /hierarchy and /screenshot requests concurrently against a server using the farm.
+    Returns per-endpoint count, errors, throughput and latency percentiles (ms).
+    """
+    import requests
+    results: Dict[str, List] = {"run": [], "hierarchy": [], "screenshot": []}
+    lock = threading.Lock()
+
+    def record(kind, start, ok):
+        with lock:
+            results[kind].append(((time.time() - start) * 1000, ok))
+
+    def do_run(i):
+        start = time.time()
+        ok = False
+        try:
+            body = {"yaml_content": flow, "filename": f"farm-load-{i}.yaml", "device": devices[i % len(devices)] if devices else ""}
+            with requests.post(f"{url}/run", json=body, stream=True, timeout=600) as response:
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and "[DONE] EXIT_CODE:" in line:
+                        ok = line.strip().endswith("0")
+        except Exception as e:
+            print(f"[DEBUG] Load: run {i} failed: {e}")
+        record("run", start, ok)
+
+    def do_get(kind, path):
+        start = time.time()
+        try:
+            response = requests.get(f"{url}{path}", timeout=60)
+            ok = response.status_code == 200
+        except Exception:
+            ok = False
+        record(kind, start, ok)
+
+    tasks = [(do_run, (i,)) for i in range(runs)]
+    tasks += [(do_get, ("hierarchy", "/hierarchy")) for _ in range(hierarchy)]
+    tasks += [(do_get, ("screenshot", "/screenshot")) for _ in range(screenshots)]
+    random.shuffle(tasks)
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(fn, *args) for fn, args in tasks]:
+            future.result()
+    elapsed = time.time() - started
+
+    report = {"elapsed_s": round(elapsed, 2), "concurrency": concurrency, "endpoints": {}}
+    for kind, samples in results.items():
+        if not samples:
+            continue
+        latencies = [ms for ms, _ in samples]
+        report["endpoints"][kind] = {
+            "count": len(samples),
+            "errors": sum(1 for _, ok in samples if not ok),
+            "throughput_per_s": round(len(samples) / elapsed, 2),
+            "p50_ms": round(_percentile(latencies, 50)),
+            "p95_ms": round(_percentile(latencies, 95)),
+            "p99_ms": round(_percentile(latencies, 99)),
+            "max_ms": round(max(latencies)),
+            "mean_ms": round(statistics.mean(latencies))
+        }
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated adb device farm and load driver")
+    sub = parser.add_subparsers(dest="command", required=True)
+    setup = sub.add_parser("install", help="Create a farm directory with a fake adb")
+    setup.add_argument("dir")
+    setup.add_argument("--devices", type=int, default=4)
+    for key in ("latency_ms", "jitter_ms", "dump_latency_ms", "failure_rate", "dump_failure_rate"):
+        setup.add_argument(f"--{key.replace('_', '-')}", type=float)
+    load = sub.add_parser("load", help="Drive a server that uses the farm's adb")
+    load.add_argument("dir", help="Farm directory (for device serials and the default flow)")
+    load.add_argument("--url", default="http://localhost:8000")
+    load.add_argument("--flow", help="Flow YAML file to run; a generated one by default")
+    load.add_argument("--runs", type=int, default=8)
+    load.add_argument("--hierarchy", type=int, default=50)
+    load.add_argument("--screenshots", type=int, default=50)
+    load.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    if args.command == "install":
+        config = {key: getattr(args, key) for key in ("latency_ms", "jitter_ms", "dump_latency_ms", "failure_rate", "dump_failure_rate")}
+        farm_dir = install(args.dir, devices=args.devices, **config)
+        print(f"Farm with {args.devices} devices in {farm_dir}")
+        print(f"Start the backend with: PATH={farm_dir}:$PATH")
+        return 0
+
+    flow = open(args.flow).read() if args.flow else default_flow(args.dir)
+    devices = load_config(args.dir)["devices"]
+    report = run_load(args.url, devices, flow, args.runs, args.hierarchy, args.screenshots, args.concurrency)
+    print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
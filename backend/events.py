@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+
+# Events kept per run; a reader that falls further behind gets a "gap" event
+RUN_EVENT_BUFFER = int(os.getenv("RATT_RUN_EVENT_BUFFER", "2000"))
+# Run logs kept in memory; the oldest finished runs are evicted first
+MAX_RUN_LOGS = 200
+# Seconds between SSE keepalives while a run is quiet
+EVENT_KEEPALIVE = 15.0
+
+# run_start, run_end, step_start, step_end (with phase timings), heal, ai_analysis, artifact,
+# and log for every human-readable line of the legacy stream
+EVENT_TYPES = ("run_start", "run_end", "step_start", "step_end", "heal", "ai_analysis", "artifact", "log")
+
+class RunEventLog:
+    """Bounded ring buffer of one run's typed events. Ids start at 1 and increase without gaps."""
+
+    def __init__(self, run_id: str, capacity: int = RUN_EVENT_BUFFER):
+        self.run_id = run_id
+        self._events = deque(maxlen=capacity)
+        self._next_id = 1
+        self._cond = threading.Condition()
+        self.closed = False
+        self.closed_at = None
+
+    @property
+    def last_id(self) -> int:
+        return self._next_id - 1
+
+    def publish(self, type: str, **data) -> Dict:
+        with self._cond:
+            event = {"id": self._next_id, "run_id": self.run_id, "type": type, "ts": round(time.time(), 3), **data}
+            self._next_id += 1
+            self._events.append(event)
+            self._cond.notify_all()
+        return event
+
+    def close(self):
+        with self._cond:
+            if not self.closed:
+                self.closed = True
+                self.closed_at = time.time()
+                self._cond.notify_all()
+
+    def _since(self, last_id: int) -> Tuple[List[Dict], int]:
+        if not self._events:
+            return [], 0
+        oldest = self._events[0]["id"]
+        start = max(0, last_id + 1 - oldest)
+        events = list(self._events)[start:]
+        return events, max(0, oldest - last_id - 1)
+
+    def since(self, last_id: int = 0) -> Tuple[List[Dict], int]:
+        """Events after last_id, and how many events after last_id were already dropped."""
+        with self._cond:
+            return self._since(last_id)
+
+    def follow(self, last_id: int = 0):
+        """SSE frames from last_id on, following the run until it closes."""
+        cursor = last_id
+        while True:
+            with self._cond:
+                events, missed = self._since(cursor)
+                if not events and not self.closed:
+                    self._cond.wait(timeout=EVENT_KEEPALIVE)
+                    events, missed = self._since(cursor)
+                done = self.closed and not events
+            if missed:
+                yield f"data: {json.dumps({'run_id': self.run_id, 'type': 'gap', 'after': cursor, 'missed': missed})}\n\n"
+            for event in events:
+                yield f"id: {event['id']}\ndata: {json.dumps(event, default=str)}\n\n"
+                cursor = event["id"]
+            if done:
+                return
+            if not events:
+                yield ": keepalive\n\n"
+
+class EventHub:
+    """Event logs of recent runs by run id, shared by every observer of a run."""
+
+    def __init__(self, max_runs: int = MAX_RUN_LOGS):
+        self.max_runs = max_runs
+        self._lock = threading.Lock()
+        self._logs: "OrderedDict[str, RunEventLog]" = OrderedDict()
+
+    def open(self, run_id: str) -> RunEventLog:
+        with self._lock:
+            log = self._logs.get(run_id)
+            if log is None or log.closed:
+                log = self._logs[run_id] = RunEventLog(run_id)
+            self._logs.move_to_end(run_id)
+            for key in [k for k, l in self._logs.items() if l.closed][:max(0, len(self._logs) - self.max_runs)]:
+                del self._logs[key]
+            return log
+
+    def get(self, run_id: str) -> Optional[RunEventLog]:
+        return self._logs.get(run_id)
+
+event_hub = EventHub()
@@ -0,0 +1,143 @@
+import os
+import time
+from typing import Dict, Optional, Any
+from intelligence import TestMemory, intelligence
+from events import event_hub
+import adb_transport
+import tracing
+import metrics
+import profiling
+
+# Tunables a run can override through ExecutionContext(policies=...)
+DEFAULT_POLICIES = {
+    "hierarchy_cache_ttl": 3.0, # Seconds a hierarchy dump is reused when nothing was touched
+    "native_dump_max_failures": 3, # uiautomator failures before falling back to maestro for the run
+    "trace_window_timeout": float(os.getenv("RATT_TRACE_WINDOW_TIMEOUT", "5")), # FAST trace window wait
+    "semantic_resolver": True, # Ask the LLM resolver when an element can't be found
+    "probe_timeout_ms": 1000 # How long `when` and `optional` look for an element beyond the current snapshot
+}
+
+class ExecutionContext:
+    """
+    Everything one run owns: target device, run id, memory partition, UI snapshot cache,
+    API keys and policies. Runner functions take it explicitly so concurrent runs in the
+    same server don't share state.
+    """
+
+    def __init__(self, device: Optional[str] = None, run_id: Optional[str] = None, memory: Optional[TestMemory] = None,
+                 api_key: Optional[str] = None, policies: Optional[Dict[str, Any]] = None, transport=None,
+                 profile: bool = False):
+        self.device = device or None # adb serial; adb's default device when None
+        self.run_id = run_id
+        self.memory = memory or intelligence
+        self.api_key = api_key or None
+        self.policies = {**DEFAULT_POLICIES, **(policies or {})}
+        self.transport = transport or adb_transport.transport # How adb/maestro commands reach the device
+
+        # UI snapshot cache and interaction clock
+        self.hierarchy_cache = {"data": None, "time": 0, "hash": None}
+        self.last_interaction_time = 0
+        self.native_dump_failures = 0
+
+        # Step memory chain and FAST trace recording of the current run
+        self.step_chain = {"key": None, "next_screen": None}
+        self.trace_recorder = None
+
+        # Typed event log of the current run and phase timings of the current step
+        self.events = None
+        self.step_phases = {}
+
+        # Timed spans of the current run, shown as a waterfall in its report
+        self.tracer = None
+        self._step_started = 0.0
+        self._active_runs = None # Gauge child counting this run while it is in progress
+
+        # Sampling and allocation profile of the run, when requested
+        self.profile = profile
+        self.profiler = None
+
+    def sleep(self, seconds: float):
+        """Wait between device commands; a transport with a clock of its own (a replay) decides how long."""
+        tracing.sleep(seconds, self.tracer, getattr(self.transport, "sleep", time.sleep))
+
+    def now(self) -> float:
+        """The clock that waits and cache ages are measured on: the transport's, if it keeps one."""
+        return getattr(self.transport, "time", time.time)()
+
+    def mark_interaction(self):
+        self.last_interaction_time = self.now()
+
+    def start_run(self, run_id: str, **info):
+        self.run_id = run_id
+        self.step_chain = {"key": None, "next_screen": None}
+        self.events = event_hub.open(run_id)
+        self.tracer = tracing.Tracer()
+        if self.profile and self.profiler is None:
+            self.profiler = profiling.RunProfiler(run_id)
+        if self._active_runs is None:
+            self._active_runs = metrics.ACTIVE_RUNS.labels(metrics.device_label(self.device))
+            self._active_runs.inc()
+        self.emit("run_start", device=self.device, **info)
+
+    def begin_step(self, index: int):
+        self.step_phases = {}
+        self._step_started = time.perf_counter()
+        if self.tracer:
+            self.tracer.step = index
+
+    def end_step(self, action: str, status: str, **attrs):
+        """Close the step's own span, which encloses everything traced while it ran."""
+        end = time.perf_counter()
+        metrics.STEP_SECONDS.labels(action, status).observe(end - self._step_started)
+        if self.tracer:
+            self.tracer.record("step", self._step_started, end, {"action": action, "status": status, **attrs})
+
+    def end_run(self, status: str, duration_ms: int, **info):
+        self.memory.end_run(self.run_id, status, duration_ms)
+        metrics.RUNS.labels(status).inc()
+        if self.tracer:
+            self.tracer.step = None
+            self.memory.save_spans(self.run_id, self.tracer.export())
+        self.emit("run_end", status=status, duration_ms=duration_ms, report=f"/report/{self.run_id}", **info)
+
+    def emit(self, type: str, **data):
+        """Publish a typed event to the run's log; a no-op outside a run."""
+        if self.events:
+            self.events.publish(type, **data)
+
+    def published(self, messages):
+        """
+        Pass a legacy SSE stream through, mirroring each line as a log event; closes the log at the end.
+        The run's tracer is made current around each step of the stream, since the server may resume
+        the stream on a different thread each time.
+        """
+        try:
+            while True:
+                with tracing.activate(self.tracer), profiling.attached(self.profiler):
+                    msg = next(messages, None)
+                if msg is None:
+                    break
+                if self.events:
+                    text = msg[len("data: "):] if msg.startswith("data: ") else msg
+                    self.events.publish("log", text=text.rstrip("\n"))
+                yield msg
+        finally:
+            if self.events:
+                self.events.close()
+            if self._active_runs is not None:
+                self._active_runs.dec()
+                self._active_runs = None
+            if self.profiler:
+                self.profiler.stop()
+                try:
+                    print(f"[DEBUG] Profile saved to {self.profiler.save()}")
+                except Exception as e:
+                    print(f"[DEBUG] Saving profile failed: {e}")
+
+    @property
+    def openai_key(self) -> Optional[str]:
+        """The run's own key, else the server's environment."""
+        return self.api_key or os.getenv("RATT_OPENAI_KEY") or os.getenv("OPENAI_API_KEY")
+
+# Context for one-off calls outside a run (single steps, hierarchy inspection)
+default_context = ExecutionContext()
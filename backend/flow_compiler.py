@@ -0,0 +1,431 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import yaml
+from pydantic import BaseModel
+
+# Bump when the IR changes so stale disk entries are recompiled
+COMPILER_VERSION = 2
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory", "compiled")
+# runFlow files are looked up next to the including flow, then here
+WORKSPACE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test-flows"))
+# Compiled flows kept in process memory (LRU)
+MAX_CACHED_FLOWS = 256
+# repeat with only a while condition stops with an error after this many iterations
+MAX_REPEAT = 100
+# Upper bound on a flow after runFlow/repeat expansion
+MAX_EXPANDED_STEPS = 5000
+
+VALID_COMMANDS = {
+    "tapOn", "doubleTapOn", "longPressOn",
+    "inputText", "eraseText", "inputRandomText", "inputRandomNumber", "inputRandomEmail", "inputRandomPersonName",
+    "assertVisible", "assertNotVisible", "assertTrue",
+    "scroll", "swipe", "scrollUntilVisible", "pressKey", "back", "hideKeyboard", "volumeUp", "volumeDown",
+    "openLink", "stopApp", "clearState", "clearKeychain", "launchApp", "killApp",
+    "runFlow", "extendedWaitUntil", "waitForAnimationToEnd", "waitForAnimation", "wait",
+    "repeat", "webhook", "takeScreenshot",
+    "copyTextFrom", "pasteText",
+    "evalScript", "runScript",
+    "startRecording", "stopRecording",
+    "setLocation", "travel"
+}
+
+# Steps whose parameters are the element selector
+ELEMENT_STEPS = {"tapOn", "doubleTapOn", "longPressOn", "assertVisible", "assertNotVisible"}
+# Steps that may target an element through their "element" parameter
+ELEMENT_PARAM_STEPS = {"scroll", "swipe", "scrollUntilVisible"}
+# Steps that default to the appId of the flow header
+APP_STEPS = {"launchApp", "stopApp", "killApp"}
+# Steps that contain other steps
+CONTROL_STEPS = {"runFlow", "repeat"}
+
+class FlowCompileError(Exception):
+    def __init__(self, message: str, line: Optional[int] = None, column: Optional[int] = None):
+        super().__init__(message)
+        self.line = line
+        self.column = column
+
+class CompiledStep(BaseModel):
+    position: int = 0 # Index in the flow
+    line: Optional[int] = None # 1-based source line
+    type: str
+    raw: Any = None # The step as written
+    params: Any = None # Parameters with the header appId injected
+    query: Optional[str] = None # Pre-resolved element selector
+    index: Optional[int] = None # Which match of an ambiguous selector
+    point: Optional[List[str]] = None # Tap point as written: pixels or percentages
+    condition: Optional[str] = None # extendedWaitUntil target / repeat while: "visible" or "notVisible"
+    source: Optional[str] = None # runFlow file the step was expanded from; None for the run's own flow
+    steps: List["CompiledStep"] = [] # runFlow/repeat commands
+    file: Optional[str] = None # runFlow file as written
+    env: Dict[str, Any] = {} # runFlow env parameters
+    times: Optional[int] = None # repeat count
+    optional: bool = False # A missing element skips the step instead of failing the flow
+    when: Optional[Dict[str, Any]] = None # Run only if {"condition", "query", "index"} holds on screen
+
+CompiledStep.update_forward_refs()
+
+class CompiledFlow(BaseModel):
+    version: int = COMPILER_VERSION
+    content_hash: str
+    header: Dict[str, Any] = {}
+    app_id: Optional[str] = None
+    steps: List[CompiledStep] = []
+
+    def raw_steps(self) -> List[Any]:
+        return [step.raw for step in self.steps]
+
+def resolve_query(params):
+    if params is None: return None
+    if isinstance(params, str): return params
+    if not isinstance(params, dict): return str(params)
+    if "point" in params: return None
+
+    # Prioritize common Maestro-style keys
+    for key in ["id", "resourceId", "text", "contentDescription", "accessibilityId", "label", "hint"]:
+        if key in params:
+            val = str(params[key])
+            # Auto-detect regex for IDs/resourceIds if they contain regex special chars
+            if key in ["id", "resourceId"] and not val.startswith("regexp:"):
+                if any(c in val for c in [".*", "+", "^", "$", "|"]):
+                    return f"regexp:{val}"
+            return val
+
+    # Fallback to any value that isn't a known metadata key
+    clean = {k:v for k,v in params.items() if k not in ["timeout", "optional", "index", "point", "longPress", "when"]}
+    if clean: return str(next(iter(clean.values())))
+    return None
+
+def _where(position: int, line: Optional[int]) -> str:
+    return f"Step {position+1}" + (f" (line {line})" if line else "")
+
+def _parse_point(params: Dict, position: int, line: Optional[int]) -> List[str]:
+    pt = str(params["point"])
+    if "," in pt:
+        px_str, py_str = pt.split(",", 1)
+        return [px_str.strip(), py_str.strip()]
+    # YAML parses {point: 90%, 9%} as point: '90%' plus a '9%' key
+    for k in params:
+        if k != "point":
+            return [pt.strip(), str(k).strip()]
+    raise FlowCompileError(f"Invalid point format at {_where(position, line)}: {pt}", line)
+
+def _index(value, position: int, line: Optional[int]) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise FlowCompileError(f"{_where(position, line)}: index must be a number, got '{value}'", line)
+
+def _parse_condition(target_map: Dict, position: int, line: Optional[int]) -> Optional[Dict[str, Any]]:
+    """{"condition", "query", "index"} from a {visible: ...} or {notVisible: ...} map."""
+    for condition, keys in (("visible", ("visible", "assertVisible")), ("notVisible", ("notVisible", "assertNotVisible"))):
+        target = next((target_map[k] for k in keys if target_map.get(k)), None)
+        if target:
+            index = _index(target.get("index"), position, line) if isinstance(target, dict) else None
+            return {"condition": condition, "query": resolve_query(target), "index": index}
+    return None
+
+def _compile_condition(compiled: CompiledStep, target_map: Dict, position: int, line: Optional[int]) -> bool:
+    """Set condition/query/index from a {visible: ...} or {notVisible: ...} map."""
+    parsed = _parse_condition(target_map, position, line)
+    if parsed:
+        compiled.condition, compiled.query, compiled.index = parsed["condition"], parsed["query"], parsed["index"]
+    return parsed is not None
+
+def _commands_nodes(node) -> List:
+    """Item nodes of the `commands` list of a runFlow/repeat step node, for line numbers."""
+    if not isinstance(node, yaml.MappingNode) or not node.value:
+        return []
+    params_node = node.value[0][1]
+    if not isinstance(params_node, yaml.MappingNode):
+        return []
+    for key_node, value_node in params_node.value:
+        if key_node.value == "commands" and isinstance(value_node, yaml.SequenceNode):
+            return value_node.value
+    return []
+
+def _compile_commands(commands, node, position: int, line: Optional[int], app_id: Optional[str]) -> List[CompiledStep]:
+    if commands is None:
+        return []
+    if not isinstance(commands, list):
+        raise FlowCompileError(f"{_where(position, line)}: commands must be a list of steps", line)
+    item_nodes = _commands_nodes(node)
+    if len(item_nodes) != len(commands):
+        item_nodes = [None] * len(commands)
+    return [
+        compile_step(command, position=j, line=item_node.start_mark.line + 1 if item_node else line, app_id=app_id, node=item_node)
+        for j, (command, item_node) in enumerate(zip(commands, item_nodes))
+    ]
+
+def compile_step(step: Any, position: int = 0, line: Optional[int] = None, app_id: Optional[str] = None, node=None) -> CompiledStep:
+    """Validate one step and resolve its selector. `node` is its YAML node, for nested line numbers."""
+    if isinstance(step, str):
+        step_type, params = step, None
+        if step_type not in VALID_COMMANDS:
+            raise FlowCompileError(f"Unknown Command at {_where(position, line)}: '{step_type}'", line)
+    elif isinstance(step, dict) and step:
+        for key in step:
+            if key not in VALID_COMMANDS:
+                raise FlowCompileError(f"Unknown Command at {_where(position, line)}: '{key}'. Did you mean 'assertVisible'?", line)
+        step_type = next(iter(step))
+        params = step[step_type]
+    else:
+        raise FlowCompileError(f"{_where(position, line)} must be a command or a command with parameters", line)
+
+    if step_type in APP_STEPS and app_id:
+        if params is None:
+            params = {"appId": app_id}
+        elif isinstance(params, dict) and "appId" not in params:
+            params = {**params, "appId": app_id}
+    if step_type == "launchApp" and not params:
+        raise FlowCompileError(f"{_where(position, line)}: launchApp needs an appId (in the step or the flow header)", line)
+
+    compiled = CompiledStep(position=position, line=line, type=step_type, raw=step, params=params)
+    if isinstance(params, dict):
+        compiled.optional = bool(params.get("optional", False))
+        if params.get("when") is not None:
+            compiled.when = _parse_condition(params["when"], position, line) if isinstance(params["when"], dict) else None
+            if not compiled.when:
+                raise FlowCompileError(f"{_where(position, line)}: when needs visible or notVisible", line)
+    if step_type == "tapOn" and isinstance(params, dict) and "point" in params:
+        compiled.point = _parse_point(params, position, line)
+    elif step_type in ELEMENT_STEPS:
+        compiled.query = resolve_query(params)
+        compiled.index = _index(params.get("index"), position, line) if isinstance(params, dict) else None
+        if not compiled.query:
+            raise FlowCompileError(f"{_where(position, line)}: {step_type} needs an element selector", line)
+    elif step_type in ELEMENT_PARAM_STEPS:
+        if isinstance(params, dict):
+            compiled.query = resolve_query(params.get("element"))
+        elif step_type == "scrollUntilVisible":
+            compiled.query = resolve_query(params)
+        if step_type == "scrollUntilVisible" and not compiled.query:
+            raise FlowCompileError(f"{_where(position, line)}: scrollUntilVisible needs an element", line)
+    elif step_type == "extendedWaitUntil" and isinstance(params, dict):
+        _compile_condition(compiled, params, position, line)
+    elif step_type == "runFlow":
+        if isinstance(params, str):
+            compiled.file = params
+        elif isinstance(params, dict) and (params.get("file") or params.get("commands")):
+            compiled.file = params.get("file")
+            compiled.env = params.get("env") or {}
+            if not isinstance(compiled.env, dict):
+                raise FlowCompileError(f"{_where(position, line)}: runFlow env must be a mapping", line)
+            compiled.steps = _compile_commands(params.get("commands"), node, position, line, app_id)
+        else:
+            raise FlowCompileError(f"{_where(position, line)}: runFlow needs a file or commands", line)
+    elif step_type == "repeat":
+        if not isinstance(params, dict) or not params.get("commands"):
+            raise FlowCompileError(f"{_where(position, line)}: repeat needs commands", line)
+        if params.get("times") is not None:
+            try:
+                compiled.times = int(params["times"])
+            except (TypeError, ValueError):
+                raise FlowCompileError(f"{_where(position, line)}: repeat times must be a number, got '{params['times']}'", line)
+        loop_while = params.get("while")
+        if loop_while is not None and not (isinstance(loop_while, dict) and _compile_condition(compiled, loop_while, position, line)):
+            raise FlowCompileError(f"{_where(position, line)}: repeat while needs visible or notVisible", line)
+        if compiled.times is None and compiled.condition is None:
+            raise FlowCompileError(f"{_where(position, line)}: repeat needs times or while", line)
+        compiled.steps = _compile_commands(params["commands"], node, position, line, app_id)
+    return compiled
+
+def _load_documents(yaml_content: str):
+    """Parse all YAML documents, keeping their nodes for source line numbers."""
+    loader = yaml.SafeLoader(yaml_content)
+    try:
+        nodes = []
+        while loader.check_node():
+            nodes.append(loader.get_node())
+        return nodes, [loader.construct_document(node) for node in nodes]
+    except yaml.YAMLError as e:
+        mark = getattr(e, "problem_mark", None)
+        if mark:
+            raise FlowCompileError(f"YAML Syntax Error at line {mark.line + 1}, column {mark.column + 1}: {e.problem}",
+                                   mark.line + 1, mark.column + 1)
+        raise FlowCompileError(str(e))
+    finally:
+        loader.dispose()
+
+def _compile(yaml_content: str, content_hash: str, default_app_id: Optional[str] = None) -> CompiledFlow:
+    nodes, docs = _load_documents(yaml_content)
+    if not docs:
+        raise FlowCompileError("YAML file is empty")
+
+    # Header + flow documents, or just a flow
+    header = docs[0] if isinstance(docs[0], dict) else {}
+    flow_index = 1 if len(docs) > 1 else (0 if isinstance(docs[0], list) else None)
+    flow = docs[flow_index] if flow_index is not None else []
+    if flow is None:
+        flow = []
+    if not isinstance(flow, list):
+        flow_line = nodes[flow_index].start_mark.line + 1
+        raise FlowCompileError(f"Test flow must be a list of steps (starting with '-') (line {flow_line})", flow_line)
+
+    if not isinstance(header.get("env") or {}, dict):
+        raise FlowCompileError("Flow header env must be a mapping")
+
+    # Subflows without their own appId use the including flow's
+    app_id = header.get("appId") or default_app_id
+    item_nodes = nodes[flow_index].value if flow_index is not None and flow else []
+    steps = [
+        compile_step(step, position=i, line=item_nodes[i].start_mark.line + 1, app_id=app_id, node=item_nodes[i])
+        for i, step in enumerate(flow)
+    ]
+    return CompiledFlow(content_hash=content_hash, header=header, app_id=app_id, steps=steps)
+
+_cache: "OrderedDict[str, CompiledFlow]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+def content_hash(yaml_content: str, app_id: Optional[str] = None) -> str:
+    return hashlib.sha1(f"{COMPILER_VERSION}\n{app_id or ''}\n{yaml_content}".encode()).hexdigest()[:20]
+
+def _read_disk(key: str) -> Optional[CompiledFlow]:
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        with open(path, "r") as f:
+            flow = CompiledFlow.parse_obj(json.load(f))
+        return flow if flow.version == COMPILER_VERSION else None
+    except (OSError, ValueError):
+        return None
+
+def _write_disk(flow: CompiledFlow):
+    path = os.path.join(CACHE_DIR, f"{flow.content_hash}.json")
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(flow.dict(), f, default=str)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"[DEBUG] Flow compiler: could not cache {flow.content_hash}: {e}")
+
+def compile_flow(yaml_content: str, app_id: Optional[str] = None) -> CompiledFlow:
+    """
+    Compile flow YAML into the step IR. Results are cached by content hash in memory and on disk,
+    so the validator, the scheduler and every run of the same file parse it once. `app_id` is the
+    default for a flow without its own (a subflow). Raises FlowCompileError with the source line.
+    """
+    key = content_hash(yaml_content, app_id)
+    with _cache_lock:
+        flow = _cache.get(key)
+        if flow is not None:
+            _cache.move_to_end(key)
+            return flow
+
+    flow = _read_disk(key)
+    if flow is None:
+        flow = _compile(yaml_content, key, app_id)
+        _write_disk(flow)
+
+    with _cache_lock:
+        _cache[key] = flow
+        while len(_cache) > MAX_CACHED_FLOWS:
+            _cache.popitem(last=False)
+    return flow
+
+# --- runFlow / repeat expansion ---
+
+_VARIABLE = re.compile(r"\$\{(\w+)\}")
+_subflows: Dict = {} # (path, default app id) -> (mtime, CompiledFlow)
+
+def substitute(value, env: Dict):
+    """Replace ${NAME} with env values in strings, lists and mappings; unknown names are left as is."""
+    if isinstance(value, str):
+        return _VARIABLE.sub(lambda m: str(env[m.group(1)]) if m.group(1) in env else m.group(0), value)
+    if isinstance(value, list):
+        return [substitute(v, env) for v in value]
+    if isinstance(value, dict):
+        return {substitute(k, env): substitute(v, env) for k, v in value.items()}
+    return value
+
+def bind_env(step: CompiledStep, env: Dict) -> CompiledStep:
+    """A copy of the step with env variables filled in; the step itself when it has none."""
+    if not env or "${" not in json.dumps(step.raw, default=str):
+        return step
+    return step.copy(update={
+        "raw": substitute(step.raw, env),
+        "params": substitute(step.params, env),
+        "query": substitute(step.query, env),
+        "point": substitute(step.point, env),
+        "file": substitute(step.file, env),
+        "env": substitute(step.env, env),
+        "when": substitute(step.when, env),
+        "steps": [bind_env(child, env) for child in step.steps]
+    })
+
+def _inside(path: str, root: str) -> bool:
+    return os.path.commonpath([path, root]) == root
+
+def resolve_flow_path(file: str, base_dir: Optional[str] = None) -> str:
+    """The runFlow file relative to the flow's folder or the workspace; files outside both are refused."""
+    roots = [os.path.realpath(base) for base in (base_dir, WORKSPACE_DIR) if base]
+    for root in roots:
+        candidate = os.path.realpath(os.path.join(root, file))
+        if not any(_inside(candidate, r) for r in roots):
+            raise FlowCompileError(f"runFlow file is outside the workspace: {file}")
+        if os.path.isfile(candidate):
+            return candidate
+    raise FlowCompileError(f"runFlow file not found: {file}")
+
+def load_subflow(path: str, app_id: Optional[str] = None) -> CompiledFlow:
+    """Compile a runFlow file once per path and mtime; a suite sharing a login flow parses it once."""
+    mtime = os.path.getmtime(path)
+    with _cache_lock:
+        hit = _subflows.get((path, app_id))
+        if hit and hit[0] == mtime:
+            return hit[1]
+    with open(path, "r") as f:
+        flow = compile_flow(f.read(), app_id=app_id)
+    with _cache_lock:
+        _subflows[(path, app_id)] = (mtime, flow)
+    return flow
+
+def expand_steps(steps: List[CompiledStep], base_dir: Optional[str] = None, env: Optional[Dict] = None,
+                 app_id: Optional[str] = None, stack: tuple = ()) -> List[CompiledStep]:
+    """
+    Inline runFlow (file or commands) and repeat-times into plain steps, so step memory, FAST traces
+    and run events see ordinary steps. repeat-while depends on the screen and stays a control step,
+    with its commands expanded. `stack` holds the files being expanded, for cycle detection.
+    """
+    env = env or {}
+    expanded = []
+    for step in steps:
+        step = bind_env(step, env)
+        if step.type == "runFlow" and step.file:
+            path = resolve_flow_path(step.file, base_dir)
+            if path in stack:
+                chain = " -> ".join(os.path.basename(p) for p in stack + (path,))
+                raise FlowCompileError(f"runFlow cycle at {_where(step.position, step.line)}: {chain}", step.line)
+            subflow = load_subflow(path, app_id)
+            sub_env = {**(subflow.header.get("env") or {}), **env, **step.env}
+            children = [
+                child if child.source else child.copy(update={"source": path})
+                for child in expand_steps(subflow.steps, os.path.dirname(path), sub_env, subflow.app_id, stack + (path,))
+            ]
+        elif step.type == "runFlow":
+            children = expand_steps(step.steps, base_dir, {**env, **step.env}, app_id, stack)
+
+        if step.type == "runFlow" and step.when:
+            # Conditional: decided on screen, so it stays a control step
+            expanded.append(step.copy(update={"steps": children}))
+        elif step.type == "runFlow":
+            expanded += children
+        elif step.type == "repeat" and step.condition is None and not step.when:
+            body = expand_steps(step.steps, base_dir, env, app_id, stack)
+            if len(body) * step.times > MAX_EXPANDED_STEPS:
+                raise FlowCompileError(f"{_where(step.position, step.line)}: repeat expands to more than {MAX_EXPANDED_STEPS} steps", step.line)
+            expanded += body * step.times
+        elif step.type in CONTROL_STEPS:
+            expanded.append(step.copy(update={"steps": expand_steps(step.steps, base_dir, env, app_id, stack)}))
+        else:
+            expanded.append(step)
+        if len(expanded) > MAX_EXPANDED_STEPS:
+            raise FlowCompileError(f"Flow expands to more than {MAX_EXPANDED_STEPS} steps", step.line)
+    return expanded
@@ -0,0 +1,145 @@
+import io
+import os
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+try:
+    from PIL import Image # Optional: without Pillow frames are served as captured (full-size PNG)
+except ImportError:
+    Image = None
+
+# Memory kept for recent frames and their renditions
+CACHE_BYTES = int(float(os.getenv("RATT_FRAME_CACHE_MB", "64")) * 1024 * 1024)
+FORMATS = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+DEFAULT_QUALITY = 70
+# What LLM calls get instead of the full-size PNG; vision calls keep the device size so coordinates map 1:1
+LLM_WIDTH = 1080
+LLM_QUALITY = 80
+
+class Frame:
+    """A captured screen, identified by the hash of its PNG bytes, with its encoded renditions."""
+
+    def __init__(self, png: bytes):
+        self.png = png
+        self.id = hashlib.sha1(png).hexdigest()[:16]
+        self.captured_at = time.time()
+        # PNG IHDR: width and height are the big-endian ints at bytes 16-24
+        self.width = int.from_bytes(png[16:20], "big") if len(png) >= 24 else 0
+        self.height = int.from_bytes(png[20:24], "big") if len(png) >= 24 else 0
+        self.renditions: Dict[Tuple, bytes] = {}
+        self.encoded: Dict[Tuple, str] = {} # Base64 of renditions, for LLM payloads
+
+    @property
+    def size(self) -> int:
+        return len(self.png) + sum(len(r) for r in self.renditions.values()) + sum(len(e) for e in self.encoded.values())
+
+    def info(self) -> Dict:
+        return {"id": self.id, "width": self.width, "height": self.height, "bytes": len(self.png), "captured_at": self.captured_at}
+
+def rendition_key(fmt: str = "png", width: Optional[int] = None, quality: Optional[int] = None, frame: Optional[Frame] = None) -> Tuple[str, int, int]:
+    """Normalized (format, width, quality): what the frame is actually served as, also without Pillow."""
+    fmt = (fmt or "png").lower().replace("jpg", "jpeg")
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    full = frame.width if frame else 0
+    width = min(width, full) if width and full else (width or full)
+    if Image is None:
+        return "png", full, 0
+    if fmt == "png":
+        return "png", width, 0
+    return fmt, width, max(1, min(int(quality or DEFAULT_QUALITY), 100))
+
+class FrameCache:
+    """Recent frames by id, least recently used first out, bounded by the bytes of frames and renditions."""
+
+    def __init__(self, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._frames: "OrderedDict[str, Frame]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"frames": 0, "duplicates": 0, "transcodes": 0, "rendition_hits": 0}
+
+    def put(self, png: bytes) -> Frame:
+        """The cached frame for these bytes; an unchanged screen returns the frame already cached."""
+        frame = Frame(png)
+        with self._lock:
+            cached = self._frames.get(frame.id)
+            if cached is not None:
+                self._frames.move_to_end(frame.id)
+                self.stats["duplicates"] += 1
+                return cached
+            self._frames[frame.id] = frame
+            self.stats["frames"] += 1
+            self._evict()
+        return frame
+
+    def get(self, frame_id: str) -> Optional[Frame]:
+        with self._lock:
+            frame = self._frames.get(frame_id)
+            if frame is not None:
+                self._frames.move_to_end(frame_id)
+            return frame
+
+    def _evict(self):
+        total = sum(f.size for f in self._frames.values())
+        while total > self.max_bytes and len(self._frames) > 1:
+            _, oldest = self._frames.popitem(last=False)
+            total -= oldest.size
+
+    def rendition(self, frame: Frame, fmt: str = "png", width: Optional[int] = None, quality: Optional[int] = None) -> Tuple[bytes, str, Tuple]:
+        """(bytes, media type, key) of the frame encoded as asked; each rendition is encoded once."""
+        key = rendition_key(fmt, width, quality, frame)
+        fmt, width, quality = key
+        if fmt == "png" and width == frame.width:
+            return frame.png, FORMATS["png"], key
+        data = frame.renditions.get(key)
+        if data is not None:
+            self.stats["rendition_hits"] += 1
+            return data, FORMATS[fmt], key
+
+        image = Image.open(io.BytesIO(frame.png))
+        if width != frame.width:
+            image = image.resize((width, max(1, round(frame.height * width / frame.width))), Image.BILINEAR)
+        out = io.BytesIO()
+        if fmt == "jpeg":
+            image.convert("RGB").save(out, "JPEG", quality=quality, optimize=False)
+        elif fmt == "webp":
+            image.save(out, "WEBP", quality=quality, method=2)
+        else:
+            image.save(out, "PNG", compress_level=1)
+        data = out.getvalue()
+        with self._lock:
+            frame.renditions[key] = data
+            self.stats["transcodes"] += 1
+            self._evict()
+        return data, FORMATS[fmt], key
+
+    def data_url(self, frame: Frame, fmt: str = "png", width: Optional[int] = None, quality: Optional[int] = None) -> str:
+        """The rendition as a data: URL for LLM image inputs, base64-encoded once per frame and rendition."""
+        data, media_type, key = self.rendition(frame, fmt, width, quality)
+        encoded = frame.encoded.get(key)
+        if encoded is None:
+            encoded = frame.encoded[key] = base64.b64encode(data).decode("ascii")
+        return f"data:{media_type};base64,{encoded}"
+
+    def llm_data_url(self, frame: Frame) -> str:
+        """A screen for LLM prompts: downscaled JPEG when Pillow is available."""
+        return self.data_url(frame, "jpeg", LLM_WIDTH, LLM_QUALITY)
+
+    def vision_data_url(self, frame: Frame) -> str:
+        """A screen for vision coordinate lookups: device size, so returned points are device pixels."""
+        return self.data_url(frame, "jpeg", None, LLM_QUALITY)
+
+frame_cache = FrameCache()
+
+def current_frame(device: Optional[str] = None, transport=None, max_age: float = 1.0) -> Optional[Frame]:
+    """The device's screen now: a running mirror's frame if recent enough, else a fresh capture."""
+    from mirror import mirror_hub, capture_png
+    frame = mirror_hub.get(device).latest(max_age=max_age) if transport is None else None
+    if frame is not None:
+        return frame
+    png = capture_png(device, transport)
+    return frame_cache.put(png) if png else None
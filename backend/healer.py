@@ -1,6 +1,6 @@
 import difflib
 from typing import Dict, List, Optional, Any
-from intelligence import intelligence
+from intelligence import memory_registry
 
 class AIHealer:
     def __init__(self):
@@ -11,9 +11,10 @@ class AIHealer:
             "APP_CRASH": self._check_app_health
         }
 
-    def analyze_failure(self, run_id: str, action_data: Dict, error_msg: str, screen_snapshot: Dict) -> Dict:
+    def analyze_failure(self, run_id: str, action_data: Dict, error_msg: str, screen_snapshot: Dict, memory=None) -> Dict:
         """
         Main entry point for diagnosing a test failure.
+        memory is the run's partition; looked up from the run id when not given.
         """
         intent = action_data.get("intent", "Unknown Action")
         action_type = action_data.get("type", "unknown")
@@ -23,11 +24,12 @@ class AIHealer:
         suggested_fix = None
 
         # 1. Get Memory Context
+        memory = memory or memory_registry.for_run(run_id)
         ui_hash = screen_snapshot.get("ui_hash", "")
         # Extract query from intent or action_data (assuming simple string for now)
         query = action_data.get("query") or str(action_data.get("intent"))
         
-        expected_element = intelligence.get_element_memory(ui_hash, query)
+        expected_element = memory.get_element_memory(ui_hash, query)
 
         # 2. Check for App Crash (Simple check)
         if "crash" in error_msg.lower() or "exception" in error_msg.lower() and "adb" not in error_msg.lower():
@@ -45,12 +47,12 @@ class AIHealer:
                 healed = True
                 notes = healing_result["notes"]
                 suggested_fix = healing_result["suggested_fix"]
-                intelligence.increment_healed()
+                memory.increment_healed()
             else:
                 reason = "ELEMENT_MISSING"
 
         # Record in memory
-        intelligence.record_failure(
+        memory.record_failure(
             run_id=run_id,
             action_id=action_data.get("action_id", "unknown"),
             reason=reason,
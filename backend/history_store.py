@@ -0,0 +1,399 @@
+import os
+import json
+import zlib
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Any
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    test_name TEXT,
+    mode TEXT,
+    started_at TEXT,
+    completed_at TEXT,
+    status TEXT DEFAULT 'RUNNING',
+    execution_time_ms INTEGER DEFAULT 0,
+    confidence_score REAL DEFAULT 0.0,
+    app_id TEXT,
+    device_model TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_runs_test_name ON runs(test_name, started_at);
+CREATE INDEX IF NOT EXISTS idx_runs_started_at ON runs(started_at);
+
+CREATE TABLE IF NOT EXISTS actions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    action_id TEXT,
+    run_id TEXT,
+    action_type TEXT,
+    intent TEXT,
+    element_id TEXT,
+    status TEXT,
+    execution_time_ms INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_actions_run_id ON actions(run_id);
+
+CREATE TABLE IF NOT EXISTS failures (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    failure_id TEXT,
+    run_id TEXT,
+    action_id TEXT,
+    reason TEXT,
+    healed INTEGER DEFAULT 0,
+    auto_fix_applied INTEGER DEFAULT 0,
+    notes TEXT DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_failures_run_id ON failures(run_id);
+
+-- Running aggregates, updated as actions are recorded and runs finish
+CREATE TABLE IF NOT EXISTS run_counters (
+    run_id TEXT PRIMARY KEY,
+    actions INTEGER DEFAULT 0,
+    successes INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS test_stats (
+    test_name TEXT PRIMARY KEY,
+    runs INTEGER DEFAULT 0,
+    passed INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    total_ms INTEGER DEFAULT 0,
+    max_ms INTEGER DEFAULT 0,
+    last_ms INTEGER DEFAULT 0,
+    histogram TEXT DEFAULT '[]'
+);
+
+-- Timed spans of a run (tracing.Tracer.export), zlib-compressed JSON
+CREATE TABLE IF NOT EXISTS run_spans (
+    run_id TEXT PRIMARY KEY,
+    span_count INTEGER DEFAULT 0,
+    data BLOB
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+RUN_COLUMNS = ["run_id", "test_name", "mode", "started_at", "completed_at", "status", "execution_time_ms", "confidence_score", "app_id", "device_model"]
+ACTION_COLUMNS = ["action_id", "run_id", "action_type", "intent", "element_id", "status", "execution_time_ms"]
+FAILURE_COLUMNS = ["failure_id", "run_id", "action_id", "reason", "healed", "auto_fix_applied", "notes"]
+
+# Upper bounds (ms) of the per-test duration histogram buckets; the last bucket is open-ended
+DURATION_BUCKETS_MS = [5000, 15000, 30000, 60000, 120000, 300000]
+AGGREGATES_VERSION = "aggregates:v1"
+
+class HistoryStore:
+    """
+    SQLite (WAL) store for run history: runs, actions and failures.
+    Each thread gets its own connection so FastAPI's thread pool can share the store.
+    Per-run action counters and per-test duration stats are kept as running aggregates;
+    test stats are lifetime figures and are not reduced when old runs are pruned.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+            # Columns added after the first release of the schema
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(runs)")}
+            for column in ("app_id", "device_model"):
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE runs ADD COLUMN {column} TEXT")
+            if not conn.execute("SELECT 1 FROM meta WHERE key = ?", (AGGREGATES_VERSION,)).fetchone():
+                # Databases created before the aggregate tables existed
+                self._rebuild_aggregates(conn)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _query(self, sql: str, params: tuple = ()) -> List[Dict]:
+        return [dict(row) for row in self._conn().execute(sql, params).fetchall()]
+
+    def _query_one(self, sql: str, params: tuple = ()) -> Optional[Dict]:
+        row = self._conn().execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+    def _insert(self, conn: sqlite3.Connection, table: str, columns: List[str], record: Dict, verb: str = "INSERT"):
+        placeholders = ", ".join("?" for _ in columns)
+        values = tuple(self._to_sql(record.get(c)) for c in columns)
+        conn.execute(f"{verb} INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", values)
+
+    @staticmethod
+    def _to_sql(value: Any) -> Any:
+        if isinstance(value, bool):
+            return int(value)
+        if value is not None and not isinstance(value, (int, float, str)):
+            # datetimes and other values are stored the same way json.dump(default=str) did
+            return str(value)
+        return value
+
+    @staticmethod
+    def _with_bools(record: Optional[Dict]) -> Optional[Dict]:
+        if record:
+            for key in ("healed", "auto_fix_applied"):
+                if key in record:
+                    record[key] = bool(record[key])
+        return record
+
+    # --- Runs ---
+
+    def insert_run(self, run: Dict):
+        with self._conn() as conn:
+            self._insert(conn, "runs", RUN_COLUMNS, run)
+
+    def finish_run(self, run_id: str, status: str, completed_at: str, execution_time_ms: int, confidence_score: float) -> bool:
+        with self._conn() as conn:
+            row = conn.execute("SELECT test_name, status FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+            cur = conn.execute(
+                "UPDATE runs SET status = ?, completed_at = ?, execution_time_ms = ?, confidence_score = ? WHERE run_id = ?",
+                (status, completed_at, execution_time_ms, confidence_score, run_id)
+            )
+            if row and row["status"] == "RUNNING":
+                self._add_test_result(conn, row["test_name"], status, execution_time_ms)
+            return cur.rowcount > 0
+
+    def get_run(self, run_id: str) -> Optional[Dict]:
+        return self._query_one("SELECT * FROM runs WHERE run_id = ?", (run_id,))
+
+    def get_latest_passing_run(self, test_name: str) -> Optional[Dict]:
+        return self._query_one(
+            "SELECT * FROM runs WHERE test_name = ? AND status = 'PASS' ORDER BY started_at DESC LIMIT 1",
+            (test_name,)
+        )
+
+    def get_last_run(self) -> Optional[Dict]:
+        return self._query_one("SELECT * FROM runs ORDER BY started_at DESC LIMIT 1")
+
+    def count_runs(self, test_name: str) -> int:
+        row = self._conn().execute("SELECT COUNT(*) FROM runs WHERE test_name = ?", (test_name,)).fetchone()
+        return row[0]
+
+    def recent_runs(self, limit: int = 50) -> List[Dict]:
+        return self._query("SELECT * FROM runs ORDER BY started_at DESC LIMIT ?", (limit,))
+
+    def delete_run(self, run_id: str) -> bool:
+        with self._conn() as conn:
+            cur = conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM actions WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM failures WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM run_counters WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM run_spans WHERE run_id = ?", (run_id,))
+            return cur.rowcount > 0
+
+    # --- Actions & Failures ---
+
+    def insert_action(self, action: Dict):
+        with self._conn() as conn:
+            self._insert(conn, "actions", ACTION_COLUMNS, action)
+            success = int(action.get("status") == "SUCCESS")
+            conn.execute(
+                "INSERT INTO run_counters (run_id, actions, successes) VALUES (?, 1, ?) "
+                "ON CONFLICT(run_id) DO UPDATE SET actions = actions + 1, successes = successes + excluded.successes",
+                (action.get("run_id"), success)
+            )
+
+    def insert_failure(self, failure: Dict):
+        with self._conn() as conn:
+            self._insert(conn, "failures", FAILURE_COLUMNS, failure)
+
+    def get_run_actions(self, run_id: str) -> List[Dict]:
+        return self._query(
+            f"SELECT {', '.join(ACTION_COLUMNS)} FROM actions WHERE run_id = ? ORDER BY seq", (run_id,)
+        )
+
+    def get_run_failures(self, run_id: str) -> List[Dict]:
+        rows = self._query(
+            f"SELECT {', '.join(FAILURE_COLUMNS)} FROM failures WHERE run_id = ? ORDER BY seq", (run_id,)
+        )
+        return [self._with_bools(r) for r in rows]
+
+    def get_run_action_counts(self, run_id: str) -> Dict[str, int]:
+        row = self._conn().execute(
+            "SELECT actions, successes FROM run_counters WHERE run_id = ?", (run_id,)
+        ).fetchone()
+        return {"total": row[0], "success": row[1]} if row else {"total": 0, "success": 0}
+
+    # --- Spans ---
+
+    def save_spans(self, run_id: str, trace: Dict):
+        data = zlib.compress(json.dumps(trace, separators=(",", ":")).encode())
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO run_spans (run_id, span_count, data) VALUES (?, ?, ?)",
+                (run_id, len(trace.get("spans", [])), data)
+            )
+
+    def get_spans(self, run_id: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT data FROM run_spans WHERE run_id = ?", (run_id,)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    # --- Aggregates ---
+
+    @staticmethod
+    def _bucket(execution_time_ms: int) -> int:
+        for i, bound in enumerate(DURATION_BUCKETS_MS):
+            if execution_time_ms <= bound:
+                return i
+        return len(DURATION_BUCKETS_MS)
+
+    def _add_test_result(self, conn: sqlite3.Connection, test_name: str, status: str, execution_time_ms: int):
+        execution_time_ms = int(execution_time_ms or 0)
+        row = conn.execute("SELECT histogram FROM test_stats WHERE test_name = ?", (test_name,)).fetchone()
+        histogram = json.loads(row["histogram"]) if row else []
+        histogram += [0] * (len(DURATION_BUCKETS_MS) + 1 - len(histogram))
+        histogram[self._bucket(execution_time_ms)] += 1
+        conn.execute(
+            "INSERT INTO test_stats (test_name, runs, passed, failed, total_ms, max_ms, last_ms, histogram) "
+            "VALUES (?, 1, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(test_name) DO UPDATE SET runs = runs + 1, passed = passed + excluded.passed, "
+            "failed = failed + excluded.failed, total_ms = total_ms + excluded.total_ms, "
+            "max_ms = MAX(max_ms, excluded.max_ms), last_ms = excluded.last_ms, histogram = excluded.histogram",
+            (test_name, int(status == "PASS"), int(status == "FAIL"), execution_time_ms,
+             execution_time_ms, execution_time_ms, json.dumps(histogram))
+        )
+
+    def _rebuild_aggregates(self, conn: sqlite3.Connection):
+        """Recompute the running aggregates from the raw tables (after import or schema upgrade)."""
+        conn.execute("DELETE FROM run_counters")
+        conn.execute(
+            "INSERT INTO run_counters (run_id, actions, successes) "
+            "SELECT run_id, COUNT(*), COALESCE(SUM(status = 'SUCCESS'), 0) FROM actions GROUP BY run_id"
+        )
+        conn.execute("DELETE FROM test_stats")
+        finished = conn.execute(
+            "SELECT test_name, status, execution_time_ms FROM runs WHERE status != 'RUNNING' ORDER BY started_at"
+        ).fetchall()
+        for run in finished:
+            self._add_test_result(conn, run["test_name"], run["status"], run["execution_time_ms"])
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (AGGREGATES_VERSION, str(len(finished))))
+
+    def get_test_stats(self, test_name: str) -> Optional[Dict]:
+        stats = self._query_one("SELECT * FROM test_stats WHERE test_name = ?", (test_name,))
+        if stats:
+            stats["histogram"] = json.loads(stats["histogram"])
+            stats["avg_ms"] = stats["total_ms"] // stats["runs"] if stats["runs"] else 0
+            stats["bucket_bounds_ms"] = DURATION_BUCKETS_MS
+        return stats
+
+    def slow_tests(self, threshold_ms: int) -> List[Dict]:
+        """Tests whose most recent run took longer than threshold."""
+        return self._query(
+            "SELECT test_name, runs, last_ms, max_ms, total_ms / runs AS avg_ms FROM test_stats "
+            "WHERE last_ms > ? ORDER BY last_ms DESC",
+            (threshold_ms,)
+        )
+
+    def stats(self, recent: int = 20) -> Dict:
+        """Cross-run statistics computed in SQL."""
+        conn = self._conn()
+        totals = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(status = 'PASS'), 0), COALESCE(SUM(status = 'FAIL'), 0), "
+            "COALESCE(AVG(CASE WHEN status != 'RUNNING' THEN execution_time_ms END), 0) FROM runs"
+        ).fetchone()
+        action_totals = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(status = 'FAIL'), 0) FROM actions"
+        ).fetchone()
+        failure_reasons = self._query(
+            "SELECT reason, COUNT(*) AS count, COALESCE(SUM(healed), 0) AS healed FROM failures GROUP BY reason ORDER BY count DESC"
+        )
+        per_app = self._query(
+            "SELECT COALESCE(app_id, 'default') AS app_id, COUNT(*) AS runs, COALESCE(SUM(status = 'PASS'), 0) AS passed, "
+            "COALESCE(SUM(status = 'FAIL'), 0) AS failed FROM runs GROUP BY COALESCE(app_id, 'default') ORDER BY runs DESC"
+        )
+        per_test = self._query(
+            "SELECT test_name, COUNT(*) AS runs, COALESCE(SUM(status = 'PASS'), 0) AS passed, "
+            "COALESCE(SUM(status = 'FAIL'), 0) AS failed, "
+            "CAST(COALESCE(AVG(CASE WHEN status != 'RUNNING' THEN execution_time_ms END), 0) AS INTEGER) AS avg_execution_time_ms, "
+            "MAX(started_at) AS last_run_at "
+            "FROM runs GROUP BY test_name ORDER BY last_run_at DESC"
+        )
+        return {
+            "total_runs": totals[0],
+            "passed_runs": totals[1],
+            "failed_runs": totals[2],
+            "pass_rate": round(totals[1] / totals[0], 3) if totals[0] else 0.0,
+            "avg_execution_time_ms": int(totals[3]),
+            "total_actions": action_totals[0],
+            "failed_actions": action_totals[1],
+            "failure_reasons": failure_reasons,
+            "apps": per_app,
+            "tests": per_test,
+            "recent_runs": self.recent_runs(recent)
+        }
+
+    # --- Retention ---
+
+    def prune(self, run_ttl_days: float = 0, max_runs: int = 0, max_actions: int = 0) -> Dict[str, int]:
+        """Drop runs older than the TTL or beyond the newest max_runs, then orphaned and excess actions/failures."""
+        removed = {"runs": 0, "actions": 0, "failures": 0}
+        with self._conn() as conn:
+            if run_ttl_days:
+                cutoff = (datetime.now() - timedelta(days=run_ttl_days)).isoformat()
+                removed["runs"] += conn.execute(
+                    "DELETE FROM runs WHERE started_at < ? AND status != 'RUNNING'", (cutoff,)
+                ).rowcount
+            if max_runs:
+                removed["runs"] += conn.execute(
+                    "DELETE FROM runs WHERE run_id NOT IN (SELECT run_id FROM runs ORDER BY started_at DESC LIMIT ?) AND status != 'RUNNING'",
+                    (max_runs,)
+                ).rowcount
+            if removed["runs"]:
+                removed["actions"] += conn.execute(
+                    "DELETE FROM actions WHERE run_id NOT IN (SELECT run_id FROM runs)"
+                ).rowcount
+                removed["failures"] += conn.execute(
+                    "DELETE FROM failures WHERE run_id NOT IN (SELECT run_id FROM runs)"
+                ).rowcount
+                conn.execute("DELETE FROM run_counters WHERE run_id NOT IN (SELECT run_id FROM runs)")
+                conn.execute("DELETE FROM run_spans WHERE run_id NOT IN (SELECT run_id FROM runs)")
+            if max_actions:
+                removed["actions"] += conn.execute(
+                    "DELETE FROM actions WHERE seq <= (SELECT seq FROM actions ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                    (max_actions,)
+                ).rowcount
+        if any(removed.values()):
+            # Give the freed pages back to the WAL file instead of letting it grow
+            self._conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    def counts(self) -> Dict[str, int]:
+        conn = self._conn()
+        return {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("runs", "actions", "failures")
+        }
+
+    def size_bytes(self) -> int:
+        return sum(
+            os.path.getsize(path) for path in (self.db_path, self.db_path + "-wal")
+            if os.path.exists(path)
+        )
+
+    # --- Migration ---
+
+    def import_json_history(self, source: str, runs: List[Dict], actions: List[Dict], failures: List[Dict]) -> bool:
+        """One-time import of the legacy JSON lists. Returns False if this source was already imported."""
+        with self._conn() as conn:
+            key = f"migrated:{source}"
+            if conn.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchone():
+                return False
+            for run in runs:
+                self._insert(conn, "runs", RUN_COLUMNS, run, verb="INSERT OR IGNORE")
+            for action in actions:
+                self._insert(conn, "actions", ACTION_COLUMNS, action)
+            for failure in failures:
+                self._insert(conn, "failures", FAILURE_COLUMNS, failure)
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (key, str(len(runs))))
+            self._rebuild_aggregates(conn)
+        return True
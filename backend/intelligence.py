@@ -1,42 +1,367 @@
 import json
 import os
+import re
 import hashlib
 import time
-from typing import Dict, List, Optional, Any, Literal
-from models import TestRun, ScreenMemory, ElementMemory, ActionHistory, FailureRecord, ConfidenceMetric
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any, Literal, Callable
+from models import TestRun, ScreenMemory, ElementMemory, ActionHistory, FailureRecord, ConfidenceMetric, RetentionPolicy
 from datetime import datetime
+from history_store import HistoryStore
+import metrics
+from similarity import LSHIndex, screen_features, minhash, encode_signature, decode_signature
+
+try:
+    import fcntl
+except ImportError: # Windows: cross-process locking is not available
+    fcntl = None
+
+# Pending screen visit counts are written to disk at most this often
+VISIT_FLUSH_INTERVAL = 5.0
+
+def load_retention_policy() -> RetentionPolicy:
+    """Build the retention policy from RATT_MEMORY_* environment overrides."""
+    overrides = {}
+    for field in RetentionPolicy.__fields__:
+        value = os.getenv(f"RATT_MEMORY_{field.upper()}")
+        if value is not None:
+            overrides[field] = value
+    return RetentionPolicy(**overrides)
+
+# Idle partitions are unloaded after this many seconds without use (0 keeps them loaded)
+PARTITION_IDLE_UNLOAD = float(os.getenv("RATT_MEMORY_IDLE_UNLOAD_S", "600"))
+DEFAULT_PARTITION = "default"
+
+# One learner thread shared by every partition
+_learner = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-learner")
+
+# Elements whose locator succeeds less often than this are reported as flaky
+FLAKY_SUCCESS_RATE = 0.90
+
+# Minimum estimated Jaccard similarity for an unknown screen to reuse a known screen's memory
+SIMILAR_SCREEN_THRESHOLD = float(os.getenv("RATT_SCREEN_SIMILARITY", "0.8"))
+
+# How often a loaded partition checks whether another process rewrote its file
+REMOTE_REFRESH_INTERVAL = 1.0
+
+class FileLock:
+    """Exclusive advisory lock on a sidecar file, shared by threads and processes (uvicorn workers)."""
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = open(self.path, "a+")
+        if fcntl:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._fd.close()
+        self._fd = None
+
+def _merge_memory(ours: Dict, theirs: Dict, deltas: Optional[Dict[tuple, int]] = None, removed: Optional[set] = None):
+    """
+    Fold a copy written by another process into ours. Entries only one side knows are kept.
+    For shared entries, counters are the other copy's value plus what we added and have not
+    written yet (`deltas`, by (kind, screen_id[, element_id])); the most recently updated record wins.
+    Entries we deleted and have not written yet (`removed`, by (section, key[, element_id])) stay deleted.
+    """
+    deltas = deltas or {}
+
+    def add(key: tuple, other: int) -> int:
+        return other + deltas.get(key, 0)
+
+    for screen_id, screen in theirs.get("screens", {}).items():
+        mine = ours["screens"].get(screen_id)
+        if mine is None:
+            ours["screens"][screen_id] = screen
+        else:
+            mine["visit_count"] = add(("visits", screen_id), screen.get("visit_count", 0))
+            for key in ("minhash", "similar_to"):
+                if key in screen and key not in mine:
+                    mine[key] = screen[key]
+            if screen.get("last_seen", 0) > mine.get("last_seen", 0):
+                mine["last_seen"] = screen["last_seen"]
+                mine["last_seen_run"] = screen.get("last_seen_run")
+
+    for screen_id, elements in theirs.get("elements", {}).items():
+        my_elements = ours["elements"].setdefault(screen_id, {})
+        for el_id, el in elements.items():
+            mine = my_elements.get(el_id)
+            if mine is None:
+                my_elements[el_id] = el
+                continue
+            mine["success_count"] = add(("success", screen_id, el_id), el.get("success_count", 0))
+            mine["fail_count"] = add(("fail", screen_id, el_id), el.get("fail_count", 0))
+            total = mine["success_count"] + mine["fail_count"]
+            mine["success_rate"] = mine["success_count"] / total if total > 0 else 1.0
+            mine["last_seen"] = max(mine.get("last_seen", 0), el.get("last_seen", 0))
+
+    for key, entry in theirs.get("step_memory", {}).items():
+        mine = ours["step_memory"].get(key)
+        if mine is None or entry.get("last_updated", 0) > mine.get("last_updated", 0):
+            ours["step_memory"][key] = entry
+
+    for key, trace in theirs.get("traces", {}).items():
+        mine = ours.setdefault("traces", {}).get(key)
+        if mine is None or trace.get("compiled_at", 0) > mine.get("compiled_at", 0):
+            ours["traces"][key] = trace
+
+    ours["globals"] = {**theirs.get("globals", {}), **ours.get("globals", {})}
+    ours["healed_count"] = add(("healed",), theirs.get("healed_count", 0))
+    ours["_version"] = max(ours.get("_version", 0), theirs.get("_version", 0))
+
+    for section, key, *rest in removed or ():
+        if section == "elements":
+            ours["elements"].get(key, {}).pop(rest[0], None)
+        else:
+            ours.get(section, {}).pop(key, None)
+            if section == "screens":
+                ours["elements"].pop(key, None)
 
 class TestMemory:
-    def __init__(self, storage_path: str):
+    """
+    Learned screen/element/step memory for one partition (an app package, optionally per device model).
+    The JSON file is loaded on first use and can be unloaded again when idle.
+    """
+    def __init__(self, storage_path: str, history: Optional[HistoryStore] = None, retention: Optional[RetentionPolicy] = None,
+                 app_id: Optional[str] = None, device_model: Optional[str] = None,
+                 on_change: Optional[Callable[[Dict], None]] = None):
         self.storage_path = storage_path
-        self.raw_data = {
-            "screens": {},
-            "globals": {},
-            "healed_count": 0,
-            "runs": [],
-            "elements": {}, # screen_id -> {element_id -> ElementMemory}
-            "step_memory": {}, # formatted_test_name|step_index -> {bounds, element_id}
-            "actions": [],
-            "failures": []
-        }
-        self._load()
+        self.lock_path = storage_path + ".lock"
+        self.app_id = app_id
+        self.device_model = device_model
+        self.retention = retention or load_retention_policy()
+        # Runs, actions and failures live in SQLite (shared by all partitions); learned memory stays in JSON
+        self.history = history or HistoryStore(os.path.splitext(storage_path)[0] + "_history.db")
+        self._raw_data: Optional[Dict] = None
+        # Secondary index over raw_data, rebuilt on load and kept in sync on mutation
+        self._element_index: Dict[str, Dict[str, Dict]] = {}
+        # Running aggregates over the loaded data, kept current by every mutation
+        self._total_visits = 0
+        self._flaky: set = set() # (screen_id, element_id) below FLAKY_SUCCESS_RATE
+        # Near-duplicate screens: MinHash LSH over known screens, unknown hash -> closest known screen
+        self._lsh = LSHIndex()
+        self._screen_aliases: Dict[str, str] = {} # unknown screen_id -> closest known screen_id
+        # Incremental learning: screens seen this session cost a counter bump, new ones are learned off-thread
+        self._lock = threading.RLock()
+        self._session_screens = set()
+        self._pending_visits: Dict[str, Dict] = {} # screen_id -> {count, last_seen, run_id}
+        self._last_visit_flush = time.time()
+        self._learner = _learner
+        self.last_used = time.monotonic()
+        self.active_runs = 0
+        # Cross-process coordination: last (mtime, size) we read or wrote, and change subscribers
+        self._disk_stat = None
+        self._deltas: Dict[tuple, int] = {} # Counter increments not written to the file yet, for merging
+        self._removed: set = set() # Entries deleted but not written yet, so merging doesn't bring them back
+        self._dirty = False # Changed since the last save; unload and flush skip the write otherwise
+        self._last_refresh_check = time.monotonic()
+        self._subscribers: List[Callable[[Dict], None]] = [on_change] if on_change else []
+
+    @property
+    def raw_data(self) -> Dict:
+        self._ensure_loaded()
+        return self._raw_data
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._raw_data is not None
+
+    def _ensure_loaded(self):
+        now = time.monotonic()
+        self.last_used = now
+        if self._raw_data is not None:
+            if now - self._last_refresh_check >= REMOTE_REFRESH_INTERVAL:
+                self._last_refresh_check = now
+                self._refresh_if_stale()
+            return
+        with self._lock:
+            if self._raw_data is not None:
+                return
+            self._raw_data = {
+                "screens": {},
+                "globals": {},
+                "healed_count": 0,
+                "elements": {}, # screen_id -> {element_id -> ElementMemory}
+                "step_memory": {}, # step_key(selector, screen_id) -> {bounds, bounds_norm, screen_id, next_screen}
+                "traces": {} # trace key -> compiled FAST-mode action trace
+            }
+            self._load()
+            self._migrate_history()
+            self._rebuild_indexes()
+
+    def unload(self):
+        """Persist unsaved changes and drop the in-memory copy; the next access loads it again."""
+        with self._lock:
+            if self._raw_data is None:
+                return
+            self._apply_pending_visits()
+            if self._dirty:
+                self.save()
+            self._raw_data = None
+            self._element_index = {}
+            self._session_screens = set()
+            self._lsh = LSHIndex()
+            self._screen_aliases = {}
 
     def _load(self):
-        if os.path.exists(self.storage_path):
+        data = self._read_disk()
+        if data:
+            # Merge existing data into default structure
+            for k in data:
+                self._raw_data[k] = data[k]
+            # A partition opened by key alone (stats, compaction) takes its app from the file
+            self.app_id = self.app_id or data.get("app_id")
+            self.device_model = self.device_model or data.get("device_model")
+
+    def _disk_state(self):
+        try:
+            st = os.stat(self.storage_path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _read_disk(self) -> Optional[Dict]:
+        state = self._disk_state()
+        if state is None:
+            return None
+        try:
+            # Writers replace the file atomically, so a plain read never sees a partial write
+            with open(self.storage_path, "r") as f:
+                data = json.load(f)
+            self._disk_stat = state
+            return data
+        except Exception as e:
+            print(f"[DEBUG] Error loading memory: {e}")
+            return None
+
+    def _refresh_if_stale(self):
+        """Merge in changes another process saved since we last read or wrote the file."""
+        if self._disk_state() == self._disk_stat:
+            return
+        with self._lock:
+            theirs = self._read_disk()
+            if not theirs or self._raw_data is None:
+                return
+            _merge_memory(self._raw_data, theirs, self._deltas, self._removed)
+            self._rebuild_indexes()
+        self._notify("remote")
+
+    def subscribe(self, callback: Callable[[Dict], None]) -> Callable[[], None]:
+        """Register for change notifications; returns an unsubscribe function."""
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback)
+
+    def _notify(self, source: str):
+        event = {
+            "storage_path": self.storage_path,
+            "app_id": self.app_id,
+            "device_model": self.device_model,
+            "version": (self._raw_data or {}).get("_version", 0),
+            "source": source # "local" save or "remote" process
+        }
+        for callback in list(self._subscribers):
             try:
-                with open(self.storage_path, "r") as f:
-                    data = json.load(f)
-                    # Merge existing data into default structure
-                    for k in data:
-                        self.raw_data[k] = data[k]
+                callback(event)
             except Exception as e:
-                print(f"[DEBUG] Error loading memory: {e}")
+                print(f"[DEBUG] Memory change subscriber failed: {e}")
+
+    def _migrate_history(self):
+        """One-time move of the legacy runs/actions/failures lists from the JSON file into SQLite."""
+        legacy_keys = [k for k in ("runs", "actions", "failures") if k in self._raw_data]
+        if not legacy_keys:
+            return
+        runs = self._raw_data.pop("runs", [])
+        actions = self._raw_data.pop("actions", [])
+        failures = self._raw_data.pop("failures", [])
+        if self.history.import_json_history(self.storage_path, runs, actions, failures):
+            print(f"[DEBUG] Migrated {len(runs)} runs, {len(actions)} actions, {len(failures)} failures to {self.history.db_path}")
+        self.save()
+
+    def _rebuild_indexes(self):
+        self._element_index = {}
+        self._flaky = set()
+        for screen_id, elements in self._raw_data["elements"].items():
+            for el in elements.values():
+                self._index_element(screen_id, el)
+                self._track_flaky(screen_id, el)
+        self._total_visits = sum(s.get("visit_count", 0) for s in self._raw_data["screens"].values())
+        self._lsh = LSHIndex()
+        for screen_id, screen in self._raw_data["screens"].items():
+            if screen.get("minhash"):
+                self._lsh.add(screen_id, decode_signature(screen["minhash"]))
+        screens = self._raw_data["screens"]
+        self._screen_aliases = {
+            screen_id: screen["similar_to"] for screen_id, screen in screens.items()
+            if screen.get("similar_to") in screens
+        }
+
+    def _track_flaky(self, screen_id: str, el: Dict):
+        key = (screen_id, el.get("element_id"))
+        if el.get("success_rate", 1.0) < FLAKY_SUCCESS_RATE:
+            self._flaky.add(key)
+        else:
+            self._flaky.discard(key)
+
+    def _index_element(self, screen_id: str, el: Dict):
+        # First element wins for a given value, matching the old linear scan order
+        index = self._element_index.setdefault(screen_id, {})
+        index.setdefault(el.get("text"), el)
+        index.setdefault(el.get("resource_id"), el)
 
     def save(self):
-        with open(self.storage_path, "w") as f:
-            # We convert Pydantic models to dict if they were stored as such
-            # But here raw_data is mostly dicts for simplicity in internal storage
-            json.dump(self.raw_data, f, indent=2, default=str)
+        """
+        Persist under the cross-process file lock. If another process wrote the file since we
+        last saw it, its changes are merged in first.
+        """
+        with self._lock:
+            if self._raw_data is None:
+                return # Nothing loaded, nothing changed
+            os.makedirs(os.path.dirname(self.storage_path) or ".", exist_ok=True)
+            with metrics.MEMORY_SAVE.time(), FileLock(self.lock_path):
+                if self._disk_state() != self._disk_stat:
+                    theirs = self._read_disk()
+                    if theirs:
+                        _merge_memory(self._raw_data, theirs, self._deltas, self._removed)
+                        self._rebuild_indexes()
+                self._raw_data["_version"] = self._raw_data.get("_version", 0) + 1
+                if self.app_id:
+                    self._raw_data["app_id"] = self.app_id
+                    self._raw_data["device_model"] = self.device_model
+                tmp_path = f"{self.storage_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    # We convert Pydantic models to dict if they were stored as such
+                    # But here raw_data is mostly dicts for simplicity in internal storage
+                    json.dump(self._raw_data, f, indent=2, default=str)
+                os.replace(tmp_path, self.storage_path)
+                self._disk_stat = self._disk_state()
+                self._deltas.clear()
+                self._removed.clear()
+                self._dirty = False
+        self._notify("local")
+
+    def snapshot(self) -> str:
+        """The learned memory as JSON, e.g. so a recorded run can be replayed against the memory it started with."""
+        with self._lock:
+            return json.dumps(self.raw_data, default=str)
+
+    def drain(self):
+        """Block until learning work queued so far has finished."""
+        self._learner.submit(lambda: None).result()
+
+    def flush(self):
+        """Write batched visit counts to disk."""
+        with self._lock:
+            if self._raw_data is not None:
+                self._apply_pending_visits()
+                if self._dirty:
+                    self.save()
 
     def start_run(self, test_name: str, mode: Literal["LEARN", "FAST"]) -> str:
         run_id = hashlib.md5(f"{test_name}|{time.time()}".encode()).hexdigest()[:8]
@@ -48,39 +373,147 @@ class TestMemory:
         )
         run_dict = new_run.dict()
         run_dict["started_at"] = run_dict["started_at"].isoformat()
-        self.raw_data["runs"].append(run_dict)
-        self.save()
+        run_dict["app_id"] = self.app_id
+        run_dict["device_model"] = self.device_model
+        self.history.insert_run(run_dict)
         return run_id
 
     def end_run(self, run_id: str, status: Literal["PASS", "FAIL"], execution_time_ms: int):
-        for run in self.raw_data["runs"]:
-            if run["run_id"] == run_id:
-                run["status"] = status
-                run["completed_at"] = datetime.now().isoformat()
-                run["execution_time_ms"] = execution_time_ms
-                # Simple confidence calculation for now
-                run["confidence_score"] = self.calculate_confidence(run_id)
-                break
-        self.save()
+        with self._lock:
+            self._apply_pending_visits()
+        self._learner.submit(self._compact_if_needed)
+        # Simple confidence calculation for now
+        self.history.finish_run(
+            run_id,
+            status,
+            datetime.now().isoformat(),
+            execution_time_ms,
+            self.calculate_confidence(run_id)
+        )
 
-    def learn_screen(self, screen_hash: str, screenshot_path: str, run_id: str, hierarchy: Dict):
-        if screen_hash not in self.raw_data["screens"]:
-            self.raw_data["screens"][screen_hash] = {
-                "screen_id": screen_hash,
-                "first_seen": time.time(),
-                "visit_count": 0,
-                "screenshot_path": screenshot_path,
-                "ui_hash": screen_hash,
-                "last_seen_run": run_id
-            }
-        
-        self.raw_data["screens"][screen_hash]["visit_count"] += 1
-        self.raw_data["screens"][screen_hash]["last_seen"] = time.time()
-        self.raw_data["screens"][screen_hash]["last_seen_run"] = run_id
-        
-        # Learn all persistent elements from this hierarchy
-        self._learn_elements(screen_hash, hierarchy, run_id)
-        self.save()
+    def get_run(self, run_id: str) -> Optional[Dict]:
+        return self.history.get_run(run_id)
+
+    def get_latest_passing_run(self, test_name: str) -> Optional[Dict]:
+        return self.history.get_latest_passing_run(test_name)
+
+    def count_runs(self, test_name: str) -> int:
+        return self.history.count_runs(test_name)
+
+    def get_run_actions(self, run_id: str) -> List[Dict]:
+        return self.history.get_run_actions(run_id)
+
+    def get_run_failures(self, run_id: str) -> List[Dict]:
+        return self.history.get_run_failures(run_id)
+
+    def save_spans(self, run_id: str, trace: Dict):
+        self.history.save_spans(run_id, trace)
+
+    def get_spans(self, run_id: str) -> Optional[Dict]:
+        return self.history.get_spans(run_id)
+
+    def learn_screen(self, screen_hash: str, screenshot_path: str, run_id: str, hierarchy: Optional[Dict] = None):
+        """
+        Count a visit to a screen and learn it if it is new.
+        Only the first sighting of a screen in this session does real work, and that work
+        (element walk + disk write) runs on the learner thread instead of the caller's.
+        """
+        now = time.time()
+        self.last_used = time.monotonic()
+        with self._lock:
+            pending = self._pending_visits.setdefault(screen_hash, {"count": 0})
+            pending["count"] += 1
+            pending["last_seen"] = now
+            pending["run_id"] = run_id
+
+            is_new = screen_hash not in self._session_screens
+            if is_new:
+                self._session_screens.add(screen_hash)
+            flush_due = now - self._last_visit_flush >= VISIT_FLUSH_INTERVAL
+            if flush_due:
+                self._last_visit_flush = now
+
+        if is_new:
+            self._learner.submit(self._learn_new_screen, screen_hash, screenshot_path, run_id, hierarchy)
+        elif flush_due:
+            self._learner.submit(self.flush)
+
+    def _match_similar_screen(self, screen_hash: str, hierarchy: Optional[Dict]) -> Optional[List[int]]:
+        """
+        Sign a screen we have no MinHash for yet and, if its hash is unknown, alias it to the
+        closest known screen. Runs on the learner thread.
+        """
+        screen = self.raw_data["screens"].get(screen_hash)
+        if not hierarchy or (screen and screen.get("minhash")):
+            return None
+        signature = minhash(screen_features(hierarchy))
+        if not screen:
+            with self._lock:
+                match = self._lsh.query(signature, SIMILAR_SCREEN_THRESHOLD, exclude=screen_hash)
+                if match:
+                    self._screen_aliases[screen_hash] = match[0]
+                    print(f"[DEBUG] Screen {screen_hash} is a near-duplicate of {match[0]} ({match[1]:.2f})")
+        return signature
+
+    def _learn_new_screen(self, screen_hash: str, screenshot_path: str, run_id: str, hierarchy: Optional[Dict]):
+        try:
+            signature = self._match_similar_screen(screen_hash, hierarchy)
+            with self._lock:
+                if signature:
+                    self._lsh.add(screen_hash, signature)
+                if screen_hash not in self.raw_data["screens"]:
+                    self.raw_data["screens"][screen_hash] = {
+                        "screen_id": screen_hash,
+                        "first_seen": time.time(),
+                        "visit_count": 0,
+                        "screenshot_path": screenshot_path,
+                        "ui_hash": screen_hash,
+                        "last_seen_run": run_id
+                    }
+                    # The element ids are derived from the same attributes as the screen hash,
+                    # so a screen learned in an earlier session already has its full element set.
+                    if hierarchy:
+                        self._learn_elements(screen_hash, hierarchy, run_id)
+                screen = self.raw_data["screens"][screen_hash]
+                if signature:
+                    screen["minhash"] = encode_signature(signature)
+                if screen_hash in self._screen_aliases:
+                    screen["similar_to"] = self._screen_aliases[screen_hash]
+                self._apply_pending_visits()
+                self.save()
+        except Exception as e:
+            print(f"[DEBUG] Error learning screen {screen_hash}: {e}")
+
+    def _remove(self, section: str, key: str, element_id: Optional[str] = None):
+        """Delete an entry and note it for merging with other processes' saves. Caller holds the lock."""
+        self._dirty = True
+        if element_id is None:
+            self.raw_data[section].pop(key, None)
+            self._removed.add((section, key))
+        else:
+            self.raw_data[section][key].pop(element_id, None)
+            self._removed.add((section, key, element_id))
+
+    def _count(self, key: tuple, amount: int = 1):
+        """Note a counter increment for merging with other processes' saves. Caller holds the lock."""
+        self._deltas[key] = self._deltas.get(key, 0) + amount
+        self._dirty = True
+
+    def _apply_pending_visits(self) -> bool:
+        """Fold batched visit counts into screen memory. Caller holds the lock."""
+        applied = False
+        for screen_hash, pending in list(self._pending_visits.items()):
+            screen = self.raw_data["screens"].get(screen_hash)
+            if not screen:
+                continue # Still queued for learning
+            screen["visit_count"] = screen.get("visit_count", 0) + pending["count"]
+            self._count(("visits", screen_hash), pending["count"])
+            self._total_visits += pending["count"]
+            screen["last_seen"] = pending["last_seen"]
+            screen["last_seen_run"] = pending["run_id"]
+            del self._pending_visits[screen_hash]
+            applied = True
+        return applied
 
     def _learn_elements(self, screen_id: str, node: Dict, run_id: str):
         """Recursively learn elements from a hierarchy."""
@@ -111,6 +544,7 @@ class TestMemory:
                     "fail_count": 0,
                     "preferred_locator": "resource_id" if rid else "text"
                 }
+                self._index_element(screen_id, self.raw_data["elements"][screen_id][el_id])
             
         for child in node.get("children", []):
             self._learn_elements(screen_id, child, run_id)
@@ -126,8 +560,7 @@ class TestMemory:
             status=status,
             execution_time_ms=duration_ms
         )
-        self.raw_data["actions"].append(action.dict())
-        self.save()
+        self.history.insert_action(action.dict())
         return action_id
 
     def record_failure(self, run_id: str, action_id: str, reason: str, healed: bool = False, notes: str = ""):
@@ -141,11 +574,16 @@ class TestMemory:
             auto_fix_applied=healed,
             notes=notes
         )
-        self.raw_data["failures"].append(failure.dict())
-        self.save()
+        self.history.insert_failure(failure.dict())
     def remember_interaction(self, screen_id: str, query: str, element_node: Dict, success: bool = True):
         """Update element memory with the result of an interaction."""
-        el = self.get_element_memory(screen_id, query)
+        with self._lock:
+            self._remember_interaction(screen_id, query, element_node, success)
+        self.save()
+
+    def _remember_interaction(self, screen_id: str, query: str, element_node: Dict, success: bool):
+        self._ensure_loaded()
+        el, _ = self._lookup_element(screen_id, query)
         if not el:
             # If not learned during screen learn (unlikely but possible), learn it now
             attrs = element_node.get("attributes", {})
@@ -169,32 +607,29 @@ class TestMemory:
                 "preferred_locator": "resource_id" if rid else "text"
             }
             self.raw_data["elements"][screen_id][el_id] = el
+            self._index_element(screen_id, el)
         
         # Update stats
+        el["last_seen"] = time.time()
         if success:
             el["success_count"] = el.get("success_count", 0) + 1
         else:
             el["fail_count"] = el.get("fail_count", 0) + 1
+        self._count(("success" if success else "fail", el["screen_id"], el["element_id"]))
         
         total = el["success_count"] + el["fail_count"]
         el["success_rate"] = el["success_count"] / total if total > 0 else 1.0
-        
-        self.save()
+        self._track_flaky(screen_id, el)
 
     def increment_healed(self):
-        self.raw_data["healed_count"] = self.raw_data.get("healed_count", 0) + 1
+        with self._lock:
+            self.raw_data["healed_count"] = self.raw_data.get("healed_count", 0) + 1
+            self._count(("healed",))
         self.save()
     
     def delete_run(self, run_id: str) -> bool:
         """Delete a test run and all associated data"""
-        # Remove run
-        self.raw_data["runs"] = [r for r in self.raw_data["runs"] if r["run_id"] != run_id]
-        # Remove associated actions
-        self.raw_data["actions"] = [a for a in self.raw_data["actions"] if a["run_id"] != run_id]
-        # Remove associated failures
-        self.raw_data["failures"] = [f for f in self.raw_data["failures"] if f["run_id"] != run_id]
-        self.save()
-        return True
+        return self.history.delete_run(run_id)
 
     def calculate_confidence(self, run_id: str) -> float:
         """
@@ -203,45 +638,393 @@ class TestMemory:
         2. Locator Reliability (Success rate of elements used)
         3. Execution Consistency (Pass rate of actions)
         """
-        run_actions = [a for a in self.raw_data["actions"] if a["run_id"] == run_id]
-        if not run_actions: return 0.0
+        counts = self.history.get_run_action_counts(run_id)
+        if not counts["total"]: return 0.0
         
         # 1. Execution Consistency
-        success_rate = len([a for a in run_actions if a["status"] == "SUCCESS"]) / len(run_actions)
+        success_rate = counts["success"] / counts["total"]
         
         # 2. UI Stability
-        known_screens = len(self.raw_data["screens"])
-        total_visits = sum(s.get("visit_count", 0) for s in self.raw_data["screens"].values())
+        self._ensure_loaded()
+        total_visits = self._total_visits
         stability = min(1.0, total_visits / 100) if total_visits > 0 else 0.5
         
         # 3. Weighted score
         final_score = (success_rate * 0.6) + (stability * 0.4)
         return round(final_score, 2)
 
+    def flaky_elements(self) -> List[Dict]:
+        """Elements currently below FLAKY_SUCCESS_RATE, from the running aggregate."""
+        self._ensure_loaded()
+        with self._lock:
+            elements = self._raw_data["elements"]
+            return [elements[s][e] for s, e in self._flaky if e in elements.get(s, {})]
+
     def get_screen_memory(self, screen_hash: str) -> Optional[Dict]:
         return self.raw_data["screens"].get(screen_hash)
 
     def get_element_memory(self, screen_id: str, query: str) -> Optional[Dict]:
-        """Find an element in memory by text or resource_id."""
-        screen_elements = self.raw_data["elements"].get(screen_id, {})
-        for el_id, el in screen_elements.items():
-            if el.get("text") == query or el.get("resource_id") == query:
-                return el
-        return None
-
-    def save_step_memory(self, test_name: str, step_index: int, bounds: str):
-        """Remember where a step successfully interacted."""
-        key = f"{test_name}|{step_index}"
-        self.raw_data["step_memory"][key] = {
-            "bounds": bounds,
-            "last_updated": time.time()
-        }
+        """
+        Find an element in memory by text or resource_id. Falls back to the closest known
+        screen when this screen is a near-duplicate (e.g. only a price or timer changed);
+        such hits carry "alias_of" and are only candidates until found on the live screen.
+        """
+        self._ensure_loaded()
+        el, alias = self._lookup_element(screen_id, query)
+        (metrics.ELEMENT_MEMORY_MISS if el is None else metrics.ELEMENT_MEMORY_HIT).inc()
+        return {**el, "alias_of": alias} if alias else el
+
+    def _lookup_element(self, screen_id: str, query: str) -> tuple:
+        """(stored element record, near-duplicate screen it came from or None)."""
+        el = self._element_index.get(screen_id, {}).get(query)
+        if el is None and screen_id in self._screen_aliases:
+            alias = self._screen_aliases[screen_id]
+            el = self._element_index.get(alias, {}).get(query)
+            if el is not None:
+                return el, alias
+        return el, None
+
+    def find_similar_screen(self, hierarchy: Dict, exclude: Optional[str] = None) -> Optional[Dict]:
+        """Closest known screen to a snapshot, as {screen_id, similarity}, or None below the threshold."""
+        self._ensure_loaded()
+        signature = minhash(screen_features(hierarchy))
+        with self._lock:
+            match = self._lsh.query(signature, SIMILAR_SCREEN_THRESHOLD, exclude=exclude)
+        return {"screen_id": match[0], "similarity": match[1]} if match else None
+
+    def save_step_memory(self, selector: str, screen_id: Optional[str], bounds: Any, screen_size: Optional[tuple] = None,
+                         test_name: Optional[str] = None, prev_key: Optional[str] = None) -> str:
+        """
+        Remember where a step successfully interacted. Entries are keyed by the step's selector
+        and the screen it acted on, so inserting or reordering steps doesn't invalidate them.
+        prev_key is the previous step's entry; its next_screen is backfilled to chain FAST mode.
+        """
+        key = step_key(selector, screen_id)
+        with self._lock:
+            step_memory = self.raw_data["step_memory"]
+            previous = step_memory.get(key, {})
+            entry = {
+                "selector": selector,
+                "screen_id": screen_id,
+                "bounds": bounds,
+                "next_screen": previous.get("next_screen"),
+                "test_name": test_name,
+                "last_updated": time.time()
+            }
+            rect = _bounds_rect(bounds)
+            if rect and screen_size:
+                width, height = screen_size
+                entry["bounds_norm"] = [round(rect[0] / width, 5), round(rect[1] / height, 5),
+                                        round(rect[2] / width, 5), round(rect[3] / height, 5)]
+                entry["screen_size"] = [width, height]
+            step_memory[key] = entry
+            if prev_key and prev_key != key and prev_key in step_memory:
+                step_memory[prev_key]["next_screen"] = screen_id
+        self.save()
+        return key
+
+    def get_step_memory(self, selector: str, screen_id: Optional[str], screen_size: Optional[tuple] = None) -> Optional[Dict]:
+        """
+        Recall where a step interacted on this screen (or its near-duplicate, marked "alias_of").
+        With screen_size, bounds are rescaled from the normalized rectangle for the current device.
+        """
+        step_memory = self.raw_data.get("step_memory", {})
+        key = step_key(selector, screen_id)
+        entry = step_memory.get(key)
+        alias = None
+        if entry is None and screen_id in self._screen_aliases:
+            alias = self._screen_aliases[screen_id]
+            key = step_key(selector, alias)
+            entry = step_memory.get(key)
+        if entry is None:
+            metrics.STEP_MEMORY_MISS.inc()
+            return None
+        metrics.STEP_MEMORY_HIT.inc()
+        entry = {**entry, "key": key}
+        if alias:
+            entry["alias_of"] = alias
+        if screen_size and entry.get("bounds_norm"):
+            width, height = screen_size
+            left, top, right, bottom = entry["bounds_norm"]
+            entry["bounds"] = {
+                "left": int(left * width), "top": int(top * height),
+                "right": int(right * width), "bottom": int(bottom * height),
+                "width": int((right - left) * width), "height": int((bottom - top) * height)
+            }
+        return entry
+
+    def save_trace(self, key: str, trace: Dict):
+        """Store the compiled action trace of a passing run."""
+        with self._lock:
+            self.raw_data.setdefault("traces", {})[key] = {**trace, "compiled_at": time.time()}
         self.save()
 
-    def get_step_memory(self, test_name: str, step_index: int) -> Optional[Dict]:
-        """Recall where a step interacted previously."""
-        key = f"{test_name}|{step_index}"
-        return self.raw_data.get("step_memory", {}).get(key)
+    def get_trace(self, key: str) -> Optional[Dict]:
+        trace = self.raw_data.get("traces", {}).get(key)
+        (metrics.FAST_TRACE_MISS if trace is None else metrics.FAST_TRACE_HIT).inc()
+        return trace
+
+    def drop_trace(self, key: str):
+        """Invalidate a trace that diverged; the next passing run compiles a fresh one."""
+        with self._lock:
+            if key not in self.raw_data.get("traces", {}):
+                return
+            self._remove("traces", key)
+            self.save()
+
+    # --- Retention ---
+
+    def compact(self, policy: Optional[RetentionPolicy] = None) -> Dict[str, Any]:
+        """
+        Apply the retention policy: expire step memory, evict least recently seen screens
+        (keeping those pinned by step memory) and elements, and prune run history.
+        """
+        policy = policy or self.retention
+        before = self.memory_metrics()
+        now = time.time()
+        evicted = {"step_memory": 0, "traces": 0, "screens": 0, "elements": 0}
+
+        with self._lock:
+            self._apply_pending_visits()
+            step_memory = self.raw_data["step_memory"]
+            if policy.step_memory_ttl_days:
+                cutoff = now - policy.step_memory_ttl_days * 86400
+                for key in [k for k, v in step_memory.items() if v.get("last_updated", 0) < cutoff]:
+                    self._remove("step_memory", key)
+                    evicted["step_memory"] += 1
+            traces = self.raw_data.get("traces", {})
+            if policy.step_memory_ttl_days:
+                for key in [k for k, v in traces.items() if v.get("compiled_at", 0) < cutoff]:
+                    self._remove("traces", key)
+                    evicted["traces"] += 1
+            # Positional "test|index" entries from before step memory was content-addressed
+            for key in [k for k, v in step_memory.items() if "selector" not in v]:
+                self._remove("step_memory", key)
+                evicted["step_memory"] += 1
+
+            screens = self.raw_data["screens"]
+            elements = self.raw_data["elements"]
+            pinned = self._pinned_screens()
+            if policy.max_screens and len(screens) > policy.max_screens:
+                candidates = sorted(
+                    (s for s in screens if s not in pinned),
+                    key=lambda s: screens[s].get("last_seen", screens[s].get("first_seen", 0))
+                )
+                for screen_id in candidates[:len(screens) - policy.max_screens]:
+                    self._remove("screens", screen_id)
+                    elements.pop(screen_id, None)
+                    self._session_screens.discard(screen_id)
+                    evicted["screens"] += 1
+            # Elements whose screen was evicted earlier (or never recorded) are dropped too
+            for screen_id in [s for s in elements if s not in screens]:
+                del elements[screen_id]
+
+            if policy.max_elements_per_screen:
+                for screen_id, screen_elements in elements.items():
+                    excess = len(screen_elements) - policy.max_elements_per_screen
+                    if excess <= 0:
+                        continue
+                    fallback = screens.get(screen_id, {}).get("first_seen", 0)
+                    lru = sorted(screen_elements, key=lambda e: screen_elements[e].get("last_seen", fallback))
+                    for el_id in lru[:excess]:
+                        self._remove("elements", screen_id, el_id)
+                        evicted["elements"] += 1
+
+            self._rebuild_indexes()
+            self.save()
+
+        evicted.update(self.history.prune(policy.run_ttl_days, policy.max_runs, policy.max_actions))
+        return {"evicted": evicted, "before": before, "after": self.memory_metrics()}
+
+    def _compact_if_needed(self):
+        policy = self.retention
+        with self._lock:
+            over_cap = policy.max_screens and len(self.raw_data["screens"]) > policy.max_screens
+        if over_cap:
+            self.compact(policy)
+        else:
+            self.flush()
+            self.save()
+
+    def _pinned_screens(self) -> set:
+        return {m["screen_id"] for m in self.raw_data["step_memory"].values() if m.get("screen_id")}
+
+    def memory_metrics(self) -> Dict[str, Any]:
+        """Sizes of the learned memory and run history."""
+        with self._lock:
+            sizes = {
+                "screens": len(self.raw_data["screens"]),
+                "elements": sum(len(e) for e in self.raw_data["elements"].values()),
+                "step_memory": len(self.raw_data["step_memory"]),
+                "traces": len(self.raw_data.get("traces", {})),
+                "pinned_screens": len(self._pinned_screens()),
+                "signed_screens": len(self._lsh),
+                "screen_aliases": len(self._screen_aliases),
+                "pending_visits": len(self._pending_visits),
+                "memory_file_bytes": os.path.getsize(self.storage_path) if os.path.exists(self.storage_path) else 0,
+                "history_db_bytes": self.history.size_bytes()
+            }
+        sizes.update(self.history.counts())
+        return sizes
+
+def step_key(selector: str, screen_id: Optional[str]) -> str:
+    """Content address of a step: its normalized selector on the screen it acts on."""
+    return hashlib.md5(f"{selector}|{screen_id or ''}".encode()).hexdigest()[:16]
+
+def _bounds_rect(bounds: Any) -> Optional[tuple]:
+    """(left, top, right, bottom) from "[x1,y1][x2,y2]" or a parsed bounds dict."""
+    if isinstance(bounds, dict):
+        return bounds.get("left", 0), bounds.get("top", 0), bounds.get("right", 0), bounds.get("bottom", 0)
+    match = re.search(r"\[(\d+),(\d+)\]\[(\d+),(\d+)\]", str(bounds or ""))
+    return tuple(map(int, match.groups())) if match else None
+
+def _partition_key(app_id: Optional[str], device_model: Optional[str] = None) -> str:
+    key = app_id or DEFAULT_PARTITION
+    if device_model:
+        key = f"{key}__{device_model}"
+    # Keep it a safe file name
+    return re.sub(r"[^A-Za-z0-9._-]", "_", key)
+
+class MemoryRegistry:
+    """
+    Lazily loaded, per-app memory partitions sharing one SQLite run history.
+    The default partition keeps the legacy intelligent_memory.json file; every other
+    partition lives in memory/<app_id>[__<device_model>].json.
+    """
+    def __init__(self, base_dir: str, idle_unload_s: float = PARTITION_IDLE_UNLOAD):
+        self.base_dir = base_dir
+        self.partition_dir = os.path.join(base_dir, "memory")
+        legacy_path = os.path.join(base_dir, "intelligent_memory.json")
+        self.history = HistoryStore(os.path.splitext(legacy_path)[0] + "_history.db")
+        self.retention = load_retention_policy()
+        self.idle_unload_s = idle_unload_s
+        self._lock = threading.Lock()
+        self._partitions: Dict[str, TestMemory] = {}
+        self._subscribers: List[Callable[[Dict], None]] = []
+        self.default = TestMemory(legacy_path, history=self.history, retention=self.retention, on_change=self._dispatch)
+        self._partitions[DEFAULT_PARTITION] = self.default
+        self._sweeper = None
+        atexit.register(self.flush_all)
+
+    def for_app(self, app_id: Optional[str], device_model: Optional[str] = None) -> TestMemory:
+        """Partition for an app package (and optionally device model). Loaded on first access."""
+        key = _partition_key(app_id, device_model)
+        memory = self._partitions.get(key)
+        if memory is None:
+            with self._lock:
+                memory = self._partitions.get(key)
+                if memory is None:
+                    memory = TestMemory(
+                        os.path.join(self.partition_dir, f"{key}.json"),
+                        history=self.history,
+                        retention=self.retention,
+                        app_id=app_id,
+                        device_model=device_model,
+                        on_change=self._dispatch
+                    )
+                    self._partitions[key] = memory
+                    self._start_sweeper()
+        if app_id and memory.app_id is None:
+            # Opened by key (get_partition) before anyone asked for it by app
+            memory.app_id = app_id
+            memory.device_model = device_model
+        return memory
+
+    def for_run(self, run_id: Optional[str]) -> TestMemory:
+        """Partition a run was started in (the default partition for unknown runs)."""
+        run = self.history.get_run(run_id) if run_id else None
+        if not run or not run.get("app_id"):
+            return self.default
+        return self.for_app(run["app_id"], run.get("device_model"))
+
+    def acquire(self, memory: TestMemory) -> TestMemory:
+        """Mark a partition in use by a run so the idle sweeper leaves it loaded."""
+        with self._lock:
+            memory.active_runs += 1
+        return memory
+
+    def release(self, memory: TestMemory):
+        with self._lock:
+            memory.active_runs = max(0, memory.active_runs - 1)
+
+    def partition_keys(self) -> List[str]:
+        keys = set(self._partitions)
+        if os.path.isdir(self.partition_dir):
+            keys.update(os.path.splitext(f)[0] for f in os.listdir(self.partition_dir) if f.endswith(".json"))
+        return sorted(keys)
+
+    def get_partition(self, key: str) -> Optional[TestMemory]:
+        """Partition by key, including ones on disk that have not been opened yet."""
+        memory = self._partitions.get(key)
+        if memory is None and os.path.exists(os.path.join(self.partition_dir, f"{key}.json")):
+            with self._lock:
+                memory = self._partitions.setdefault(key, TestMemory(
+                    os.path.join(self.partition_dir, f"{key}.json"),
+                    history=self.history,
+                    retention=self.retention,
+                    on_change=self._dispatch
+                ))
+        return memory
+
+    def subscribe(self, callback: Callable[[Dict], None]) -> Callable[[], None]:
+        """Change notifications for every partition, including saves by other processes."""
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback)
+
+    def _dispatch(self, event: Dict):
+        for callback in list(self._subscribers):
+            callback(event)
+
+    def unload_idle(self) -> List[str]:
+        if not self.idle_unload_s:
+            return []
+        now = time.monotonic()
+        unloaded = []
+        for key, memory in list(self._partitions.items()):
+            if memory.is_loaded and memory.active_runs == 0 and now - memory.last_used > self.idle_unload_s:
+                memory.unload()
+                unloaded.append(key)
+        return unloaded
+
+    def _start_sweeper(self):
+        if self._sweeper or not self.idle_unload_s:
+            return
+        def sweep():
+            while True:
+                time.sleep(min(60.0, self.idle_unload_s))
+                try:
+                    unloaded = self.unload_idle()
+                    if unloaded:
+                        print(f"[DEBUG] Unloaded idle memory partitions: {unloaded}")
+                except Exception as e:
+                    print(f"[DEBUG] Memory sweeper error: {e}")
+        self._sweeper = threading.Thread(target=sweep, name="memory-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def flush_all(self):
+        for memory in list(self._partitions.values()):
+            memory.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        """Cross-app view: per-partition sizes plus SQL run history."""
+        partitions = {}
+        for key in self.partition_keys():
+            memory = self.get_partition(key)
+            was_loaded = memory.is_loaded
+            data = memory.raw_data
+            partitions[key] = {
+                "app_id": memory.app_id,
+                "device_model": memory.device_model,
+                "loaded": was_loaded,
+                "screens": len(data["screens"]),
+                "elements": sum(len(e) for e in data["elements"].values()),
+                "step_memory": len(data["step_memory"]),
+                "healed_count": data.get("healed_count", 0)
+            }
+            if not was_loaded and memory.active_runs == 0:
+                memory.unload()
+        return {"partitions": partitions, "history": self.history.stats()}
 
-# Global intelligence instance
-intelligence = TestMemory(os.path.join(os.path.dirname(__file__), "intelligent_memory.json"))
+# Global intelligence instances: the registry and its default (legacy) partition
+memory_registry = MemoryRegistry(os.path.dirname(os.path.abspath(__file__)))
+intelligence = memory_registry.default
@@ -0,0 +1,261 @@
+import os
+import time
+import uuid
+import heapq
+import itertools
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+import runner
+from scheduler import connected_devices, device_locks
+
+# Events kept per job for detached readers; older ones are dropped first
+MAX_JOB_EVENTS = 5000
+# Finished jobs kept in memory for GET /jobs/{id}
+MAX_FINISHED_JOBS = 500
+# Seconds between SSE keepalives while a job is quiet
+EVENT_KEEPALIVE = 15.0
+# Seconds between device discoveries while jobs are queued, and between a worker's looks at a busy device
+DEVICE_POLL_INTERVAL = float(os.getenv("RATT_JOB_DEVICE_POLL_S", "5"))
+
+FINISHED_STATUSES = ("PASS", "FAIL", "CANCELLED")
+
+class Job:
+    """A flow or folder run queued for a device. It runs whether or not anyone is listening."""
+
+    def __init__(self, yaml_content: Optional[str] = None, filename: str = "", folder_path: Optional[str] = None,
+                 priority: int = 0, devices: Optional[List[str]] = None, api_key: Optional[str] = None,
+                 base_dir: Optional[str] = None, profile: bool = False):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = "folder" if folder_path else "flow"
+        self.yaml_content = yaml_content
+        self.filename = filename
+        self.folder_path = folder_path
+        self.base_dir = folder_path or base_dir # Where runFlow files are looked up
+        self.priority = priority
+        self.devices = list(devices or []) # Allowed serials; any device when empty
+        self.api_key = api_key or None
+        self.profile = profile # Profile every run of the job
+
+        self.status = "QUEUED"
+        self.device = None
+        self.run_ids: List[str] = []
+        self.results: List[Dict] = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self.events = deque(maxlen=MAX_JOB_EVENTS)
+        self.next_event_id = 0
+
+    def add_event(self, text: str):
+        self.events.append((self.next_event_id, text))
+        self.next_event_id += 1
+
+    def events_since(self, event_id: int):
+        return [(i, text) for i, text in self.events if i >= event_id]
+
+    def summary(self) -> Dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "name": self.filename or (os.path.basename(self.folder_path) if self.folder_path else ""),
+            "priority": self.priority,
+            "devices": self.devices,
+            "status": self.status,
+            "device": self.device,
+            "run_ids": self.run_ids,
+            "results": self.results,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "events": self.next_event_id
+        }
+
+class JobQueue:
+    """
+    Priority queue of run jobs with one worker thread per device. Higher priority first, FIFO
+    within a priority; a worker takes the best job its device is allowed to run, while the device
+    is connected and not held by a direct run or suite (scheduler.device_locks).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock) # Queue changed
+        self._progress = threading.Condition(self._lock) # A job got events or finished
+        self._heap = [] # (-priority, seq, job_id)
+        self._seq = itertools.count()
+        self.jobs: Dict[str, Job] = {}
+        self._workers: Dict[str, threading.Thread] = {}
+        self._connected = set()
+        self._poller: Optional[threading.Thread] = None
+
+    def refresh_devices(self) -> List[str]:
+        """Start workers for newly connected devices. Jobs pinned to an absent device wait for it."""
+        try:
+            serials = connected_devices()
+        except Exception as e:
+            print(f"[DEBUG] Job queue: device discovery failed: {e}")
+            serials = []
+        with self._lock:
+            if set(serials) != self._connected:
+                self._connected = set(serials)
+                self._work.notify_all()
+            for serial in serials:
+                if serial not in self._workers:
+                    worker = threading.Thread(target=self._worker, args=(serial,), name=f"job-worker-{serial}", daemon=True)
+                    self._workers[serial] = worker
+                    worker.start()
+            return list(self._workers)
+
+    def submit(self, job: Job) -> Job:
+        with self._lock:
+            self.jobs[job.id] = job
+            heapq.heappush(self._heap, (-job.priority, next(self._seq), job.id))
+            job.add_event(f"[INFO] Job queued with priority {job.priority}")
+            self._prune()
+            self._work.notify_all()
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll_devices, name="job-device-poller", daemon=True)
+                self._poller.start()
+        self.refresh_devices()
+        return job
+
+    def _poll_devices(self):
+        """Discover devices while jobs wait, so a device attached (or reconnected) later picks them up."""
+        while True:
+            time.sleep(DEVICE_POLL_INTERVAL)
+            with self._lock:
+                waiting = any(job.status == "QUEUED" for job in self.jobs.values())
+            if waiting:
+                self.refresh_devices()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def list_jobs(self, status: Optional[str] = None) -> List[Dict]:
+        with self._lock:
+            jobs = [job for job in self.jobs.values() if not status or job.status == status]
+        return [job.summary() for job in sorted(jobs, key=lambda j: j.created_at, reverse=True)]
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued job. Running jobs finish so the device is not left mid-flow."""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status != "QUEUED":
+                return False
+            job.status = "CANCELLED"
+            job.finished_at = time.time()
+            job.add_event("[INFO] Job cancelled")
+            self._progress.notify_all()
+            return True
+
+    def stream(self, job_id: str, since: int = 0):
+        """SSE events of a job from event id `since`, following it until it finishes."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        cursor = since
+        while True:
+            with self._lock:
+                events = job.events_since(cursor)
+                finished = job.status in FINISHED_STATUSES
+                if not events and not finished:
+                    self._progress.wait(timeout=EVENT_KEEPALIVE)
+                    events = job.events_since(cursor)
+                    finished = job.status in FINISHED_STATUSES
+            for event_id, text in events:
+                yield f"id: {event_id}\ndata: {text}\n\n"
+                cursor = event_id + 1
+            if finished and not events:
+                return
+            if not events:
+                yield ": keepalive\n\n"
+
+    def _prune(self):
+        finished = [job for job in self.jobs.values() if job.status in FINISHED_STATUSES]
+        for job in sorted(finished, key=lambda j: j.finished_at or 0)[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job.id]
+
+    def _take(self, serial: str) -> Job:
+        """The best job for this device, once it is connected and free. The worker then holds the device."""
+        with self._lock:
+            while True:
+                if serial not in self._connected:
+                    self._work.wait()
+                    continue
+                skipped = []
+                job = None
+                while self._heap:
+                    entry = heapq.heappop(self._heap)
+                    candidate = self.jobs.get(entry[2])
+                    if candidate is None or candidate.status != "QUEUED":
+                        continue
+                    skipped.append(entry)
+                    if candidate.devices and serial not in candidate.devices:
+                        continue
+                    job = candidate
+                    break
+                if job and not device_locks.try_acquire(serial, f"job {job.id}"):
+                    job = None # A direct run or suite has the device; the job stays queued
+                for entry in skipped:
+                    if job is None or entry[2] != job.id:
+                        heapq.heappush(self._heap, entry)
+                if job:
+                    job.status = "RUNNING"
+                    job.device = serial
+                    job.started_at = time.time()
+                    return job
+                # Timed, so a device freed by a direct run is noticed without a queue change
+                self._work.wait(timeout=DEVICE_POLL_INTERVAL)
+
+    def _emit(self, job: Job, msg: str):
+        text = msg[len("data: "):] if msg.startswith("data: ") else msg
+        text = text.rstrip("\n")
+        with self._lock:
+            job.add_event(text)
+            self._progress.notify_all()
+        return text
+
+    def _run_flow(self, job: Job, serial: str, yaml_content: str, filename: str) -> bool:
+        passed = False
+        for msg in runner.run_yaml_custom(yaml_content, api_key=job.api_key, filename=filename, device=serial,
+                                          base_dir=job.base_dir, profile=job.profile):
+            text = self._emit(job, msg)
+            if text.startswith("[DONE] EXIT_CODE:"):
+                passed = text.endswith("0")
+            elif text.startswith("[INFO] Run ID:"):
+                # Announced as the run starts, so clients can attach to /runs/{run_id}/events
+                job.run_ids.append(text.split(":", 1)[1].strip())
+        return passed
+
+    def _worker(self, serial: str):
+        while True:
+            job = self._take(serial)
+            print(f"[DEBUG] Job {job.id} started on {serial}")
+            self._emit(job, f"[INFO] Job started on {serial}")
+            passed = False
+            try:
+                if job.kind == "flow":
+                    passed = self._run_flow(job, serial, job.yaml_content, job.filename)
+                    job.results.append({"file": job.filename, "passed": passed})
+                else:
+                    files = sorted(f for f in os.listdir(job.folder_path) if f.endswith('.yaml') or f.endswith('.yml'))
+                    for i, filename in enumerate(files):
+                        self._emit(job, f"[INFO] === Running {filename} ({i + 1}/{len(files)}) ===")
+                        with open(os.path.join(job.folder_path, filename), "r") as f:
+                            content = f.read()
+                        file_passed = self._run_flow(job, serial, content, filename)
+                        job.results.append({"file": filename, "passed": file_passed})
+                    passed = bool(files) and all(r["passed"] for r in job.results)
+            except Exception as e:
+                self._emit(job, f"[ERROR] {e}")
+            device_locks.release(serial, f"job {job.id}")
+            with self._lock:
+                job.status = "PASS" if passed else "FAIL"
+                job.finished_at = time.time()
+                job.add_event(f"[JOB] Finished: {job.status}")
+                self._progress.notify_all()
+            print(f"[DEBUG] Job {job.id} finished on {serial}: {job.status}")
+
+job_queue = JobQueue()
@@ -1,5 +1,5 @@
-from fastapi import FastAPI, HTTPException, Response
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Response, Header
+from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 from typing import List, Optional, Literal, Dict
 import subprocess
@@ -27,12 +27,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Frame-Id"],
 )
 
 class TestRequest(BaseModel):
     yaml_content: str
     apiKey: str = "" # Optional, for AI Vision features
     filename: str = "" # Optional, for better test naming
+    device: str = "" # Optional adb serial; adb's default device when empty
+    profile: bool = False # Sample CPU stacks and allocations for the run (also X-RATT-Profile: 1)
 
 class FileSaveRequest(BaseModel):
     path: str
@@ -76,10 +79,38 @@ def get_packages():
 class RunStepRequest(BaseModel):
     step: dict
 
+def _memory_partition(partition: Optional[str]):
+    from intelligence import memory_registry
+    memory = memory_registry.get_partition(partition or "default")
+    if memory is None:
+        raise HTTPException(status_code=404, detail=f"Unknown memory partition: {partition}")
+    return memory
+
 @app.get("/api/intelligence/stats")
-async def get_intelligence_stats():
-    from intelligence import intelligence
-    return intelligence.raw_data
+def get_intelligence_stats(partition: Optional[str] = None):
+    from intelligence import memory_registry
+    if partition:
+        # Learned screen/element memory of one app plus run history aggregated in SQL
+        memory = _memory_partition(partition)
+        return {**memory.raw_data, "history": memory.history.stats()}
+    # Cross-app view over all partitions
+    return memory_registry.stats()
+
+@app.get("/api/intelligence/metrics")
+def get_intelligence_metrics(partition: Optional[str] = None):
+    from intelligence import memory_registry
+    if partition:
+        return _memory_partition(partition).memory_metrics()
+    return {key: memory_registry.get_partition(key).memory_metrics() for key in memory_registry.partition_keys()}
+
+@app.post("/api/intelligence/compact")
+def compact_intelligence(request: Optional[dict] = None, partition: Optional[str] = None):
+    from intelligence import memory_registry
+    from models import RetentionPolicy
+    # Optional overrides on top of the configured policy, e.g. {"max_screens": 100}
+    policy = RetentionPolicy(**{**memory_registry.retention.dict(), **(request or {})})
+    keys = [partition] if partition else memory_registry.partition_keys()
+    return {key: _memory_partition(key).compact(policy) for key in keys}
 
 @app.post("/memory/screen")
 async def save_screen(request: dict):
@@ -104,6 +135,25 @@ async def analyze_failure(request: dict):
     )
     return analysis
 
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus scrape endpoint: device, hierarchy, cache, step, healing, LLM and memory telemetry."""
+    import metrics
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/runs/{run_id}/events")
+def get_run_events(run_id: str, since: int = 0, last_event_id: Optional[str] = Header(None)):
+    from events import event_hub
+    log = event_hub.get(run_id)
+    if log is None:
+        raise HTTPException(status_code=404, detail="No event log for this run")
+    # EventSource reconnects send Last-Event-ID; plain clients can pass ?since=<last id>
+    try:
+        after = int(last_event_id) if last_event_id else since
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Last-Event-ID must be an event id")
+    return StreamingResponse(log.follow(after), media_type="text/event-stream")
+
 @app.get("/report/{run_id}")
 async def get_run_report(run_id: str):
     from reporter import reporter
@@ -112,11 +162,39 @@ async def get_run_report(run_id: str):
         raise HTTPException(status_code=404, detail=report["error"])
     return report
 
+@app.get("/report/{run_id}/trace")
+def get_run_trace(run_id: str):
+    """The run's spans as Chrome trace-event JSON; open it in chrome://tracing or ui.perfetto.dev."""
+    from intelligence import intelligence
+    import tracing
+    trace = intelligence.get_spans(run_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="No trace for this run")
+    return JSONResponse(tracing.chrome_trace(trace, run_id),
+                        headers={"Content-Disposition": f'attachment; filename="trace-{run_id}.json"'})
+
+@app.get("/report/{run_id}/profile")
+def get_run_profile(run_id: str, format: str = "json"):
+    """The run's profile: top functions and allocation sites, or ?format=collapsed for flame graph tools."""
+    import profiling
+    profile = profiling.load_profile(run_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="No profile for this run; start it with profile: true")
+    if format == "collapsed":
+        return Response(content=profiling.collapsed(profile), media_type="text/plain",
+                        headers={"Content-Disposition": f'attachment; filename="profile-{run_id}.txt"'})
+    if format != "json":
+        raise HTTPException(status_code=400, detail="format must be json or collapsed")
+    stacks = profile.pop("stacks", {})
+    return {**profile, "distinct_stacks": len(stacks), "collapsed": f"/report/{run_id}/profile?format=collapsed"}
+
 @app.delete("/report/{run_id}")
 async def delete_run_report(run_id: str):
     from intelligence import intelligence
     success = intelligence.delete_run(run_id)
     if success:
+        import profiling
+        profiling.delete_profile(run_id)
         return {"status": "success", "message": f"Run {run_id} deleted"}
     else:
         raise HTTPException(status_code=404, detail="Run not found")
@@ -124,107 +202,71 @@ async def delete_run_report(run_id: str):
 @app.post("/validate-yaml")
 def validate_yaml(request: TestRequest):
     """Validate YAML syntax AND Maestro Schema"""
+    from flow_compiler import FlowCompileError, compile_flow, expand_steps
     if not request.yaml_content:
         return {"valid": False, "error": "YAML content is empty"}
     
     try:
-        # Try to parse the YAML
-        docs = list(yaml.safe_load_all(request.yaml_content))
-        
-        # Basic structure validation
-        if len(docs) == 0:
-            return {"valid": False, "error": "YAML file is empty"}
-        
-        # Check if it has the expected structure (header + flow or just flow)
-        header = docs[0] if len(docs) > 0 else {}
-        flow = docs[1] if len(docs) > 1 else (docs[0] if isinstance(docs[0], list) else [])
-        
-        if not isinstance(flow, list):
-            return {"valid": False, "error": "Test flow must be a list of steps (starting with '-')"}
-
-
-        VALID_COMMANDS = {
-            "tapOn", "doubleTapOn", "longPressOn", 
-            "inputText", "eraseText", "inputRandomText", "inputRandomNumber", "inputRandomEmail", "inputRandomPersonName",
-            "assertVisible", "assertNotVisible", "assertTrue",
-            "scroll", "swipe", "scrollUntilVisible", "pressKey", "back", "hideKeyboard", "volumeUp", "volumeDown",
-            "openLink", "stopApp", "clearState", "clearKeychain", "launchApp", "killApp",
-            "runFlow", "extendedWaitUntil", "waitForAnimationToEnd", "waitForAnimation", "wait",
-            "repeat", "webhook", "takeScreenshot",
-            "copyTextFrom", "pasteText",
-            "evalScript", "runScript",
-            "startRecording", "stopRecording",
-            "setLocation", "travel"
-        }
-
-        for i, step in enumerate(flow):
-            if not isinstance(step, dict):
-                continue # Comment string or something
-            
-            for key in step.keys():
-                if key not in VALID_COMMANDS:
-                    return {
-                        "valid": False, 
-                        "error": f"Unknown Command at Step {i+1}: '{key}'. Did you mean 'assertVisible'?",
-                        "line": i + 2 # Approx line estimate (Header takes ~2 lines + i)
-                    }
-        
-        return {"valid": True, "message": f"Valid Maestro Code ({len(flow)} steps)"}
-        
-    except yaml.YAMLError as e:
-        error_msg = str(e)
-        line_num = None
-        col_num = None
-        
-        # Extract line number if available
-        if hasattr(e, 'problem_mark'):
-            mark = e.problem_mark
-            line_num = mark.line + 1
-            col_num = mark.column + 1
-            error_msg = f"YAML Syntax Error at line {line_num}, column {col_num}: {e.problem}"
-        
+        # Compiling validates every step; the result is cached for the run that follows.
+        # Expanding checks runFlow files and cycles.
+        flow = compile_flow(request.yaml_content)
+        steps = expand_steps(flow.steps, base_dir=_flow_dir(request.filename), env=flow.header.get("env"), app_id=flow.app_id)
+        return {"valid": True, "message": f"Valid Maestro Code ({len(steps)} steps)"}
+    except FlowCompileError as e:
         return {
             "valid": False, 
-            "error": error_msg,
-            "line": line_num,
-            "column": col_num
+            "error": str(e),
+            "line": e.line,
+            "column": e.column
         }
     except Exception as e:
         return {"valid": False, "error": f"Validation error: {str(e)}"}
 
-@app.post("/run")
-def run_test(request: TestRequest):
-    if not request.yaml_content:
+def _flow_dir(filename: str) -> str:
+    """Folder runFlow paths of a workspace file are relative to."""
+    return os.path.dirname(get_safe_path(filename)) if filename else WORKSPACE_DIR
+
+def _check_yaml(yaml_content: str, base_dir: Optional[str] = None):
+    from flow_compiler import FlowCompileError, compile_flow, expand_steps
+    if not yaml_content:
          raise HTTPException(status_code=400, detail="YAML content is empty")
     
-    # Validate YAML before running
+    # Validate before running; the compiled flow and its subflows are cached for the run
     try:
-        yaml.safe_load_all(request.yaml_content)
-    except yaml.YAMLError as e:
-        error_msg = str(e)
-        if hasattr(e, 'problem_mark'):
-            mark = e.problem_mark
-            error_msg = f"YAML Syntax Error at line {mark.line + 1}, column {mark.column + 1}: {e.problem}"
-        raise HTTPException(status_code=400, detail=error_msg)
+        flow = compile_flow(yaml_content)
+        expand_steps(flow.steps, base_dir=base_dir, env=flow.header.get("env"), app_id=flow.app_id)
+    except FlowCompileError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _profile_requested(flag: bool, header: Optional[str]) -> bool:
+    return flag or (header or "").strip().lower() in ("1", "true", "yes", "on")
+
+@app.post("/run")
+def run_test(request: TestRequest, x_ratt_profile: Optional[str] = Header(None)):
+    base_dir = _flow_dir(request.filename)
+    _check_yaml(request.yaml_content, base_dir)
 
     return StreamingResponse(
-        runner.run_yaml_custom(request.yaml_content, api_key=request.apiKey, filename=request.filename), 
+        runner.run_yaml_exclusive(request.yaml_content, api_key=request.apiKey, filename=request.filename,
+                                  device=request.device or None, base_dir=base_dir,
+                                  profile=_profile_requested(request.profile, x_ratt_profile)), 
         media_type="text/event-stream"
     )
 
 class RunFolderRequest(BaseModel):
     folder_path: str
+    devices: List[str] = [] # adb serials to shard across; all connected devices when empty
 
 @app.post("/run-folder")
 def run_folder_endpoint(request: RunFolderRequest):
     full_path = get_safe_path(request.folder_path)
-    return StreamingResponse(runner.run_folder_custom(full_path), media_type="text/event-stream")
+    return StreamingResponse(runner.run_folder_custom(full_path, devices=request.devices or None), media_type="text/event-stream")
 
 @app.post("/run-step")
 def run_step(request: RunStepRequest):
     try:
         print(f"Executing step: {request.step}")
-        log = runner.run_test_step(request.step)
+        log = runner.run_test_step(runner.default_context, request.step)
         return {"status": "success", "log": log}
     except Exception as e:
         print(f"Step execution error: {e}")
@@ -245,6 +287,68 @@ def run_goal_endpoint(request: GoalRequest):
         media_type="text/event-stream"
     )
 
+# --- Jobs ---
+
+class JobRequest(BaseModel):
+    yaml_content: str = "" # A single flow...
+    filename: str = ""
+    folder_path: str = "" # ...or a workspace folder run file by file on one device
+    priority: int = 0 # Higher runs first
+    devices: List[str] = [] # adb serials the job may run on; any device when empty
+    apiKey: str = ""
+    profile: bool = False # Profile every run of the job (also X-RATT-Profile: 1)
+
+@app.post("/jobs")
+def submit_job(request: JobRequest, x_ratt_profile: Optional[str] = Header(None)):
+    from jobs import Job, job_queue
+    if bool(request.yaml_content) == bool(request.folder_path):
+        raise HTTPException(status_code=400, detail="Provide either yaml_content or folder_path")
+    if request.folder_path:
+        full_path = get_safe_path(request.folder_path)
+        if not os.path.isdir(full_path):
+            raise HTTPException(status_code=404, detail="Folder not found")
+        job = Job(folder_path=full_path, priority=request.priority, devices=request.devices, api_key=request.apiKey,
+                  profile=_profile_requested(request.profile, x_ratt_profile))
+    else:
+        base_dir = _flow_dir(request.filename)
+        _check_yaml(request.yaml_content, base_dir)
+        job = Job(yaml_content=request.yaml_content, filename=request.filename, priority=request.priority,
+                  devices=request.devices, api_key=request.apiKey, base_dir=base_dir,
+                  profile=_profile_requested(request.profile, x_ratt_profile))
+    return job_queue.submit(job).summary()
+
+@app.get("/jobs")
+def list_jobs(status: Optional[str] = None):
+    from jobs import job_queue
+    job_queue.refresh_devices()
+    return {"jobs": job_queue.list_jobs(status)}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    from jobs import job_queue
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.summary()
+
+@app.get("/jobs/{job_id}/events")
+def get_job_events(job_id: str, since: int = 0):
+    from jobs import job_queue
+    if job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # Reconnect with ?since=<last id + 1> to pick up where the stream dropped
+    return StreamingResponse(job_queue.stream(job_id, since), media_type="text/event-stream")
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    from jobs import job_queue
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not job_queue.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}; only queued jobs can be cancelled")
+    return job.summary()
+
 # --- File System ---
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -378,7 +482,7 @@ def get_hierarchy():
     try:
         # Use the improved hierarchy logic from runner.py
         # This handles native ADB dump + normalization to Maestro format
-        data = runner.get_hierarchy()
+        data = runner.get_hierarchy(runner.default_context)
         if data:
             return {"output": json.dumps(data)}
         return {"output": "{\"children\":[]}", "error": "Failed to fetch hierarchy"}
@@ -421,45 +525,70 @@ def get_device_info():
 
 # --- Screen Mirroring ---
 
-@app.get("/screenshot")
-def get_screenshot():
-    # Capture screenshot via adb and return as image/png
-    
-    # Method 1: exec-out (Fastest)
+def _frame_response(frame, fmt: str, width: Optional[int], quality: Optional[int], if_none_match: Optional[str],
+                    cache_control: str) -> Response:
+    from frames import frame_cache
     try:
-        result = subprocess.run(["adb", "exec-out", "screencap", "-p"], capture_output=True, timeout=3)
-        if result.returncode == 0 and len(result.stdout) > 1000 and result.stdout.startswith(b'\x89PNG'):
-             return Response(content=result.stdout, media_type="image/png")
-    except Exception as e:
-        print(f"[SCREENSHOT] Method 1 failed: {e}")
+        data, media_type, (fmt, width, quality) = frame_cache.rendition(frame, fmt, width, quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # The frame hash plus the rendition: unchanged screens revalidate with a 304 and no body
+    etag = f'"{frame.id}-{fmt}-{width}-{quality}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "X-Frame-Id": frame.id}
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type=media_type, headers=headers)
 
-    # Method 2: shell screencap -p (Direct Stream)
+@app.get("/screenshot")
+def get_screenshot(device: Optional[str] = None, width: Optional[int] = None, format: str = "png",
+                   quality: Optional[int] = None, frame: Optional[str] = None,
+                   if_none_match: Optional[str] = Header(None)):
+    """
+    The device screen, optionally downscaled to `width` and re-encoded as jpeg or webp (needs Pillow).
+    ?frame=<id> serves a cached frame (the X-Frame-Id of an earlier response), which never changes.
+    """
+    from frames import frame_cache, current_frame
+    if frame:
+        cached = frame_cache.get(frame)
+        if cached is None:
+            raise HTTPException(status_code=404, detail="Frame no longer cached")
+        return _frame_response(cached, format, width, quality, if_none_match, "private, max-age=3600, immutable")
+    current = current_frame(device or None)
+    if current is None:
+        raise HTTPException(status_code=503, detail="Screenshot failed with all methods")
+    return _frame_response(current, format, width, quality, if_none_match, "no-cache")
+
+@app.get("/screenshot/frame")
+def capture_frame(device: Optional[str] = None):
+    """Capture the screen into the frame cache; pass the id to /api/ai/generate instead of the image."""
+    from frames import current_frame
+    current = current_frame(device or None)
+    if current is None:
+        raise HTTPException(status_code=503, detail="Screenshot failed with all methods")
+    return current.info()
+
+@app.get("/mirror/stream")
+def mirror_stream(device: Optional[str] = None, width: Optional[int] = None, format: str = "png", quality: Optional[int] = None):
+    """Live screen as multipart/x-mixed-replace frames; viewers of a device share one capture loop."""
+    from mirror import mirror_hub, MEDIA_TYPE
+    from frames import rendition_key
     try:
-        shell_res = subprocess.run(["adb", "shell", "screencap", "-p"], capture_output=True, timeout=5)
-        if shell_res.returncode == 0 and len(shell_res.stdout) > 1000 and shell_res.stdout.startswith(b'\x89PNG'):
-             return Response(content=shell_res.stdout, media_type="image/png")
-    except Exception as e:
-        print(f"[SCREENSHOT] Method 2 failed: {e}")
+        rendition_key(format, width, quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(mirror_hub.get(device or None).stream(format, width, quality), media_type=MEDIA_TYPE,
+                             headers={"Cache-Control": "no-store"})
 
-    # Method 3: File-based Fallback (Most robust)
-    try:
-        print("[SCREENSHOT] Using file-based fallback...")
-        subprocess.run(["adb", "shell", "screencap", "-p", "/data/local/tmp/ratl_screen.png"], check=True, timeout=7)
-        cat_res = subprocess.run(["adb", "exec-out", "cat", "/data/local/tmp/ratl_screen.png"], capture_output=True, timeout=5)
-        
-        if cat_res.returncode == 0 and len(cat_res.stdout) > 100:
-             return Response(content=cat_res.stdout, media_type="image/png")
-    except Exception as e:
-        print(f"[SCREENSHOT] Method 3 failed: {e}")
-            
-    # If all failed
-    raise HTTPException(status_code=503, detail="Screenshot failed with all methods")
-            
+@app.get("/mirror/status")
+def mirror_status():
+    from mirror import mirror_hub
+    return {"mirrors": mirror_hub.status()}
 
 # --- AI Generation ---
 
 class AIRequest(BaseModel):
-    screenshot: str # Base64 encoded image
+    screenshot: str = "" # Base64 encoded PNG...
+    frame: str = "" # ...or the id of a cached frame (/screenshot/frame), sent to the model downscaled
     hierarchy: str
     context: str = ""
     apiKey: str = "" # Optional
@@ -475,6 +604,17 @@ def generate_step_ai(request: AIRequest):
             "error": "Missing API Key. Please provide OPENAI_API_KEY in environment or settings."
         }
     
+    if request.frame:
+        from frames import frame_cache
+        frame = frame_cache.get(request.frame)
+        if frame is None:
+            return {"success": False, "error": "Screenshot frame expired. Capture the screen again."}
+        image_url = frame_cache.llm_data_url(frame)
+    elif request.screenshot:
+        image_url = f"data:image/png;base64,{request.screenshot}"
+    else:
+        return {"success": False, "error": "Provide a screenshot or frame."}
+
     # 2. Call LLM (OpenAI)
     try:
         headers = {
@@ -505,7 +645,7 @@ def generate_step_ai(request: AIRequest):
         
         user_content = [
              {"type": "text", "text": f"TASK: {base_instruction}\nContext: {request.context}\nHierarchy Info (Truncated): {request.hierarchy[:15000]}"},
-             {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{request.screenshot}"}}
+             {"type": "image_url", "image_url": {"url": image_url}}
         ]
         
         payload = {
@@ -0,0 +1,226 @@
+import time
+import bisect
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Prometheus text exposition format served by GET /metrics
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Label sets per metric beyond which new ones are folded into "other", so a stray label can't grow memory
+MAX_SERIES = 500
+# Seconds; device commands and dumps are tens of ms to seconds, LLM calls seconds to tens of seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class _Metric(ABC):
+    """
+    A metric family. labels() returns the child for a label set; keep the children of fixed label
+    sets in module constants, so the hot path is a plain attribute update. Updates are not locked:
+    the GIL keeps them consistent enough for telemetry, and only creating a child takes the lock.
+    """
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}, got {key}")
+            with self._lock:
+                if len(self._children) >= MAX_SERIES and key not in self._children:
+                    key = ("other",) * len(self.labelnames)
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """A fresh child for a new label set."""
+
+    @abstractmethod
+    def _render_child(self, key: Tuple[str, ...], child) -> List[str]:
+        """Exposition lines of one child."""
+
+    def _label_text(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock: # labels() may add children from worker threads while a scrape renders
+            children = list(self._children.items())
+        for key, child in sorted(children):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{self._label_text(key)} {_number(child.value)}"]
+
+class Gauge(Counter):
+    type = "gauge"
+
+class _Observations:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _Observations(self.buckets)
+
+    def _render_child(self, key, child):
+        lines = []
+        counts = list(child.counts) # Copy first, so the buckets and count agree even while observing
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = 'le="%s"' % _number(bound)
+            lines.append(f"{self.name}_bucket{self._label_text(key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(key)} {_number(child.sum)}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# --- Runner metrics ---
+
+ADB_SECONDS = registry.register(Histogram(
+    "ratt_adb_command_seconds", "adb command latency by command type", ["command"]))
+HIERARCHY_SECONDS = registry.register(Histogram(
+    "ratt_hierarchy_capture_seconds", "UI hierarchy capture latency by provider", ["provider"]))
+CACHE_LOOKUPS = registry.register(Counter(
+    "ratt_cache_lookups_total", "Lookups of the snapshot cache, element and step memory and FAST traces", ["cache", "result"]))
+FAST_TRACE_DIVERGENCES = registry.register(Counter(
+    "ratt_fast_trace_divergences_total", "FAST trace replays that fell back to the resolver"))
+STEP_SECONDS = registry.register(Histogram(
+    "ratt_step_seconds", "Flow step duration by command and status", ["command", "status"]))
+HEALS = registry.register(Counter(
+    "ratt_heals_total", "Steps recovered by self-healing, by method", ["method"]))
+HEAL_ANALYSIS_SECONDS = registry.register(Histogram(
+    "ratt_heal_analysis_seconds", "Healer failure analysis latency"))
+LLM_SECONDS = registry.register(Histogram(
+    "ratt_llm_request_seconds", "LLM request latency", ["kind", "model"]))
+LLM_REQUESTS = registry.register(Counter(
+    "ratt_llm_requests_total", "LLM requests by outcome", ["kind", "model", "status"]))
+MEMORY_SAVE_SECONDS = registry.register(Histogram(
+    "ratt_memory_save_seconds", "Test memory save latency (lock, merge and write)"))
+ACTIVE_RUNS = registry.register(Gauge(
+    "ratt_active_runs", "Runs in progress by device", ["device"]))
+RUNS = registry.register(Counter(
+    "ratt_runs_total", "Finished runs by status", ["status"]))
+
+# Children of fixed label sets, bound once for the hot path
+HIERARCHY_BY_PROVIDER = {p: HIERARCHY_SECONDS.labels(p) for p in ("uiautomator", "maestro")}
+SNAPSHOT_HIT = CACHE_LOOKUPS.labels("snapshot", "hit")
+SNAPSHOT_MISS = CACHE_LOOKUPS.labels("snapshot", "miss")
+ELEMENT_MEMORY_HIT = CACHE_LOOKUPS.labels("element_memory", "hit")
+ELEMENT_MEMORY_MISS = CACHE_LOOKUPS.labels("element_memory", "miss")
+STEP_MEMORY_HIT = CACHE_LOOKUPS.labels("step_memory", "hit")
+STEP_MEMORY_MISS = CACHE_LOOKUPS.labels("step_memory", "miss")
+FAST_TRACE_HIT = CACHE_LOOKUPS.labels("fast_trace", "hit")
+FAST_TRACE_MISS = CACHE_LOOKUPS.labels("fast_trace", "miss")
+FAST_TRACE_DIVERGED = FAST_TRACE_DIVERGENCES.labels()
+HEALS_FUZZY = HEALS.labels("fuzzy")
+HEALS_SEMANTIC = HEALS.labels("semantic")
+HEALS_HEALER = HEALS.labels("healer")
+HEAL_ANALYSIS = HEAL_ANALYSIS_SECONDS.labels()
+MEMORY_SAVE = MEMORY_SAVE_SECONDS.labels()
+_adb_children: Dict[str, _Observations] = {}
+
+def adb_command(command: str) -> _Observations:
+    """The latency child of an adb command line, by its first two words ("shell input", "exec-out screencap")."""
+    child = _adb_children.get(command)
+    if child is None:
+        child = ADB_SECONDS.labels(" ".join(command.split()[:2]))
+        if len(_adb_children) < MAX_SERIES * 4:
+            _adb_children[command] = child
+    return child
+
+def device_label(device: Optional[str]) -> str:
+    return device or "default"
+
+@contextmanager
+def llm_call(kind: str, model: str):
+    """Time an LLM request. The block sets call["ok"] = False for an error response; raising counts as an error too."""
+    call = {"ok": True}
+    start = time.perf_counter()
+    try:
+        yield call
+    except Exception:
+        call["ok"] = False
+        raise
+    finally:
+        LLM_SECONDS.labels(kind, model).observe(time.perf_counter() - start)
+        LLM_REQUESTS.labels(kind, model, "ok" if call["ok"] else "error").inc()
@@ -0,0 +1,161 @@
+import os
+import time
+import threading
+from typing import Dict, List, Optional
+import adb_transport
+from frames import Frame, frame_cache
+
+# Fastest a device is captured, however many viewers it has
+MIN_FRAME_INTERVAL = 1 / float(os.getenv("RATT_MIRROR_MAX_FPS", "5"))
+# Seconds the capture loop keeps running after its last viewer left, so a page reload doesn't restart it
+IDLE_GRACE = float(os.getenv("RATT_MIRROR_IDLE_GRACE", "5"))
+# A viewer is re-sent the current frame after this many seconds without a new one, so dead connections are noticed
+KEEPALIVE = 10.0
+# Back-off after a failed capture (device busy, unplugged)
+ERROR_BACKOFF = 1.0
+BOUNDARY = "frame"
+MEDIA_TYPE = f"multipart/x-mixed-replace; boundary={BOUNDARY}"
+
+def capture_png(device: Optional[str] = None, transport=None) -> Optional[bytes]:
+    """One PNG of the device screen, trying exec-out, then shell, then a file on the device."""
+    transport = transport or adb_transport.transport
+    adb = ["adb"] + (["-s", device] if device else [])
+
+    # Method 1: exec-out (Fastest)
+    try:
+        result = transport.run(adb + ["exec-out", "screencap", "-p"], capture_output=True, text=False, timeout=3)
+        if result.returncode == 0 and len(result.stdout) > 1000 and result.stdout.startswith(b'\x89PNG'):
+            return result.stdout
+    except Exception as e:
+        print(f"[SCREENSHOT] Method 1 failed: {e}")
+
+    # Method 2: shell screencap -p (Direct Stream)
+    try:
+        result = transport.run(adb + ["shell", "screencap", "-p"], capture_output=True, text=False, timeout=5)
+        if result.returncode == 0 and len(result.stdout) > 1000 and result.stdout.startswith(b'\x89PNG'):
+            return result.stdout
+    except Exception as e:
+        print(f"[SCREENSHOT] Method 2 failed: {e}")
+
+    # Method 3: File-based Fallback (Most robust)
+    try:
+        print("[SCREENSHOT] Using file-based fallback...")
+        transport.run(adb + ["shell", "screencap", "-p", "/data/local/tmp/ratl_screen.png"], capture_output=True, text=False, timeout=7)
+        result = transport.run(adb + ["exec-out", "cat", "/data/local/tmp/ratl_screen.png"], capture_output=True, text=False, timeout=5)
+        if result.returncode == 0 and len(result.stdout) > 100:
+            return result.stdout
+    except Exception as e:
+        print(f"[SCREENSHOT] Method 3 failed: {e}")
+    return None
+
+class DeviceMirror:
+    """
+    One capture loop per device, shared by every viewer. Frames identical to the previous one are
+    dropped, so viewers only receive (and the network only carries) frames that changed. Frames go
+    through the frame cache, so viewers asking for the same rendition share one encode per frame.
+    """
+
+    def __init__(self, device: Optional[str] = None, capture=None):
+        self.device = device
+        self.capture = capture or (lambda: capture_png(device))
+        self.frame: Optional[Frame] = None
+        self.frame_id = 0 # Increments on every changed frame
+        self.frame_time = 0.0
+        self.viewers = 0
+        self.stats = {"captures": 0, "unchanged": 0, "failures": 0, "frames": 0}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._last_viewer_left = 0.0
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if not self.viewers and time.time() - self._last_viewer_left > IDLE_GRACE:
+                    self._thread = None
+                    return
+            started = time.time()
+            png = self.capture()
+            frame = frame_cache.put(png) if png is not None else None
+            with self._cond:
+                self.stats["captures"] += 1
+                if frame is None:
+                    self.stats["failures"] += 1
+                else:
+                    if self.frame is not None and frame.id == self.frame.id:
+                        self.stats["unchanged"] += 1
+                    else:
+                        self.frame = frame
+                        self.frame_id += 1
+                        self.stats["frames"] += 1
+                        self._cond.notify_all()
+                    self.frame_time = time.time()
+            delay = ERROR_BACKOFF if png is None else MIN_FRAME_INTERVAL - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _join(self):
+        with self._cond:
+            self.viewers += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=f"mirror-{self.device or 'default'}", daemon=True)
+                self._thread.start()
+
+    def _leave(self):
+        with self._cond:
+            self.viewers -= 1
+            self._last_viewer_left = time.time()
+
+    def latest(self, max_age: float) -> Optional[Frame]:
+        """The current frame if the loop captured the screen within max_age seconds."""
+        with self._cond:
+            if self.frame is not None and self._thread is not None and time.time() - self.frame_time <= max_age:
+                return self.frame
+        return None
+
+    def stream(self, fmt: str = "png", width: Optional[int] = None, quality: Optional[int] = None):
+        """multipart/x-mixed-replace parts: the current frame, then each changed frame, encoded as asked."""
+        self._join()
+        try:
+            sent = 0
+            while True:
+                with self._cond:
+                    if self.frame_id == sent:
+                        self._cond.wait(timeout=KEEPALIVE)
+                    frame, sent = self.frame, self.frame_id
+                if frame is None:
+                    continue
+                data, media_type, _ = frame_cache.rendition(frame, fmt, width, quality)
+                yield (f"--{BOUNDARY}\r\nContent-Type: {media_type}\r\nContent-Length: {len(data)}\r\n\r\n").encode() + data + b"\r\n"
+        finally:
+            self._leave()
+
+    def status(self) -> Dict:
+        return {
+            "device": self.device,
+            "viewers": self.viewers,
+            "running": self._thread is not None,
+            "frame": self.frame.info() if self.frame else None,
+            "frame_age_s": round(time.time() - self.frame_time, 2) if self.frame_time else None,
+            **self.stats
+        }
+
+class MirrorHub:
+    """Mirrors by device serial."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mirrors: Dict[Optional[str], DeviceMirror] = {}
+
+    def get(self, device: Optional[str] = None) -> DeviceMirror:
+        with self._lock:
+            mirror = self._mirrors.get(device)
+            if mirror is None:
+                mirror = self._mirrors[device] = DeviceMirror(device)
+            return mirror
+
+    def status(self) -> List[Dict]:
+        with self._lock:
+            mirrors = list(self._mirrors.values())
+        return [m.status() for m in mirrors]
+
+mirror_hub = MirrorHub()
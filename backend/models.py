@@ -63,3 +63,12 @@ class ConfidenceMetric(BaseModel):
     locator_reliability: float
     execution_consistency: float
     final_score: float
+
+class RetentionPolicy(BaseModel):
+    """Size caps for the intelligence memory. A value of 0 disables that limit."""
+    max_screens: int = 500               # LRU by last_seen; screens referenced by step memory are pinned
+    max_elements_per_screen: int = 200   # LRU by last_seen within a screen
+    step_memory_ttl_days: float = 60
+    run_ttl_days: float = 90             # Actions/failures are removed with their run
+    max_runs: int = 5000
+    max_actions: int = 100000
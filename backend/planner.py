@@ -26,8 +26,7 @@ If UI changes are detected, reduce reuse and increase validation.
         """
         
         # Mode decision logic
-        recent_runs = intelligence.raw_data.get("runs", [])
-        last_run = recent_runs[-1] if recent_runs else None
+        last_run = intelligence.history.get_last_run()
         
         mode = "LEARN"
         if last_run and last_run.get("status") == "PASS" and last_run.get("confidence_score", 0) > 0.9:
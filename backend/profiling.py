@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+PROFILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory", "profiles")
+# Milliseconds between stack samples of a profiled run
+SAMPLE_INTERVAL_MS = float(os.getenv("RATT_PROFILE_INTERVAL_MS", "10"))
+MAX_STACK_DEPTH = 64
+# Frames stored per allocation site and sites reported
+TRACEMALLOC_FRAMES = 8
+TOP_ALLOCATIONS = 25
+TOP_FUNCTIONS = 40
+
+# tracemalloc is process-wide: it runs while any profiled run does
+_tracemalloc_users = 0
+_tracemalloc_lock = threading.Lock()
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        _tracemalloc_users += 1
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+class RunProfiler:
+    """
+    Statistical profile of one run: a sampler thread records the stacks of the threads currently
+    executing the run (the server may move a run between worker threads, so they attach and detach
+    around each step of its stream), plus tracemalloc snapshots at the start and end of the run.
+    Samples are wall-clock, so waits show up under the frame that waited (tracing.sleep, transport).
+    """
+
+    def __init__(self, run_id: str, interval_ms: float = SAMPLE_INTERVAL_MS):
+        self.run_id = run_id
+        self.interval = interval_ms / 1000
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._threads: Dict[int, int] = {} # thread id -> attach depth
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, name=f"profiler-{run_id}", daemon=True)
+        self.started = time.time()
+        self.finished = None
+        _start_tracemalloc()
+        self._snapshot_start = tracemalloc.take_snapshot()
+        self._snapshot_end = None
+        self._peak_bytes = 0
+        self._sampler.start()
+
+    @contextmanager
+    def attached(self):
+        """Sample the calling thread while the block runs."""
+        ident = threading.get_ident()
+        self._threads[ident] = self._threads.get(ident, 0) + 1
+        try:
+            yield
+        finally:
+            depth = self._threads.pop(ident, 1) - 1
+            if depth:
+                self._threads[ident] = depth
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            idents = list(self._threads)
+            if not idents:
+                continue
+            frames = sys._current_frames()
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                names = []
+                while frame is not None and len(names) < MAX_STACK_DEPTH:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+                self.samples += 1
+            del frames
+            _, peak = tracemalloc.get_traced_memory()
+            self._peak_bytes = max(self._peak_bytes, peak)
+
+    def stop(self):
+        if self.finished is not None:
+            return
+        self._stop.set()
+        self._sampler.join()
+        self._snapshot_end = tracemalloc.take_snapshot()
+        _stop_tracemalloc()
+        self.finished = time.time()
+
+    def _top_functions(self) -> List[Dict]:
+        """Samples per function: self (on top of the stack) and total (anywhere in it, once per sample)."""
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            names = stack.split(";")
+            own[names[-1]] += count
+            for name in set(names):
+                total[name] += count
+        return [
+            {"function": name, "self_samples": own[name], "total_samples": count,
+             "self_pct": round(own[name] / self.samples * 100, 1) if self.samples else 0.0}
+            for name, count in sorted(total.items(), key=lambda kv: (-own[kv[0]], -kv[1]))[:TOP_FUNCTIONS]
+        ]
+
+    def _top_allocations(self) -> List[Dict]:
+        """Allocation sites that grew most during the run (process-wide, so concurrent runs count too)."""
+        if self._snapshot_end is None:
+            return []
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+        diff = self._snapshot_end.filter_traces(ignore).compare_to(self._snapshot_start.filter_traces(ignore), "traceback")
+        return [
+            {"site": f"{os.path.basename(stat.traceback[-1].filename)}:{stat.traceback[-1].lineno}",
+             "traceback": [f"{os.path.basename(f.filename)}:{f.lineno}" for f in stat.traceback],
+             "size_diff_kb": round(stat.size_diff / 1024, 1), "size_kb": round(stat.size / 1024, 1),
+             "count_diff": stat.count_diff}
+            for stat in diff[:TOP_ALLOCATIONS]
+        ]
+
+    def report(self) -> Dict:
+        return {
+            "run_id": self.run_id,
+            "started_at": self.started,
+            "duration_s": round((self.finished or time.time()) - self.started, 3),
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "top_functions": self._top_functions(),
+            "allocations": {"peak_traced_bytes": self._peak_bytes, "top": self._top_allocations()},
+            "stacks": dict(self.stacks.most_common())
+        }
+
+    def save(self) -> str:
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        path = profile_path(self.run_id)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.report(), f)
+        os.replace(tmp, path)
+        return path
+
+@contextmanager
+def attached(profiler: Optional[RunProfiler]):
+    """profiler.attached(), or nothing for runs that aren't profiled."""
+    if profiler is None:
+        yield
+    else:
+        with profiler.attached():
+            yield
+
+def profile_path(run_id: str) -> str:
+    return os.path.join(PROFILES_DIR, f"{os.path.basename(run_id)}.json")
+
+def load_profile(run_id: str) -> Optional[Dict]:
+    path = profile_path(run_id)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def delete_profile(run_id: str):
+    path = profile_path(run_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+def collapsed(profile: Dict) -> str:
+    """Collapsed stacks ("frame;frame;frame count" lines) for flamegraph.pl, speedscope and the like."""
+    return "".join(f"{stack} {count}\n" for stack, count in profile.get("stacks", {}).items())
@@ -0,0 +1,112 @@
+import json
+import os
+import re
+import sys
+import copy
+import tempfile
+import xml.etree.ElementTree as ET
+from history_store import HistoryStore
+from intelligence import TestMemory
+from runner import parse_xml_node, get_screen_hash
+
+# Usage: python recall_report.py [dump.xml ...]
+# Learns each recorded uiautomator dump, then replays drifted copies of it (changed numbers,
+# a removed list item, an edited label) and reports element recall by exact screen hash
+# (before) versus with near-duplicate screen matching (after).
+
+here = os.path.dirname(os.path.abspath(__file__))
+dumps = sys.argv[1:] or [
+    path for path in (
+        os.path.join(here, "uidump.xml"),
+        os.path.join(here, "uidump_live.xml"),
+        os.path.join(here, "..", "window_dump.xml")
+    ) if os.path.exists(path)
+]
+
+def load_dump(path):
+    with open(path, "r") as f:
+        xml_data = f.read()
+    return parse_xml_node(ET.fromstring(xml_data[xml_data.find("<hierarchy"):]))
+
+def nodes(node):
+    yield node
+    for child in node.get("children", []):
+        yield from nodes(child)
+
+def queries(hierarchy):
+    found = set()
+    for node in nodes(hierarchy):
+        attrs = node.get("attributes", {})
+        found.update(q for q in (attrs.get("text"), attrs.get("resource-id")) if q)
+    return found
+
+def drift_numbers(hierarchy):
+    drifted = copy.deepcopy(hierarchy)
+    for node in nodes(drifted):
+        attrs = node.get("attributes", {})
+        if re.search(r"\d", attrs.get("text") or ""):
+            attrs["text"] = re.sub(r"\d+", lambda m: str(int(m.group()) + 7), attrs["text"])
+    return drifted
+
+def drop_item(hierarchy):
+    drifted = drift_numbers(hierarchy)
+    for node in reversed(list(nodes(drifted))):
+        leaves = [c for c in node.get("children", []) if c.get("attributes", {}).get("text") and not c.get("children")]
+        if leaves:
+            node["children"].remove(leaves[-1])
+            break
+    return drifted
+
+def edit_label(hierarchy):
+    drifted = drift_numbers(hierarchy)
+    for node in nodes(drifted):
+        attrs = node.get("attributes", {})
+        if attrs.get("text") and not re.search(r"\d", attrs["text"]):
+            attrs["text"] += " (new)"
+            break
+    return drifted
+
+DRIFTS = {"numbers": drift_numbers, "numbers+removed_item": drop_item, "numbers+edited_label": edit_label}
+
+workdir = tempfile.mkdtemp(prefix="recall-report-")
+memory = TestMemory(os.path.join(workdir, "memory.json"), history=HistoryStore(os.path.join(workdir, "history.db")))
+report = {"dumps": {}, "totals": {"queries": 0, "exact_hits": 0, "similar_hits": 0}}
+
+learned = {}
+for path in dumps:
+    hierarchy = load_dump(path)
+    screen_hash = get_screen_hash(hierarchy)
+    memory.learn_screen(screen_hash, None, "recall-report", hierarchy)
+    learned[path] = (hierarchy, screen_hash)
+memory.drain()
+
+for path, (hierarchy, screen_hash) in learned.items():
+    results = {}
+    for name, drift in DRIFTS.items():
+        variant = drift(hierarchy)
+        variant_hash = get_screen_hash(variant)
+        match = memory.find_similar_screen(variant)
+        matched_id = match["screen_id"] if match else None
+        qs = queries(variant)
+        exact = sum(1 for q in qs if memory.get_element_memory(variant_hash, q))
+        similar = sum(1 for q in qs if memory.get_element_memory(variant_hash, q)
+                      or (matched_id and memory.get_element_memory(matched_id, q)))
+        results[name] = {
+            "hash_changed": variant_hash != screen_hash,
+            "matched_screen": matched_id,
+            "correct_match": matched_id == screen_hash,
+            "similarity": round(match["similarity"], 3) if match else None,
+            "queries": len(qs),
+            "exact_recall": round(exact / len(qs), 3) if qs else None,
+            "similar_recall": round(similar / len(qs), 3) if qs else None
+        }
+        report["totals"]["queries"] += len(qs)
+        report["totals"]["exact_hits"] += exact
+        report["totals"]["similar_hits"] += similar
+    report["dumps"][os.path.relpath(path, here)] = {"screen": screen_hash, "drifts": results}
+
+totals = report["totals"]
+if totals["queries"]:
+    totals["exact_recall"] = round(totals["exact_hits"] / totals["queries"], 3)
+    totals["similar_recall"] = round(totals["similar_hits"] / totals["queries"], 3)
+print(json.dumps(report, indent=2))
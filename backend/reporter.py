@@ -1,5 +1,8 @@
+import os
 from typing import Dict, List, Any
 from intelligence import intelligence
+import tracing
+import profiling
 from datetime import datetime
 
 class AIReporter:
@@ -7,12 +10,12 @@ class AIReporter:
         """
         Generates a simple, actionable test report focused on failures.
         """
-        run_data = next((r for r in intelligence.raw_data["runs"] if r["run_id"] == run_id), None)
+        run_data = intelligence.get_run(run_id)
         if not run_data:
             return {"error": "Run not found"}
 
-        actions = [a for a in intelligence.raw_data["actions"] if a["run_id"] == run_id]
-        failures = [f for f in intelligence.raw_data["failures"] if f["run_id"] == run_id]
+        actions = intelligence.get_run_actions(run_id)
+        failures = intelligence.get_run_failures(run_id)
         
         # Find failed actions
         failed_actions = [a for a in actions if a["status"] == "FAIL"]
@@ -43,11 +46,25 @@ class AIReporter:
             },
             "failure_details": self._get_failure_details(failed_actions, failures),
             "execution_steps": steps,
-            "recommendation": self._get_recommendation(run_data, failed_actions, failures)
+            "recommendation": self._get_recommendation(run_data, failed_actions, failures),
+            "waterfall": self._get_waterfall(run_id),
+            "profile": f"/report/{run_id}/profile" if os.path.exists(profiling.profile_path(run_id)) else None
         }
         
         return report
 
+    def _get_waterfall(self, run_id: str) -> Dict:
+        """Per-step timing of the run's traced spans (device calls, dumps, parsing, waits, AI calls)"""
+        trace = intelligence.get_spans(run_id)
+        if not trace:
+            return {"steps": [], "span_count": 0, "dropped_spans": 0}
+        return {
+            "steps": tracing.waterfall(trace["spans"]),
+            "span_count": len(trace["spans"]),
+            "dropped_spans": trace.get("dropped", 0),
+            "chrome_trace": f"/report/{run_id}/trace"
+        }
+
     def _get_failure_details(self, failed_actions: List[Dict], failures: List[Dict]) -> List[Dict]:
         """Extract clear failure information"""
         details = []
@@ -1,16 +1,25 @@
-from intelligence import intelligence
+from intelligence import intelligence, memory_registry
+from execution_context import ExecutionContext, default_context
 from models import TestRun, ScreenMemory, ElementMemory, ActionHistory, FailureRecord, ConfidenceMetric
 from healer import healer
+from flow_compiler import CompiledStep, FlowCompileError, CONTROL_STEPS, MAX_REPEAT, compile_flow, compile_step, expand_steps, resolve_query
 import subprocess
+import adb_transport
+import tracing
+import metrics
+from frames import Frame, frame_cache, current_frame
 import time
 import hashlib
 import os
 import json
 import base64
+import copy
 import requests
 import re
 import xml.etree.ElementTree as ET
 import yaml
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional, Any
 from agents.failure_analyzer import failure_analyzer
 from agents.hybrid_resolver import hybrid_resolver
@@ -19,23 +28,32 @@ from agents.goal_agent import goal_agent
 from analysis.crash_analyzer import crash_analyzer
 from analysis.improver import improver
 
-# Global variables for current run tracking
-current_run_id = None
-
-_hierarchy_cache = {"data": None, "time": 0, "hash": None}
-_last_interaction_time = 0
-_native_dump_failures = 0
-
-def mark_interaction():
-    global _last_interaction_time
-    _last_interaction_time = time.time()
-
+# Per-run state lives in ExecutionContext; only facts about a device are shared between runs
+_device_info: Dict[Optional[str], Dict[str, Any]] = {} # serial -> {model, screen_size}
+
+# Compiled FAST traces: device input recorded while a step runs
+TRACE_COMMANDS = ("shell input ", "shell am start ", "shell am force-stop ", "shell monkey ", "shell pm clear ")
+# Steps that must observe the UI always run through the resolver, even when replaying a trace.
+# runFlow/repeat left after expansion are conditional, so they are live too.
+LIVE_STEPS = {"assertVisible", "assertNotVisible", "scrollUntilVisible", "extendedWaitUntil", "wait", "repeat", "runFlow"}
+# Steps that set the device state themselves, so their precondition isn't checked
+ANCHOR_STEPS = {"launchApp", "openLink", "stopApp", "killApp"}
+_probe_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="trace-probe")
+
+def vision_image(screenshot):
+    """(media type, base64) of a frames.Frame (encoded once per frame) or an image file."""
+    if isinstance(screenshot, Frame):
+        media_type, encoded = frame_cache.vision_data_url(screenshot)[len("data:"):].split(";base64,", 1)
+        return media_type, encoded
+    with open(screenshot, "rb") as img_file:
+        return "image/png", base64.b64encode(img_file.read()).decode("utf-8")
+
+@tracing.traced("vision.google")
 def call_google_vision(screenshot_path, query, api_key):
     """Google Gemini Vision Implementation"""
     try:
         print(f"[DEBUG] Asking Google Gemini to find '{query}'...")
-        with open(screenshot_path, "rb") as img_file:
-            b64_image = base64.b64encode(img_file.read()).decode("utf-8")
+        media_type, b64_image = vision_image(screenshot_path)
             
         url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={api_key}"
         headers = {"Content-Type": "application/json"}
@@ -49,13 +67,15 @@ def call_google_vision(screenshot_path, query, api_key):
             "contents": [{
                 "parts": [
                     {"text": prompt},
-                    {"inline_data": {"mime_type": "image/png", "data": b64_image}}
+                    {"inline_data": {"mime_type": media_type, "data": b64_image}}
                 ]
             }]
         }
         
-        resp = requests.post(url, headers=headers, json=payload)
-        data = resp.json()
+        with metrics.llm_call("vision", "gemini-1.5-flash") as call:
+            resp = requests.post(url, headers=headers, json=payload)
+            data = resp.json()
+            call["ok"] = "error" not in data
         
         if "error" in data:
             print(f"[DEBUG] Google Vision Error: {data['error']}")
@@ -71,6 +91,7 @@ def call_google_vision(screenshot_path, query, api_key):
         print(f"[DEBUG] Google Vision Exception: {e}")
     return None
 
+@tracing.traced("vision")
 def call_ai_vision(screenshot_path, query, api_key):
     """Fallback: Use AI to find element coordinates by vision (OpenAI or Google)"""
     
@@ -100,8 +121,7 @@ def call_ai_vision(screenshot_path, query, api_key):
     # 3. OpenAI Implementation (Legacy)
     try:
         print(f"[DEBUG] Asking OpenAI to find '{query}'...")
-        with open(screenshot_path, "rb") as img_file:
-            b64_image = base64.b64encode(img_file.read()).decode("utf-8")
+        media_type, b64_image = vision_image(screenshot_path)
             
         headers = {
             "Content-Type": "application/json",
@@ -123,15 +143,17 @@ def call_ai_vision(screenshot_path, query, api_key):
                     "role": "user",
                     "content": [
                         {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64_image}"}}
+                        {"type": "image_url", "image_url": {"url": f"data:{media_type};base64,{b64_image}"}}
                     ]
                 }
             ],
             "max_tokens": 100
         }
         
-        resp = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-        data = resp.json()
+        with metrics.llm_call("vision", "gpt-4o") as call:
+            resp = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+            data = resp.json()
+            call["ok"] = "error" not in data
         
         if "error" in data:
             print(f"[DEBUG] OpenAI Vision Error: {data['error']}")
@@ -149,17 +171,66 @@ def call_ai_vision(screenshot_path, query, api_key):
         
     return None
 
-def run_adb(command):
-    cmd = ["adb"] + command.split()
-    result = subprocess.run(cmd, capture_output=True, text=True)
+def run_adb(ctx, command):
+    if ctx.trace_recorder is not None and command.startswith(TRACE_COMMANDS) and "uiautomator" not in command:
+        if not ctx.trace_recorder["commands"]:
+            # The window the step acted on, sampled once it has resolved its target
+            ctx.trace_recorder["expect_before"] = get_focus_fingerprint(ctx)
+        ctx.trace_recorder["commands"].append(command)
+    cmd = ["adb"] + (["-s", ctx.device] if ctx.device else []) + command.split()
+    with tracing.span("adb", ctx.tracer, cmd=" ".join(command.split()[:3])), metrics.adb_command(command).time():
+        result = ctx.transport.run(cmd, capture_output=True, text=True)
     return result
 
-def tap_point(x, y):
-    mark_interaction()
-    run_adb(f"shell input tap {x} {y}")
-
-def get_screen_size():
-    res = run_adb("shell wm size").stdout
+def get_focus_fingerprint(ctx):
+    """Lightweight screen probe: the focused window (activity or dialog) without a hierarchy dump."""
+    out = run_adb(ctx, "shell dumpsys window | grep mCurrentFocus").stdout
+    match = re.search(r"mCurrentFocus=Window\{\S+ \S+ ([^}]+)\}", out)
+    return match.group(1).strip() if match else None
+
+def wait_for_window(ctx, expected, timeout=None):
+    """Poll the focused window until it matches; returns the last window seen and whether it matched."""
+    timeout = ctx.policies["trace_window_timeout"] if timeout is None else timeout
+    start = ctx.now()
+    while True:
+        window = get_focus_fingerprint(ctx)
+        if window == expected or ctx.now() - start >= timeout:
+            return window, window == expected
+        ctx.sleep(0.1)
+
+def tap_point(ctx, x, y):
+    ctx.mark_interaction()
+    run_adb(ctx, f"shell input tap {x} {y}")
+
+def get_device_model(ctx):
+    info = _device_info.setdefault(ctx.device, {})
+    if "model" not in info:
+        info["model"] = run_adb(ctx, "shell getprop ro.product.model").stdout.strip() or "unknown"
+    return info["model"]
+
+@contextmanager
+def recorded_device(device, info):
+    """Serve a device's facts (model, screen size) from a recording while the block runs, for session replays."""
+    _device_info[device] = {key: tuple(value) if isinstance(value, list) else value for key, value in (info or {}).items()}
+    try:
+        yield
+    finally:
+        _device_info.pop(device, None)
+
+def select_memory(ctx, app_id):
+    """Pick the memory partition for the app under test, optionally split by device model."""
+    device_model = get_device_model(ctx) if os.getenv("RATT_MEMORY_PARTITION_BY_DEVICE") == "1" else None
+    ctx.memory = memory_registry.for_app(app_id, device_model)
+    return ctx.memory
+
+def get_screen_size(ctx):
+    info = _device_info.setdefault(ctx.device, {})
+    if "screen_size" not in info:
+        info["screen_size"] = _read_screen_size(ctx)
+    return info["screen_size"]
+
+def _read_screen_size(ctx):
+    res = run_adb(ctx, "shell wm size").stdout
     # Prioritize Override size (user custom resolution)
     match = re.search(r"Override size:\s*(\d+)x(\d+)", res)
     if match:
@@ -176,8 +247,31 @@ def get_screen_size():
         return int(match.group(1)), int(match.group(2))
     return 1080, 2400
 
-def tap_point_percent(px_str, py_str):
-    w, h = get_screen_size()
+def step_selector(s):
+    """Normalized selector of a step, independent of its position in the flow."""
+    params = s.params
+    if isinstance(params, dict):
+        if set(params) - {"point"}:
+            params = {k: v for k, v in params.items() if k != "point"}
+    if isinstance(params, str):
+        params = params.strip().lower()
+    return f"{s.type}:{json.dumps(params, sort_keys=True, default=str)}"
+
+def remember_step(ctx, step_context, bounds, screen_id):
+    """Save where a step interacted, keyed by selector + screen, and chain it to the previous step."""
+    if not step_context or not screen_id:
+        return
+    test_name, _, selector = step_context
+    key = ctx.memory.save_step_memory(
+        selector, screen_id, bounds,
+        screen_size=get_screen_size(ctx),
+        test_name=test_name,
+        prev_key=ctx.step_chain["key"]
+    )
+    ctx.step_chain.update(key=key, next_screen=None)
+
+def tap_point_percent(ctx, px_str, py_str):
+    w, h = get_screen_size(ctx)
     
     # Handle X
     if "%" in str(px_str):
@@ -191,7 +285,7 @@ def tap_point_percent(px_str, py_str):
     else:
         y_val = float(py_str)
         
-    tap_point(int(x_val), int(y_val))
+    tap_point(ctx, int(x_val), int(y_val))
 
 def parse_bounds(bounds_str):
     # "[0,0][1080,210]"
@@ -253,48 +347,64 @@ def get_screen_hash(hierarchy_data):
     full_str = "|".join(structure)
     return hashlib.md5(full_str.encode()).hexdigest()
 
-def get_hierarchy(force_refresh=False, smart_cache=False):
-    global _hierarchy_cache, _native_dump_failures
-    now = time.time()
+def get_hierarchy(ctx, force_refresh=False, smart_cache=False):
+    with tracing.span("get_hierarchy", ctx.tracer) as span:
+        start = time.perf_counter()
+        data = _get_hierarchy(ctx, span, force_refresh, smart_cache)
+    if span.get("provider") == "cache":
+        metrics.SNAPSHOT_HIT.inc()
+    else:
+        metrics.SNAPSHOT_MISS.inc()
+        metrics.HIERARCHY_BY_PROVIDER[span.get("provider", "maestro")].observe(time.perf_counter() - start)
+    return data
+
+def _get_hierarchy(ctx, span, force_refresh, smart_cache):
+    """get_hierarchy; records which provider answered on the span."""
+    now = ctx.now()
     
     # Smart Cache: If enabled, utilize cache as long as it's newer than the last interaction
     # This allows bulk assertions to run instantly without re-dumping
-    if smart_cache and _hierarchy_cache["data"]:
+    if smart_cache and ctx.hierarchy_cache["data"]:
         # Check if cache was captured AFTER the last interaction
-        if _hierarchy_cache["time"] > _last_interaction_time:
-            return _hierarchy_cache["data"]
+        if ctx.hierarchy_cache["time"] > ctx.last_interaction_time:
+            span["provider"] = "cache"
+            return ctx.hierarchy_cache["data"]
 
-    # Standard Cache: 3 seconds (unless forced), BUT must be newer than last interaction
-    is_fresh = _hierarchy_cache["time"] > _last_interaction_time
-    if not force_refresh and _hierarchy_cache["data"] and (now - _hierarchy_cache["time"] < 3.0) and is_fresh:
-        return _hierarchy_cache["data"]
+    # Standard Cache: 3 seconds by default (unless forced), BUT must be newer than last interaction
+    is_fresh = ctx.hierarchy_cache["time"] > ctx.last_interaction_time
+    cache_ttl = ctx.policies["hierarchy_cache_ttl"]
+    if not force_refresh and ctx.hierarchy_cache["data"] and (now - ctx.hierarchy_cache["time"] < cache_ttl) and is_fresh:
+        span["provider"] = "cache"
+        return ctx.hierarchy_cache["data"]
 
     data = None
     
     # Check circuit breaker
-    if _native_dump_failures < 3:
+    max_dump_failures = ctx.policies["native_dump_max_failures"]
+    if ctx.native_dump_failures < max_dump_failures:
+        span["provider"] = "uiautomator"
         try:
             # 1. Native ADB dump (fast)
             # Self-healing: kill any stuck uiautomator process first
-            run_adb("shell pkill -9 uiautomator")
+            run_adb(ctx, "shell pkill -9 uiautomator")
             
             # Try native dump with timeout
             # Cleanup first
-            run_adb("shell rm -f /data/local/tmp/uidump.xml")
+            run_adb(ctx, "shell rm -f /data/local/tmp/uidump.xml")
             
-            dump_proc = run_adb("shell uiautomator dump /data/local/tmp/uidump.xml")
+            dump_proc = run_adb(ctx, "shell uiautomator dump /data/local/tmp/uidump.xml")
             
             # If it failed, try once more after a tiny sleep
             if dump_proc.returncode != 0:
                 print(f"[DEBUG] Native dump failed (code {dump_proc.returncode}, stderr: {dump_proc.stderr}), retrying...")
-                time.sleep(0.5)
+                ctx.sleep(0.5)
                 # Kill uiautomator more aggressively
-                run_adb("shell am force-stop com.github.uiautomator")
-                run_adb("shell am force-stop com.github.uiautomator.test")
-                dump_proc = run_adb("shell uiautomator dump /data/local/tmp/uidump.xml")
+                run_adb(ctx, "shell am force-stop com.github.uiautomator")
+                run_adb(ctx, "shell am force-stop com.github.uiautomator.test")
+                dump_proc = run_adb(ctx, "shell uiautomator dump /data/local/tmp/uidump.xml")
 
             if dump_proc.returncode == 0:
-                xml_res = run_adb("shell cat /data/local/tmp/uidump.xml")
+                xml_res = run_adb(ctx, "shell cat /data/local/tmp/uidump.xml")
                 xml_data = xml_res.stdout
                 
                 if xml_data and "<?xml" in xml_data:
@@ -303,51 +413,57 @@ def get_hierarchy(force_refresh=False, smart_cache=False):
                     if start_xml != -1 and end_xml != -1:
                         clean_xml = xml_data[start_xml:end_xml + len("</hierarchy>")]
                         try:
-                            root = ET.fromstring(clean_xml)
-                            data = parse_xml_node(root)
+                            with tracing.span("parse", ctx.tracer, bytes=len(clean_xml)):
+                                root = ET.fromstring(clean_xml)
+                                data = parse_xml_node(root)
                             # Success! Reset failure count
-                            _native_dump_failures = 0
+                            ctx.native_dump_failures = 0
                         except: pass
             
             if not data:
-                _native_dump_failures += 1
-                if _native_dump_failures >= 3:
+                ctx.native_dump_failures += 1
+                if ctx.native_dump_failures >= max_dump_failures:
                      print("[DEBUG] Native dump unstable. Disabling for this session.")
 
         except Exception as e:
-             _native_dump_failures += 1
+             ctx.native_dump_failures += 1
              print(f"[ERROR] Native dump error: {e}")
 
     if not data:
         # 2. Fallback to maestro hierarchy
         print("[DEBUG] Native dump failed/invalid/disabled, falling back to maestro")
-        result = subprocess.run(["maestro", "hierarchy"], capture_output=True, text=True, timeout=30, env={**os.environ, "MAESTRO_OUTPUT_NO_COLOR": "true"})
+        span["provider"] = "maestro"
+        device_args = ["--device", ctx.device] if ctx.device else []
+        with tracing.span("maestro", ctx.tracer):
+            result = ctx.transport.run(["maestro"] + device_args + ["hierarchy"], capture_output=True, text=True, timeout=30, env={**os.environ, "MAESTRO_OUTPUT_NO_COLOR": "true"})
         output = result.stdout
         start = output.find('{')
         end = output.rfind('}')
         if start != -1 and end != -1:
-            data = json.loads(output[start:end+1])
+            with tracing.span("parse", ctx.tracer, bytes=len(output)):
+                data = json.loads(output[start:end+1])
 
     if data:
         h = get_screen_hash(data)
         # AI Learning integration
-        intelligence.learn_screen(h, None, current_run_id or "unknown", data)
-        _hierarchy_cache = {"data": data, "time": now, "hash": h}
+        ctx.memory.learn_screen(h, None, ctx.run_id or "unknown", data)
+        ctx.hierarchy_cache = {"data": data, "time": now, "hash": h}
         return data
             
     return {"children": []}
 
-def get_current_screen_hash():
+def get_current_screen_hash(ctx):
     """Helper to get the hash of the last captured hierarchy."""
-    if _hierarchy_cache["time"] > _last_interaction_time:
-        return _hierarchy_cache.get("hash")
+    if ctx.hierarchy_cache["time"] > ctx.last_interaction_time:
+        return ctx.hierarchy_cache.get("hash")
     return None
 
 
-def get_hierarchy_json():
-    data = get_hierarchy()
+def get_hierarchy_json(ctx):
+    data = get_hierarchy(ctx)
     return json.dumps(data)
 
+@tracing.traced("find_element")
 def find_element(node, query, index=None):
     """
     Find an element in the UI hierarchy matching the query.
@@ -547,7 +663,7 @@ def find_fuzzy_successor(root, query, cached_data):
         if not n: return
         
         attrs = n.get("attributes", {})
-        bounds = attrs.get("bounds")
+        bounds = n.get("bounds") # Parsed by parse_xml_node; attributes keep the raw string
         
         if bounds:
             ncx = (bounds["left"] + bounds["right"]) // 2
@@ -571,12 +687,12 @@ def find_fuzzy_successor(root, query, cached_data):
     search(root)
     return best_candidate
 
-def analyze_failure(root, query, screen_hash):
+def analyze_failure(ctx, root, query, screen_hash):
     """
     REASONING ENGINE: Why did it fail? 
     Compares current state vs knowledge base.
     """
-    cached = intelligence.get_element_memory(screen_hash, query)
+    cached = ctx.memory.get_element_memory(screen_hash, query)
     if not cached:
          return "Element never seen before on this screen. Is the locator correct?"
     
@@ -610,13 +726,13 @@ def get_center(bounds):
         pass
     return None
 
-def perform_tap_id_only(resource_id):
+def perform_tap_id_only(ctx, resource_id):
     """
     Perform a tap on an element identified by its resource-id.
     This helper is used for fast-path permission dialog handling.
     """
     print(f"[DEBUG] Attempting tap on ID: {resource_id}")
-    root = get_hierarchy()
+    root = get_hierarchy(ctx)
     el = find_element(root, resource_id)
     if el:
         attrs = el.get("attributes", {})
@@ -625,7 +741,7 @@ def perform_tap_id_only(resource_id):
         center = get_center(bounds)
         if center:
             cx, cy = center
-            run_adb(f"shell input tap {cx} {cy}")
+            run_adb(ctx, f"shell input tap {cx} {cy}")
             return True
         else:
             print(f"[DEBUG] ID '{resource_id}' found but no valid bounds: {bounds}")
@@ -633,13 +749,13 @@ def perform_tap_id_only(resource_id):
         print(f"[DEBUG] ID '{resource_id}' not found in current hierarchy")
     return False
 
-def perform_tap_text_only(text, root=None):
+def perform_tap_text_only(ctx, text, root=None):
     """
     Perform a tap on an element identified by its text.
     """
     print(f"[DEBUG] Attempting tap on Text: {text}")
     if not root:
-        root = get_hierarchy()
+        root = get_hierarchy(ctx)
     el = find_element(root, text)
     if el:
         attrs = el.get("attributes", {})
@@ -647,12 +763,12 @@ def perform_tap_text_only(text, root=None):
         center = get_center(bounds)
         if center:
             cx, cy = center
-            run_adb(f"shell input tap {cx} {cy}")
+            run_adb(ctx, f"shell input tap {cx} {cy}")
             return True
     return False
 
-def input_text(text):
-    mark_interaction()
+def input_text(ctx, text):
+    ctx.mark_interaction()
     # Ensure it is a string if it came from a dict parameter
     if isinstance(text, dict):
         # Extract text if parameter was a dict like {text: "...", index: ...}
@@ -662,47 +778,59 @@ def input_text(text):
         
     # Escape spaces for ADB input
     escaped = text.replace(" ", "%s")
-    run_adb(f"shell input text {escaped}")
+    run_adb(ctx, f"shell input text {escaped}")
 
-def take_screenshot(name="failure"):
+def take_screenshot(ctx, name="failure"):
     path = f"/data/local/tmp/{name}.png"
-    run_adb(f"shell screencap -p {path}")
+    run_adb(ctx, f"shell screencap -p {path}")
+    ctx.emit("artifact", kind="screenshot", name=name, path=path, location="device")
     # Pull to local workspace for viewing? For now just capturing implies debugging intent
     # Real implementation would pull this to frontend
     return path
 
 class StepData:
+    """Per-execution copy of a compiled step. Healing and FAST mode rewrite it, never the cached IR."""
     def __init__(self, step):
-        self.raw = step
-        if isinstance(step, str):
-            self.type = step
-            self.params = None
-        else:
-            self.type = list(step.keys())[0]
-            self.params = step[self.type]
-
-def resolve_query(params):
-    if params is None: return None
-    if isinstance(params, str): return params
-    if not isinstance(params, dict): return str(params)
-    if "point" in params: return None
-    
-    # Prioritize common Maestro-style keys
-    for key in ["id", "resourceId", "text", "contentDescription", "accessibilityId", "label", "hint"]:
-        if key in params:
-            val = str(params[key])
-            # Auto-detect regex for IDs/resourceIds if they contain regex special chars
-            if key in ["id", "resourceId"] and not val.startswith("regexp:"):
-                if any(c in val for c in [".*", "+", "^", "$", "|"]):
-                    return f"regexp:{val}"
-            return val
-            
-    # Fallback to any value that isn't a known metadata key
-    clean = {k:v for k,v in params.items() if k not in ["timeout", "optional", "index", "point", "longPress"]}
-    if clean: return str(next(iter(clean.values())))
-    return None
+        compiled = step if isinstance(step, CompiledStep) else compile_step(step)
+        self.raw = compiled.raw
+        self.type = compiled.type
+        self.params = copy.deepcopy(compiled.params)
+        self.line = compiled.line
+        self.query = compiled.query
+        self.index = compiled.index
+        self.point = list(compiled.point) if compiled.point else None
+        self.condition = compiled.condition
+        self.optional = compiled.optional
+        self.when = compiled.when
+
+    def reselect(self):
+        """Resolve the selector again after healing rewrote the params."""
+        self.query = resolve_query(self.params)
+
+def probe_element(ctx, query, index=None, visible=True, timeout_ms=None):
+    """
+    Whether `query` is (or with visible=False, isn't) on screen: judged on the current snapshot,
+    then on fresh dumps until timeout_ms (policy probe_timeout_ms). `when` and `optional` use this
+    instead of the assertion waits, so a dialog that isn't there costs one snapshot lookup.
+    """
+    timeout_ms = ctx.policies["probe_timeout_ms"] if timeout_ms is None else timeout_ms
+    deadline = ctx.now() + timeout_ms / 1000
+    root = get_hierarchy(ctx, smart_cache=True)
+    while True:
+        if bool(find_element(root, query, index=index)) == visible:
+            return True
+        if ctx.now() >= deadline:
+            return False
+        ctx.sleep(0.2)
+        root = get_hierarchy(ctx, force_refresh=True)
+
+def when_met(ctx, when):
+    return probe_element(ctx, when["query"], when["index"], visible=when["condition"] == "visible")
 
-def retry_operation(operation_func, max_retries=3, retry_delay=1.0, operation_name="operation"):
+def when_skipped(step_type, when):
+    return f"Skip {step_type}: when {when['condition']} '{when['query']}' is false"
+
+def retry_operation(operation_func, max_retries=3, retry_delay=1.0, operation_name="operation", sleep=tracing.sleep):
     """
     Retry an operation up to max_retries times with a delay between attempts.
     
@@ -711,6 +839,7 @@ def retry_operation(operation_func, max_retries=3, retry_delay=1.0, operation_na
         max_retries: Maximum number of retry attempts (default: 3)
         retry_delay: Delay in seconds between retries (default: 1.0)
         operation_name: Name of the operation for logging
+        sleep: How to wait between attempts (ctx.sleep in a run)
     
     Returns:
         Result of the operation_func if successful
@@ -723,7 +852,8 @@ def retry_operation(operation_func, max_retries=3, retry_delay=1.0, operation_na
     for attempt in range(1, max_retries + 1):
         try:
             print(f"[DEBUG] {operation_name} - Attempt {attempt}/{max_retries}")
-            result = operation_func()
+            with tracing.span("attempt", operation=operation_name, attempt=attempt):
+                result = operation_func()
             if attempt > 1:
                 print(f"[DEBUG] {operation_name} succeeded on attempt {attempt}")
             return result
@@ -732,14 +862,27 @@ def retry_operation(operation_func, max_retries=3, retry_delay=1.0, operation_na
             if attempt < max_retries:
                 print(f"[DEBUG] {operation_name} failed (attempt {attempt}/{max_retries}): {str(e)}")
                 print(f"[DEBUG] Waiting {retry_delay}s before retry...")
-                time.sleep(retry_delay)
+                sleep(retry_delay)
             else:
                 print(f"[DEBUG] {operation_name} failed after {max_retries} attempts")
     
     # All retries exhausted
     raise last_exception
 
-def wait_for_element_or_fail(query, timeout=10, step_context=None, index=None):
+def recall_element(ctx, screen_hash, query, root=None):
+    """
+    Element memory for the query on this screen. A hit borrowed from a near-duplicate screen is
+    only a candidate: it is used once the element is found on the live hierarchy, with live bounds.
+    """
+    cached = ctx.memory.get_element_memory(screen_hash, query)
+    if not cached or not cached.get("alias_of"):
+        return cached
+    el = find_element(root, query) if root else None
+    if not el:
+        return None
+    return {**cached, "bounds": el["attributes"]["bounds"]}
+
+def wait_for_element_or_fail(ctx, query, timeout=10, step_context=None, index=None):
     # Requirement: Wait up to 10s. If not found, retry for another 10s.
     # We enforce a minimum of 10s per attempt unless a specific long timeout was requested.
     phase_timeout = max(timeout, 10)
@@ -747,43 +890,43 @@ def wait_for_element_or_fail(query, timeout=10, step_context=None, index=None):
     # 1. Try to recall from knowledge first (Instant check)
     # Skip recall if index is used (recall currently optimized for "best" match)
     if index is None:
-        last_hash = get_current_screen_hash()
-        cached = intelligence.get_element_memory(last_hash, query)
+        last_hash = get_current_screen_hash(ctx)
+        cached = recall_element(ctx, last_hash, query)
         if cached:
             print(f"[DEBUG] Learner: Recalled '{query}' from previous run knowledge.")
             if step_context:
-                 intelligence.save_step_memory(step_context[0], step_context[1], cached["bounds"])
+                 remember_step(ctx, step_context, cached["bounds"], last_hash)
             return {"bounds": cached["bounds"], "attributes": {"bounds": cached["bounds"], "recalled": True}}
 
     # Two attempts: Initial (10s) + Retry (10s)
     for attempt in range(1, 3):
-        start = time.time()
+        start = ctx.now()
         msg = f"{query}[{index}]" if index is not None else query
         print(f"[DEBUG] Waiting for element: {msg} (Attempt {attempt}/2, timeout {phase_timeout}s)")
         
         first_check = True
 
-        while time.time() - start < phase_timeout:
+        while ctx.now() - start < phase_timeout:
             # OPTIMIZATION: On first check, try smart cache (fastest)
             # If that fails, force a refresh immediately (to avoid waiting 3s for cache expiry)
             is_smart = first_check and attempt == 1
-            root = get_hierarchy(smart_cache=is_smart, force_refresh=(not is_smart and first_check))
+            root = get_hierarchy(ctx, smart_cache=is_smart, force_refresh=(not is_smart and first_check))
             
             if not root:
                  print("[DEBUG] Hierarchy is None")
-                 time.sleep(0.3)
+                 ctx.sleep(0.3)
                  continue
                  
             # Detect screen hash
-            current_hash = get_current_screen_hash()
+            current_hash = get_current_screen_hash(ctx)
             
             # Check cache again if screen changed (and no index)
             if index is None:
-                cached = intelligence.get_element_memory(current_hash, query)
+                cached = recall_element(ctx, current_hash, query, root)
                 if cached:
                     print(f"[DEBUG] Learner: Identified screen '{current_hash}'. Recalling '{query}'.")
                     if step_context:
-                         intelligence.save_step_memory(step_context[0], step_context[1], cached["bounds"])
+                         remember_step(ctx, step_context, cached["bounds"], current_hash)
                     return {"bounds": cached["bounds"], "attributes": {"bounds": cached["bounds"], "recalled": True}}
 
             el = find_element(root, query, index=index)
@@ -792,11 +935,11 @@ def wait_for_element_or_fail(query, timeout=10, step_context=None, index=None):
                 bounds = el.get("bounds") # Use the parsed bounds object, not the raw string
                 # Basic visibility check
                 if bounds and bounds.get("width", 0) > 0 and bounds.get("height", 0) > 0:
-                     print(f"[DEBUG] Found '{msg}' in {time.time() - start:.2f}s")
+                     print(f"[DEBUG] Found '{msg}' in {ctx.now() - start:.2f}s")
                      if index is None: # Only remember interactions for unique/best elements
-                         intelligence.remember_interaction(current_hash, query, el, success=True)
+                         ctx.memory.remember_interaction(current_hash, query, el, success=True)
                      if step_context:
-                          intelligence.save_step_memory(step_context[0], step_context[1], bounds)
+                          remember_step(ctx, step_context, bounds, current_hash)
                      return el
                 else:
                      print(f"[DEBUG] Found '{msg}' but it is not visible/interactive. Continuing search...")
@@ -810,82 +953,111 @@ def wait_for_element_or_fail(query, timeout=10, step_context=None, index=None):
             
             # SELF-HEALING: Try fuzzy matching (only if no index)
             if index is None:
-                cached = intelligence.get_element_memory(current_hash, query)
+                cached = ctx.memory.get_element_memory(current_hash, query)
                 if cached:
                     healed_el = find_fuzzy_successor(root, query, cached)
                     if healed_el:
                         print(f"[DEBUG] 🛠 SELF-HEALED: Exact match for '{query}' failed, but found a similar element.")
-                        intelligence.increment_healed()
-                        intelligence.remember_interaction(current_hash, query, healed_el, success=True)
+                        metrics.HEALS_FUZZY.inc()
+                        ctx.memory.increment_healed()
+                        ctx.memory.remember_interaction(current_hash, query, healed_el, success=True)
                         if step_context:
-                             intelligence.save_step_memory(step_context[0], step_context[1], healed_el["attributes"]["bounds"])
+                             remember_step(ctx, step_context, healed_el["attributes"]["bounds"], current_hash)
                         return healed_el
                 
                 # 3. HYBRID RESOLVER (Semantic AI Matching)
                 # Trigger this earlier if we've done at least one full hierarchy scan
-                if (attempt == 1 and time.time() - start > 5.0) or (attempt == 2):
-                    openai_key = os.getenv("RATT_OPENAI_KEY") or os.getenv("OPENAI_API_KEY")
-                    if openai_key:
-                        semantic_el = hybrid_resolver.resolve_with_json(query, root)
+                if (attempt == 1 and ctx.now() - start > 5.0) or (attempt == 2):
+                    openai_key = ctx.openai_key
+                    if openai_key and ctx.policies["semantic_resolver"]:
+                        with tracing.span("hybrid_resolver", ctx.tracer):
+                            semantic_el = hybrid_resolver.resolve_with_json(query, root, api_key=openai_key)
                         if semantic_el:
                             print(f"[DEBUG] 🧠 HYBRID RESOLVER: Found semantic match for '{query}'.")
-                            intelligence.remember_interaction(current_hash, query, semantic_el, success=True)
+                            metrics.HEALS_SEMANTIC.inc()
+                            ctx.memory.remember_interaction(current_hash, query, semantic_el, success=True)
                             if step_context:
-                                 intelligence.save_step_memory(step_context[0], step_context[1], semantic_el["attributes"]["bounds"])
+                                 remember_step(ctx, step_context, semantic_el["attributes"]["bounds"], current_hash)
                             return semantic_el
 
-            time.sleep(0.3)
+            ctx.sleep(0.3)
         
         if attempt == 1:
             print(f"[DEBUG] Element '{msg}' not found in first {phase_timeout}s. RETRYING...")
-            time.sleep(0.5)
+            ctx.sleep(0.5)
 
     # Timeout -> Fail
-    current_hash = get_current_screen_hash()
-    reason = analyze_failure(get_hierarchy(), query, current_hash)
+    current_hash = get_current_screen_hash(ctx)
+    reason = analyze_failure(ctx, get_hierarchy(ctx), query, current_hash)
     if index is None:
-        intelligence.remember_interaction(current_hash, query, {}, success=False)
+        ctx.memory.remember_interaction(current_hash, query, {}, success=False)
     print(f"[DEBUG] FAIL: {reason}")
-    take_screenshot("failure_timeout")
+    take_screenshot(ctx, "failure_timeout")
     raise Exception(f"Element not found: {query} (index: {index}) after {phase_timeout*2}s. Analysis: {reason}")
 
-def run_test_step(step, run_id=None, step_index=None, history=None):
+def run_test_step(ctx, step, step_index=None, history=None):
     """Wrapper for intelligence and failure handling around step execution."""
     start_time = time.time()
     s = StepData(step)
-    intent = str(step)
+    intent = str(s.raw)
     action_type = s.type
     
     if history is None:
         history = []
 
+    # Milliseconds per phase of this step, reported with the step_end event
+    phases = ctx.step_phases = {}
+
+    # Conditional and optional steps look at the screen once, with a short bounded probe
+    if s.when or (s.optional and s.query):
+        phase_start = time.time()
+        if s.when and not when_met(ctx, s.when):
+            phases["probe"] = int((time.time() - phase_start) * 1000)
+            yield f"RETURN:{when_skipped(s.type, s.when)}"
+            return
+        if s.optional and s.query and not probe_element(ctx, s.query, s.index):
+            phases["probe"] = int((time.time() - phase_start) * 1000)
+            yield f"RETURN:Skip optional {s.type}: '{s.query}' not on screen"
+            return
+        phases["probe"] = int((time.time() - phase_start) * 1000)
+
     # Determine Intelligence Mode
     mode = "LEARN"
     test_name = None
+    run_id = ctx.run_id
     if run_id:
-        for r in intelligence.raw_data["runs"]:
-             if r["run_id"] == run_id: 
-                 mode = r.get("mode", "LEARN")
-                 test_name = r.get("test_name")
-                 break
+        r = ctx.memory.get_run(run_id)
+        if r:
+            mode = r.get("mode", "LEARN")
+            test_name = r.get("test_name")
     
-    step_context = (test_name, step_index) if test_name and step_index is not None else None
+    step_context = (test_name, step_index, step_selector(s)) if test_name and step_index is not None else None
 
     # FAST MODE: Predict and Optimize
     if mode == "FAST" and step_context and s.type == "tapOn":
-        # Check if we have a memory for this step
-        mem = intelligence.get_step_memory(*step_context)
+        phase_start = time.time()
+        # The screen we are on: a fresh dump if we have one, else where the previous step leads
+        screen_id = get_current_screen_hash(ctx) or ctx.step_chain["next_screen"]
+        if not screen_id:
+            get_hierarchy(ctx) # Anchor the chain with one dump
+            screen_id = get_current_screen_hash(ctx)
+        # Check if we have a memory for this step on this screen
+        mem = ctx.memory.get_step_memory(step_context[2], screen_id, get_screen_size(ctx))
+        if mem and mem.get("alias_of"):
+            # Learned on a near-duplicate screen: tap only what is on this one, else resolve normally
+            live = find_element(get_hierarchy(ctx), s.query, index=s.index) if s.query else None
+            mem = {**mem, "bounds": live["attributes"]["bounds"]} if live else None
         if mem:
+            ctx.step_chain.update(key=mem["key"], next_screen=mem.get("next_screen"))
             print(f"[FAST] Recalled step memory: {mem['bounds']}")
             cx, cy = get_center(mem['bounds'])
             if cx:
-                # OPTIMIZATION: Rewrite step to use point directly!
+                # OPTIMIZATION: Tap the point directly!
                 # This bypasses hierarchy dump and search entirely.
-                if isinstance(s.params, str): # "Search"
-                    s.params = {"point": f"{cx},{cy}", "original": s.params}
-                elif isinstance(s.params, dict) and "point" not in s.params:
-                    s.params["point"] = f"{cx},{cy}"
+                if not s.point:
+                    s.point = [str(cx), str(cy)]
                 print(f"[FAST] Optimized to tap point {cx},{cy}")
+        phases["recall"] = int((time.time() - phase_start) * 1000)
 
     
     # Track current state before action
@@ -897,25 +1069,35 @@ def run_test_step(step, run_id=None, step_index=None, history=None):
     if mode == "FAST": should_capture_state = False
 
     if should_capture_state:
-        root = get_hierarchy()
+        phase_start = time.time()
+        root = get_hierarchy(ctx)
         current_hash = get_screen_hash(root)
+        phases["snapshot"] = int((time.time() - phase_start) * 1000)
     
     attempts = 0
     max_attempts = 2  # 1 regular + 1 retry if healed
 
     while attempts < max_attempts:
+        phase_start = time.time()
         try:
-            result = _dispatch_step_logic(s, step_context)
+            result = _dispatch_step_logic(ctx, s, step_context)
+            phases["action"] = phases.get("action", 0) + int((time.time() - phase_start) * 1000)
             
             # Record Success
             duration = int((time.time() - start_time) * 1000)
             if run_id:
-                intelligence.record_action(run_id, action_type, intent, "SUCCESS", duration)
+                ctx.memory.record_action(run_id, action_type, intent, "SUCCESS", duration)
                 
             yield f"RETURN:{result}"
             return
 
         except Exception as e:
+            phases["action"] = phases.get("action", 0) + int((time.time() - phase_start) * 1000)
+            if s.optional:
+                # Optional steps never fail the flow, and aren't worth a healing round
+                print(f"[DEBUG] Optional {s.type} failed: {e}")
+                yield f"RETURN:Skip optional {s.type}: {e}"
+                return
             attempts += 1
             duration = int((time.time() - start_time) * 1000)
             error_msg = str(e)
@@ -923,13 +1105,16 @@ def run_test_step(step, run_id=None, step_index=None, history=None):
             # Record Failure & Analyze
             analysis = None
             if run_id:
-                intelligence.record_action(run_id, action_type, intent, "FAIL", duration)
-                analysis = healer.analyze_failure(
-                    run_id, 
-                    {"intent": intent, "type": action_type}, 
-                    error_msg, 
-                    {"ui_hash": current_hash or "unknown", "hierarchy": root or {}}
-                )
+                phase_start = time.time()
+                ctx.memory.record_action(run_id, action_type, intent, "FAIL", duration)
+                with tracing.span("healer", ctx.tracer), metrics.HEAL_ANALYSIS.time():
+                    analysis = healer.analyze_failure(
+                        run_id, 
+                        {"intent": intent, "type": action_type}, 
+                        error_msg, 
+                        {"ui_hash": current_hash or "unknown", "hierarchy": root or {}},
+                        memory=ctx.memory
+                    )
 
                 # NEW: AI Deep Analysis
                 yield "[AI-BOT] Deep Analysis triggered..."
@@ -942,14 +1127,17 @@ def run_test_step(step, run_id=None, step_index=None, history=None):
                 xml_str = json.dumps(root) if root else ""
                 
                 # 3. Ask the Bot
-                ai_analysis = failure_analyzer.analyze(
-                   step=s.raw,
-                   error=error_msg,
-                   xml_hierarchy=xml_str,
-                   history=history
-                )
+                with tracing.span("failure_analyzer", ctx.tracer):
+                    ai_analysis = failure_analyzer.analyze(
+                       step=s.raw,
+                       error=error_msg,
+                       xml_hierarchy=xml_str,
+                       history=history,
+                       api_key=ctx.openai_key
+                    )
                 
                 if ai_analysis:
+                   ctx.emit("ai_analysis", index=step_index, step=s.raw, error=error_msg, crash=is_crash, analysis=ai_analysis)
                    yield f"[AI-BOT] Analysis: {ai_analysis.get('failure_type')} - {ai_analysis.get('root_cause')}"
                    
                    # Merge AI diagnosis into existing analysis object for reporting
@@ -969,15 +1157,19 @@ def run_test_step(step, run_id=None, step_index=None, history=None):
                              elif "id" in bfix.get("locator_type", ""):
                                   if isinstance(s.params, dict): s.params['id'] = val
                                   else: s.params = f"id:{val}"
+                             s.reselect()
                              
                              # Set flag to retry with new params
                              analysis["healed"] = True
                              analysis["suggested_fix"] = {"type": bfix.get("locator_type"), "value": val}
+                phases["analysis"] = phases.get("analysis", 0) + int((time.time() - phase_start) * 1000)
             
             # HEALING LOGIC: Can we retry?
             if attempts < max_attempts and analysis and analysis.get("healed"):
                 fix = analysis.get("suggested_fix")
                 if fix:
+                    ctx.emit("heal", index=step_index, step=s.raw, error=error_msg, fix=fix, attempt=attempts + 1)
+                    metrics.HEALS_HEALER.inc()
                     yield f"[HEALER] Attempting auto-fix: {fix['value']}"
                     # Update step data for retry
                     if fix['type'] == 'text':
@@ -986,15 +1178,16 @@ def run_test_step(step, run_id=None, step_index=None, history=None):
                     elif fix['type'] == 'resource_id':
                         if isinstance(s.params, dict): s.params['id'] = fix['value']
                         else: s.params = f"id:{fix['value']}"
+                    s.reselect()
                     
                     # Refresh hierarchy before retry to be sure
-                    root = get_hierarchy()
+                    root = get_hierarchy(ctx)
                     current_hash = get_screen_hash(root)
                     continue
 
             raise e
 
-def _dispatch_step_logic(s, step_context=None):
+def _dispatch_step_logic(ctx, s, step_context=None):
     """The core Maestro command dispatcher."""
     if s.type == "launchApp":
         if isinstance(s.params, str):
@@ -1005,53 +1198,48 @@ def _dispatch_step_logic(s, step_context=None):
             clear_state = s.params.get("clearState", False)
         
         # Force stop the app first
-        run_adb(f"shell am force-stop {app_id}")
+        run_adb(ctx, f"shell am force-stop {app_id}")
         
         # Clear app data if clearState is true (optimized - no extra wait)
         if clear_state:
             print(f"[DEBUG] Clearing app data for {app_id}")
-            result = run_adb(f"shell pm clear {app_id}")
+            result = run_adb(ctx, f"shell pm clear {app_id}")
             # pm clear is synchronous, no need to wait
         
         # Launch the app with optimized startup
-        run_adb(f"shell monkey -p {app_id} -c android.intent.category.LAUNCHER 1")
+        run_adb(ctx, f"shell monkey -p {app_id} -c android.intent.category.LAUNCHER 1")
         
         # Reduced wait time - app launches quickly
-        time.sleep(1.5)
+        ctx.sleep(1.5)
         
         return f"Launch {app_id}" + (" (cleared state)" if clear_state else "")
 
 
     elif s.type == "tapOn":
-        is_optional = False
-        timeout = 5 if is_optional else 10 # Reduced default timeout
+        is_optional = s.optional
+        timeout = 10
         
-        # Handle coordinate tap immediately (FAST PATH)
-        if isinstance(s.params, dict) and "point" in s.params:
-            pt = str(s.params["point"])
-            if "," in pt:
-                px_str, py_str = pt.split(",")
-            else:
-                # Handle possible YAML parsing artifact where {point: 90%, 9%} 
-                # might result in 'point' being '90%' and others as keys
-                px_str = pt
-                py_str = None
-                for k in s.params:
-                    if k != "point":
-                        py_str = str(k)
-                        break
-                if not py_str:
-                     raise Exception(f"Invalid point format: {pt}")
-            
-            tap_point_percent(px_str, py_str)
+        # Handle coordinate tap immediately (FAST PATH); the compiler parsed the point
+        if s.point:
+            px_str, py_str = s.point
+            tap_point_percent(ctx, px_str, py_str)
             return f"Tap Point: {px_str},{py_str}"
             
-        query = resolve_query(s.params)
-        index = s.params.get("index") if isinstance(s.params, dict) else None
+        query = s.query
+        index = s.index
         
         def perform_tap():
-            # Regular Search - wait_for_element_or_fail already handles retries/wait/visibility
-            el = wait_for_element_or_fail(query, timeout=timeout, step_context=step_context, index=index)
+            if is_optional:
+                # The probe just saw it: tap it on that snapshot rather than waiting (up to 2 x 10s) if it went away
+                el = find_element(get_hierarchy(ctx, smart_cache=True), query, index=index)
+                bounds = el.get("bounds") if el else None
+                if not (bounds and bounds.get("width", 0) > 0 and bounds.get("height", 0) > 0):
+                    raise Exception(f"'{query}' is no longer visible after the probe")
+                if step_context:
+                    remember_step(ctx, step_context, bounds, get_current_screen_hash(ctx))
+            else:
+                # Regular Search - wait_for_element_or_fail already handles retries/wait/visibility
+                el = wait_for_element_or_fail(ctx, query, timeout=timeout, step_context=step_context, index=index)
             
             # Extract bounds
             attrs = el.get("attributes", {})
@@ -1060,13 +1248,14 @@ def _dispatch_step_logic(s, step_context=None):
             # Use center coordinates
             cx, cy = get_center(bounds)
             if cx:
-                run_adb(f"shell input tap {cx} {cy}")
+                run_adb(ctx, f"shell input tap {cx} {cy}")
                 return f"Tap '{query}'" + (f" [{index}]" if index is not None else "")
             
             raise Exception(f"Element found but no valid center for bounds: {query}")
 
         try:
-            return retry_operation(perform_tap, max_retries=5, retry_delay=1.0, operation_name=f"Tap '{query}'")
+            # An optional target was just seen by the probe; one look at that snapshot is enough
+            return retry_operation(perform_tap, max_retries=1 if is_optional else 5, retry_delay=1.0, operation_name=f"Tap '{query}'", sleep=ctx.sleep)
         except Exception as e:
             if is_optional: return f"Skip optional tap: '{query}'"
             
@@ -1086,27 +1275,29 @@ def _dispatch_step_logic(s, step_context=None):
                 for pid in permission_ids:
                     try:
                         # Quick check if ID exists in current hierarchy (optimization)
-                        if perform_tap_id_only(pid):
+                        if perform_tap_id_only(ctx, pid):
                              return f"Tap Permission Allow (via ID fast-path)"
                     except:
                         continue
                         
                 # Then try text variations
                 extra_queries = ["ALLOW", "While using the app", "Only this time"]
-                root = get_hierarchy()
+                root = get_hierarchy(ctx)
                 for eq in extra_queries:
-                     if perform_tap_text_only(eq, root):
+                     if perform_tap_text_only(ctx, eq, root):
                          return f"Tap '{eq}' (via variation fallback)"
 
             # Fallback: AI Vision
-            api_key = os.getenv("RATT_OPENAI_KEY") or os.getenv("OPENAI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+            api_key = ctx.openai_key or os.getenv("GOOGLE_API_KEY")
             if api_key:
                 print(f"[DEBUG] Element '{query}' not found via hierarchy. Trying AI Vision...")
                 try:
-                    snap_path = take_screenshot("vision_check")
-                    coords = call_ai_vision(snap_path, query, api_key)
+                    snap_path = take_screenshot(ctx, "vision_check")
+                    # The screen as a cached frame; the device-side file isn't readable from here
+                    frame = current_frame(ctx.device, ctx.transport)
+                    coords = call_ai_vision(frame or snap_path, query, api_key)
                     if coords:
-                        run_adb(f"shell input tap {coords[0]} {coords[1]}")
+                        run_adb(ctx, f"shell input tap {coords[0]} {coords[1]}")
                         return f"Tap '{query}' (via AI Vision)"
                 except Exception as vision_err:
                     print(f"[DEBUG] AI Vision failed: {vision_err}")
@@ -1114,44 +1305,44 @@ def _dispatch_step_logic(s, step_context=None):
             raise Exception(f"Element '{query}' not found. {str(e)}")
 
     elif s.type == "assertVisible":
-        query = resolve_query(s.params)
-        index = s.params.get("index") if isinstance(s.params, dict) else None
+        query = s.query
+        index = s.index
         timeout = s.params.get("timeout", 50) if isinstance(s.params, dict) else 50
         
         def perform_assert():
-            wait_for_element_or_fail(query, timeout=timeout, step_context=step_context, index=index)
+            wait_for_element_or_fail(ctx, query, timeout=timeout, step_context=step_context, index=index)
             return f"Assert Valid: '{query}'" + (f" [{index}]" if index is not None else "")
         
         # Retry assertion up to 3 times
-        return retry_operation(perform_assert, max_retries=3, retry_delay=0.5, operation_name=f"Assert '{query}'")
+        return retry_operation(perform_assert, max_retries=3, retry_delay=0.5, operation_name=f"Assert '{query}'", sleep=ctx.sleep)
 
     elif s.type == "assertNotVisible":
-        query = resolve_query(s.params)
+        query = s.query
         # Quick check, no wait needed usually, or short wait to ensure animation finished?
-        root = get_hierarchy()
+        root = get_hierarchy(ctx)
         el = find_element(root, query)
         if el:
-            take_screenshot("failure_visible")
+            take_screenshot(ctx, "failure_visible")
             raise Exception(f"Element should NOT be visible: {query}")
         return f"Assert Not Visible: '{query}'"
 
     elif s.type == "back":
-        mark_interaction()
-        run_adb("shell input keyevent 4")
+        ctx.mark_interaction()
+        run_adb(ctx, "shell input keyevent 4")
         return "Pressed Back"
 
     elif s.type == "stopApp" or s.type == "killApp":
         app_id = s.params
         if isinstance(s.params, dict):
              app_id = s.params.get("appId")
-        run_adb(f"shell am force-stop {app_id}")
+        run_adb(ctx, f"shell am force-stop {app_id}")
         return f"stopped App {app_id}"
 
     elif s.type == "openLink":
         link = s.params
         if isinstance(s.params, dict):
              link = s.params.get("link")
-        run_adb(f"shell am start -a android.intent.action.VIEW -d {link}")
+        run_adb(ctx, f"shell am start -a android.intent.action.VIEW -d {link}")
         return f"Open Link {link}"
         
     elif s.type == "eraseText":
@@ -1167,44 +1358,44 @@ def _dispatch_step_logic(s, step_context=None):
         # 'input keyevent 67 67 ...'
         events = " ".join(["67"] * chars)
         # If too long, split
-        run_adb(f"shell input keyevent {events}")
+        run_adb(ctx, f"shell input keyevent {events}")
         return f"Erased {chars} chars"
 
     elif s.type == "doubleTapOn":
         # Similar to tapOn but twice
-        query = resolve_query(s.params)
-        el = wait_for_element_or_fail(query, timeout=5)
+        query = s.query
+        el = wait_for_element_or_fail(ctx, query, timeout=5)
         attrs = el.get("attributes", {})
         cx, cy = get_center(attrs["bounds"])
         if cx:
-            run_adb(f"shell input tap {cx} {cy}")
-            time.sleep(0.1)
-            run_adb(f"shell input tap {cx} {cy}")
+            run_adb(ctx, f"shell input tap {cx} {cy}")
+            ctx.sleep(0.1)
+            run_adb(ctx, f"shell input tap {cx} {cy}")
             return f"Double Tap '{query}'"
         raise Exception(f"No bounds for {query}")
 
     elif s.type == "longPressOn":
          # input swipe x y x y duration
-         query = resolve_query(s.params)
-         el = wait_for_element_or_fail(query, timeout=5)
+         query = s.query
+         el = wait_for_element_or_fail(ctx, query, timeout=5)
          attrs = el.get("attributes", {})
          cx, cy = get_center(attrs["bounds"])
          if cx:
-             run_adb(f"shell input swipe {cx} {cy} {cx} {cy} 1000")
+             run_adb(ctx, f"shell input swipe {cx} {cy} {cx} {cy} 1000")
              return f"Long Press '{query}'"
          raise Exception(f"No bounds for {query}")
 
     elif s.type == "inputText":
-        input_text(s.params)
-        time.sleep(0.1)  # Small delay to ensure text is processed
+        input_text(ctx, s.params)
+        ctx.sleep(0.1)  # Small delay to ensure text is processed
         return f"Input: {s.params}"
 
     elif s.type == "pressKey":
         key = s.params
         key_map = {"Enter": "66", "Back": "4", "Home": "3"}
         code = key_map.get(key, key)
-        mark_interaction()
-        run_adb(f"shell input keyevent {code}")
+        ctx.mark_interaction()
+        run_adb(ctx, f"shell input keyevent {code}")
         return f"Key: {key}"
 
     elif s.type == "hideKeyboard":
@@ -1212,23 +1403,22 @@ def _dispatch_step_logic(s, step_context=None):
         # Alternatively 4 (BACK) but that might navigate if no keyboard.
         # Let's try 111 first, or we can use 'input method hide' if available?
         # Safe bet: keyevent 111
-        run_adb("shell input keyevent 111")
-        time.sleep(0.5)
+        run_adb(ctx, "shell input keyevent 111")
+        ctx.sleep(0.5)
         return "Hide Keyboard"
 
     elif s.type == "scroll":
-        mark_interaction()
+        ctx.mark_interaction()
         direction = "DOWN"
-        query = None
+        query = s.query
         if isinstance(s.params, dict):
             direction = s.params.get("direction", "DOWN")
-            query = resolve_query(s.params.get("element"))
         
-        w, h = get_screen_size()
+        w, h = get_screen_size(ctx)
         
         # If element is provided, scroll within its center
         if query:
-            root = get_hierarchy()
+            root = get_hierarchy(ctx)
             el = find_element(root, query)
             if el:
                 bounds = el.get("bounds")
@@ -1239,42 +1429,31 @@ def _dispatch_step_logic(s, step_context=None):
                 dist_v = int(bounds["height"] * 0.3)
                 
                 if direction == "DOWN":
-                    run_adb(f"shell input swipe {cx} {cy + dist_v} {cx} {cy - dist_v} 1000")
+                    run_adb(ctx, f"shell input swipe {cx} {cy + dist_v} {cx} {cy - dist_v} 1000")
                 elif direction == "UP":
-                    run_adb(f"shell input swipe {cx} {cy - dist_v} {cx} {cy + dist_v} 1000")
+                    run_adb(ctx, f"shell input swipe {cx} {cy - dist_v} {cx} {cy + dist_v} 1000")
                 elif direction == "RIGHT":
-                    run_adb(f"shell input swipe {cx + dist_h} {cy} {cx - dist_h} {cy} 1000")
+                    run_adb(ctx, f"shell input swipe {cx + dist_h} {cy} {cx - dist_h} {cy} 1000")
                 elif direction == "LEFT":
-                    run_adb(f"shell input swipe {cx - dist_h} {cy} {cx + dist_h} {cy} 1000")
+                    run_adb(ctx, f"shell input swipe {cx - dist_h} {cy} {cx + dist_h} {cy} 1000")
                 return f"Scroll {direction} on '{query}'"
 
         # Global scroll
         cx, cy = w // 2, h // 2
         if direction == "DOWN":
-            run_adb(f"shell input swipe {cx} {int(h * 0.8)} {cx} {int(h * 0.2)} 1000")
+            run_adb(ctx, f"shell input swipe {cx} {int(h * 0.8)} {cx} {int(h * 0.2)} 1000")
         elif direction == "UP":
-            run_adb(f"shell input swipe {cx} {int(h * 0.2)} {cx} {int(h * 0.8)} 1000")
+            run_adb(ctx, f"shell input swipe {cx} {int(h * 0.2)} {cx} {int(h * 0.8)} 1000")
         elif direction == "RIGHT":
-            run_adb(f"shell input swipe {int(w * 0.8)} {cy} {int(w * 0.2)} {cy} 1000")
+            run_adb(ctx, f"shell input swipe {int(w * 0.8)} {cy} {int(w * 0.2)} {cy} 1000")
         elif direction == "LEFT":
-            run_adb(f"shell input swipe {int(w * 0.2)} {cy} {int(w * 0.8)} {cy} 1000")
+            run_adb(ctx, f"shell input swipe {int(w * 0.2)} {cy} {int(w * 0.8)} {cy} 1000")
             
         return f"Scroll {direction}"
 
     elif s.type == "scrollUntilVisible":
-        if isinstance(s.params, dict):
-             target_query = s.params.get("element")
-             # Handle nested map if element is complex or just string
-             if isinstance(target_query, dict):
-                 # e.g. element: { text: "Foo" } -> resolve
-                 query = resolve_query(target_query)
-             else:
-                 query = target_query
-                 
-             direction = s.params.get("direction", "DOWN")
-        else:
-             query = s.params
-             direction = "DOWN"
+        query = s.query
+        direction = s.params.get("direction", "DOWN") if isinstance(s.params, dict) else "DOWN"
         
         print(f"[DEBUG] Scroll {direction} until '{query}' visible")
         
@@ -1283,30 +1462,30 @@ def _dispatch_step_logic(s, step_context=None):
         
         for i in range(max_scrolls):
             # Check visibility
-            root = get_hierarchy()
+            root = get_hierarchy(ctx)
             if find_element(root, query):
                 found = True
                 break
             
             # Not found, scroll
-            w, h = get_screen_size()
+            w, h = get_screen_size(ctx)
             cx = w // 2
             
             # Scroll behavior
             if direction == "DOWN":
                 # Scroll DOWN content = Swipe UP
-                run_adb(f"shell input swipe {cx} {int(h * 0.8)} {cx} {int(h * 0.2)} 1000")
+                run_adb(ctx, f"shell input swipe {cx} {int(h * 0.8)} {cx} {int(h * 0.2)} 1000")
             elif direction == "UP":
                 # Scroll UP content = Swipe DOWN
-                run_adb(f"shell input swipe {cx} {int(h * 0.2)} {cx} {int(h * 0.8)} 1000")
+                run_adb(ctx, f"shell input swipe {cx} {int(h * 0.2)} {cx} {int(h * 0.8)} 1000")
             elif direction == "RIGHT":
                 # Scroll RIGHT content = Swipe LEFT
-                run_adb(f"shell input swipe {int(w * 0.8)} {cy} {int(w * 0.2)} {cy} 1000")
+                run_adb(ctx, f"shell input swipe {int(w * 0.8)} {cy} {int(w * 0.2)} {cy} 1000")
             elif direction == "LEFT":
                 # Scroll LEFT content = Swipe RIGHT
-                run_adb(f"shell input swipe {int(w * 0.2)} {cy} {int(w * 0.8)} {cy} 1000")
+                run_adb(ctx, f"shell input swipe {int(w * 0.2)} {cy} {int(w * 0.8)} {cy} 1000")
             
-            time.sleep(1.0) # Wait for scroll to settle
+            ctx.sleep(1.0) # Wait for scroll to settle
             
         if not found:
              raise Exception(f"Element '{query}' not found after scrolling {direction} {max_scrolls} times")
@@ -1314,21 +1493,20 @@ def _dispatch_step_logic(s, step_context=None):
         return f"Scrolled {direction} to find '{query}'"
 
     elif s.type == "swipe":
-        mark_interaction()
+        ctx.mark_interaction()
         direction = "LEFT"
         duration = 500
-        query = None
+        query = s.query
         
         if isinstance(s.params, dict):
             direction = s.params.get("direction", "LEFT")
             duration = s.params.get("duration", 500)
-            query = resolve_query(s.params.get("element"))
         
-        w, h = get_screen_size()
+        w, h = get_screen_size(ctx)
         
         # If element is provided, swipe within element bounds
         if query:
-            root = get_hierarchy()
+            root = get_hierarchy(ctx)
             el = find_element(root, query)
             if not el:
                 raise Exception(f"Swipe failed: Element '{query}' not found")
@@ -1338,24 +1516,24 @@ def _dispatch_step_logic(s, step_context=None):
             width, height = bounds["width"], bounds["height"]
             
             if direction == "LEFT":
-                run_adb(f"shell input swipe {int(cx + width*0.3)} {cy} {int(cx - width*0.3)} {cy} {duration}")
+                run_adb(ctx, f"shell input swipe {int(cx + width*0.3)} {cy} {int(cx - width*0.3)} {cy} {duration}")
             elif direction == "RIGHT":
-                run_adb(f"shell input swipe {int(cx - width*0.3)} {cy} {int(cx + width*0.3)} {cy} {duration}")
+                run_adb(ctx, f"shell input swipe {int(cx - width*0.3)} {cy} {int(cx + width*0.3)} {cy} {duration}")
             elif direction == "DOWN":
-                run_adb(f"shell input swipe {cx} {int(cy - height*0.3)} {cx} {int(cy + height*0.3)} {duration}")
+                run_adb(ctx, f"shell input swipe {cx} {int(cy - height*0.3)} {cx} {int(cy + height*0.3)} {duration}")
             elif direction == "UP":
-                run_adb(f"shell input swipe {cx} {int(cy + height*0.3)} {cx} {int(cy - height*0.3)} {duration}")
+                run_adb(ctx, f"shell input swipe {cx} {int(cy + height*0.3)} {cx} {int(cy - height*0.3)} {duration}")
         else:
             # Global swipe (centered)
             cx, cy = w // 2, h // 2
             if direction == "LEFT":
-                run_adb(f"shell input swipe {int(w*0.7)} {cy} {int(w*0.3)} {cy} {duration}")
+                run_adb(ctx, f"shell input swipe {int(w*0.7)} {cy} {int(w*0.3)} {cy} {duration}")
             elif direction == "RIGHT":
-                run_adb(f"shell input swipe {int(w*0.3)} {cy} {int(w*0.7)} {cy} {duration}")
+                run_adb(ctx, f"shell input swipe {int(w*0.3)} {cy} {int(w*0.7)} {cy} {duration}")
             elif direction == "DOWN":
-                run_adb(f"shell input swipe {cx} {int(h*0.3)} {cx} {int(h*0.7)} {duration}")
+                run_adb(ctx, f"shell input swipe {cx} {int(h*0.3)} {cx} {int(h*0.7)} {duration}")
             elif direction == "UP":
-                run_adb(f"shell input swipe {cx} {int(h*0.7)} {cx} {int(h*0.3)} {duration}")
+                run_adb(ctx, f"shell input swipe {cx} {int(h*0.7)} {cx} {int(h*0.3)} {duration}")
         
         return f"Swipe {direction}"
 
@@ -1363,12 +1541,12 @@ def _dispatch_step_logic(s, step_context=None):
         # Wait for specified milliseconds
         duration_ms = s.params if isinstance(s.params, (int, float)) else 1000
         duration_sec = duration_ms / 1000
-        time.sleep(duration_sec)
+        ctx.sleep(duration_sec)
         return f"Wait {duration_ms}ms"
 
     elif s.type == "waitForAnimationToEnd":
         # Rough approximation: wait for UI to settle
-        time.sleep(10.0)
+        ctx.sleep(10.0)
         return "Wait animation to end (10s)"
 
 
@@ -1377,77 +1555,246 @@ def _dispatch_step_logic(s, step_context=None):
         timeout_ms = s.params.get("timeout", 5000)
         timeout_s = timeout_ms / 1000
         
-        # Determine query from berbagai possible keys (visible, assertVisible, etc.)
-        target = s.params.get("visible") or s.params.get("assertVisible")
-        if target:
-            query = resolve_query(target)
-            index = target.get("index") if isinstance(target, dict) else None
-            wait_for_element_or_fail(query, timeout=timeout_s, step_context=step_context, index=index)
+        # The compiler picked the target (visible, assertVisible, notVisible, ...)
+        query, index = s.query, s.index
+        if s.condition == "visible":
+            wait_for_element_or_fail(ctx, query, timeout=timeout_s, step_context=step_context, index=index)
             return f"Wait until visible: {query}"
             
-        target_not = s.params.get("notVisible") or s.params.get("assertNotVisible")
-        if target_not:
-            query = resolve_query(target_not)
-            index = target_not.get("index") if isinstance(target_not, dict) else None
-            start = time.time()
-            while time.time() - start < timeout_s:
-                root = get_hierarchy()
+        if s.condition == "notVisible":
+            start = ctx.now()
+            while ctx.now() - start < timeout_s:
+                root = get_hierarchy(ctx)
                 if not find_element(root, query, index=index):
                     return f"Wait until not visible: {query}"
-                time.sleep(0.5)
+                ctx.sleep(0.5)
             raise Exception(f"Element still visible after {timeout_s}s: {query}")
              
-        time.sleep(timeout_s)
+        ctx.sleep(timeout_s)
         return f"Wait {timeout_ms}ms"
         
     return f"Skipped {s.type}"
 
-def execute_flow(flow, global_app_id, run_id=None):
-    history = []
-    for i, step in enumerate(flow):
-        # Inject appId if needed
-        if isinstance(step, dict) and "launchApp" in step:
-            if isinstance(step["launchApp"], dict) and "appId" not in step["launchApp"] and global_app_id:
-                step["launchApp"]["appId"] = global_app_id
+def flow_trace_key(ctx, test_name, flow, app_id=None):
+    """Traces are only valid for the exact flow content on the same screen size."""
+    w, h = get_screen_size(ctx)
+    content = json.dumps(flow, sort_keys=True, default=str)
+    return hashlib.md5(f"{test_name}|{app_id}|{w}x{h}|{content}".encode()).hexdigest()[:16]
 
-        try:
-            # Send 'running' status before starting the step
-            yield f"data: [{i+1}/{len(flow)}] step (running)\n\n"
-            
-            # Consume generator from run_test_step
-            log = "Step Completed"
-            for msg in run_test_step(step, run_id=run_id, step_index=i, history=history):
-                if msg.startswith("RETURN:"):
-                    log = msg.replace("RETURN:", "", 1)
-                elif msg.startswith("[AI-BOT]"):
-                    yield f"data: {msg}\n\n"
-                elif msg.startswith("[HEALER]"):
-                    yield f"data: {msg}\n\n"
-                else:
-                    # Debug logs or others
-                    print(msg) 
-            
-            # Record step to history
-            history.append({"step": step, "log": log, "status": "PASS"})
-            yield f"data: [{i+1}/{len(flow)}] {log} (completed)\n\n"
-        except Exception as e:
-            history.append({"step": step, "error": str(e), "status": "FAIL"})
-            yield f"data: [{i+1}/{len(flow)}] {str(e)} (failed)\n\n"
-            raise e
+def condition_holds(ctx, step):
+    """Evaluate a repeat-while condition on the latest snapshot; steps that touched the device invalidate it."""
+    if step.condition is None:
+        return True
+    return probe_element(ctx, step.query, step.index, visible=step.condition == "visible", timeout_ms=0)
+
+def _step_messages(ctx, step, i, history):
+    """Run a step through the resolver, yielding its SSE messages. Returns the step log."""
+    if step.type in CONTROL_STEPS:
+        return (yield from _run_control_step(ctx, step, i, history))
+
+    log = "Step Completed"
+    for msg in run_test_step(ctx, step, step_index=i, history=history):
+        if msg.startswith("RETURN:"):
+            log = msg.replace("RETURN:", "", 1)
+        elif msg.startswith("[AI-BOT]"):
+            yield f"data: {msg}\n\n"
+        elif msg.startswith("[HEALER]"):
+            yield f"data: {msg}\n\n"
+        else:
+            # Debug logs or others
+            print(msg)
+    return log
 
-def run_yaml_custom(yaml_content, api_key=None, filename=""):
-    # Set key for this run
-    if api_key:
-        os.environ["RATT_OPENAI_KEY"] = api_key
+def _run_control_step(ctx, step, i, history):
+    """
+    Run a runFlow or repeat that depends on the screen (when / while). Its commands were expanded
+    by the compiler; they run with the control step's index, so their step memory is kept across runs.
+    """
+    if step.when and not when_met(ctx, step.when):
+        return when_skipped(step.type, step.when)
+    if step.type == "runFlow":
+        for nested in step.steps:
+            log = yield from _step_messages(ctx, nested, i, history)
+            history.append({"step": nested.raw, "log": log, "status": "PASS"})
+        return f"Ran {step.file or 'commands'} ({len(step.steps)} steps)"
+
+    iterations = 0
+    limit = step.times if step.times is not None else MAX_REPEAT
+    while iterations < limit and condition_holds(ctx, step):
+        for nested in step.steps:
+            log = yield from _step_messages(ctx, nested, i, history)
+            history.append({"step": nested.raw, "log": log, "status": "PASS"})
+        iterations += 1
+    if step.times is None and iterations >= limit and condition_holds(ctx, step):
+        raise Exception(f"repeat: '{step.query}' still {step.condition} after {limit} iterations")
+    if step.condition is None:
+        return f"Repeated {iterations}x"
+    return f"Repeated {iterations}x while {step.condition}: {step.query}"
+
+def _run_flow_step(ctx, i, step, flow, history):
+    """Run one flow step through the resolver path, yielding SSE messages."""
+    start_time = time.time()
+    ctx.begin_step(i)
+    ctx.emit("step_start", index=i, total=len(flow), step=step.raw, action=step.type, line=step.line, source=step.source)
+    try:
+        # Send 'running' status before starting the step
+        yield f"data: [{i+1}/{len(flow)}] step (running)\n\n"
+        
+        log = yield from _step_messages(ctx, step, i, history)
         
+        # Record step to history
+        history.append({"step": step.raw, "log": log, "status": "PASS"})
+        ctx.emit("step_end", index=i, status="PASS", log=log, duration_ms=int((time.time() - start_time) * 1000), phases=ctx.step_phases)
+        ctx.end_step(action=step.type, status="PASS")
+        yield f"data: [{i+1}/{len(flow)}] {log} (completed)\n\n"
+    except Exception as e:
+        history.append({"step": step.raw, "error": str(e), "status": "FAIL"})
+        ctx.emit("step_end", index=i, status="FAIL", error=str(e), duration_ms=int((time.time() - start_time) * 1000), phases=ctx.step_phases)
+        ctx.end_step(action=step.type, status="FAIL")
+        yield f"data: [{i+1}/{len(flow)}] {str(e)} (failed)\n\n"
+        raise e
+
+def replay_trace(ctx, trace, flow, history):
+    """
+    Replay a compiled trace at device speed. A step sends its input only once the window it expects
+    is showing. That check starts on the probe thread right after the previous step's input, so it
+    overlaps the previous step's bookkeeping and streaming, and is settled before the step's own input.
+    Live steps use the resolver. Returns the index of the first step to run through the resolver
+    (len(flow) if none); none of that step's input has been sent.
+    """
+    steps = trace["steps"]
+    check = None # Future of the window check for the next step, started after this step's input
+    last_window = None
+    for i, entry in enumerate(steps):
+        step = flow[i]
+        if entry["live"]:
+            yield from _run_flow_step(ctx, i, step, flow, history)
+            last_window = None
+            continue
+
+        expected = entry.get("expect_before")
+        if expected and not entry.get("anchor"):
+            window, ok = check.result() if check else wait_for_window(ctx, expected, _window_timeout(expected, last_window))
+            if not ok:
+                yield f"data: [FAST-TRACE] Expected '{expected}' before step {i+1}, found '{window}'. Falling back to the resolver.\n\n"
+                return i
+        check = None
+        last_window = expected
+
+        start_time = time.time()
+        ctx.begin_step(i)
+        ctx.emit("step_start", index=i, total=len(flow), step=step.raw, action=entry["type"], line=step.line, source=step.source, replayed=True)
+        yield f"data: [{i+1}/{len(flow)}] step (running)\n\n"
+        ctx.mark_interaction()
+        for command in entry["commands"]:
+            run_adb(ctx, command)
+        following = steps[i + 1] if i + 1 < len(steps) else None
+        if following and not following["live"] and not following.get("anchor") and following.get("expect_before"):
+            after = following["expect_before"]
+            check = _probe_pool.submit(wait_for_window, ctx, after, _window_timeout(after, last_window))
+        log = f"Replayed {entry['type']} ({len(entry['commands'])} input events)"
+        if ctx.run_id:
+            ctx.memory.record_action(ctx.run_id, entry["type"], str(step.raw), "SUCCESS", int((time.time() - start_time) * 1000))
+        history.append({"step": step.raw, "log": log, "status": "PASS"})
+        duration = int((time.time() - start_time) * 1000)
+        ctx.emit("step_end", index=i, status="PASS", log=log, duration_ms=duration, phases={"replay": duration})
+        ctx.end_step(action=entry["type"], status="PASS", replayed=True)
+        yield f"data: [{i+1}/{len(flow)}] {log} (completed)\n\n"
+    return len(flow)
+
+def _window_timeout(expected, last_window):
+    """A step on the same window as the previous one should find it at once; a new window may take a while."""
+    return 1.0 if expected == last_window else None
+
+def execute_flow(ctx, flow, trace_key=None, trace=None):
+    """
+    Run a list of compiled steps. With a compiled trace, replay it and resume through the resolver
+    from the first divergence. Without one, record the device input of every step so a passing run
+    compiles a trace.
+    """
+    history = []
+    start_index = 0
+    if trace and len(trace.get("steps", [])) == len(flow):
+        yield f"data: [FAST-TRACE] Replaying compiled trace ({len(flow)} steps)\n\n"
+        start_index = yield from replay_trace(ctx, trace, flow, history)
+        if start_index < len(flow):
+            metrics.FAST_TRACE_DIVERGED.inc()
+            ctx.memory.drop_trace(trace_key)
+
+    compiled = [] if trace_key and start_index == 0 else None
+    try:
+        for i in range(start_index, len(flow)):
+            step = flow[i]
+            if compiled is not None:
+                ctx.trace_recorder = {"commands": [], "expect_before": None}
+            yield from _run_flow_step(ctx, i, step, flow, history)
+            if compiled is not None:
+                compiled.append({
+                    "type": step.type,
+                    # Conditional and optional steps may act differently next run
+                    "live": step.type in LIVE_STEPS or step.optional or bool(step.when),
+                    "anchor": step.type in ANCHOR_STEPS,
+                    "commands": ctx.trace_recorder["commands"],
+                    "expect_before": ctx.trace_recorder["expect_before"]
+                })
+                ctx.trace_recorder = None
+    finally:
+        ctx.trace_recorder = None
+
+    if compiled is not None:
+        ctx.memory.save_trace(trace_key, {"steps": compiled})
+        yield f"data: [FAST-TRACE] Compiled trace of {len(compiled)} steps for the next run\n\n"
+
+def run_yaml_custom(yaml_content, api_key=None, filename="", device=None, policies=None, base_dir=None, transport=None,
+                    profile=False, memory=None, mode=None):
+    # The key, device and policies belong to this run only.
+    # base_dir is where runFlow files are looked up (the folder of the flow file).
+    # profile samples the run's stacks and allocations; see /report/{run_id}/profile.
+    # memory and mode replace the app's partition and the mode picked from its history (session replays).
+    # With RATT_RECORD_SESSIONS set, the run's device traffic is saved for offline replay.
+    recorder = None
+    if transport is None and os.getenv("RATT_RECORD_SESSIONS"):
+        transport = recorder = adb_transport.RecordingTransport()
+    ctx = ExecutionContext(device=device, api_key=api_key, policies=policies, transport=transport, profile=profile)
+    try:
+        yield from ctx.published(_run_yaml(ctx, yaml_content, filename, base_dir, memory, mode))
+    finally:
+        if recorder and ctx.run_id:
+            try:
+                path = recorder.save(adb_transport.session_path(ctx.run_id), run_id=ctx.run_id, device=device,
+                                     flow={"yaml_content": yaml_content, "filename": filename, "base_dir": base_dir})
+                print(f"[DEBUG] Session recorded to {path}")
+            except Exception as e:
+                print(f"[DEBUG] Session recording failed: {e}")
+
+def run_yaml_exclusive(yaml_content, device=None, **kwargs):
+    """run_yaml_custom for a direct request: holds the device for the run, so a queued job can't drive it too."""
+    from scheduler import device_key, device_locks
+    serial = device_key(device)
+    owner = f"run {kwargs.get('filename') or 'flow'} {os.urandom(3).hex()}"
+    if not device_locks.try_acquire(serial, owner):
+        yield f"data: [ERROR] Device {serial or 'default'} is busy with {device_locks.owner(serial)}\n\n"
+        yield f"data: [DONE] EXIT_CODE: 1\n\n"
+        return
+    try:
+        yield from run_yaml_custom(yaml_content, device=device, **kwargs)
+    finally:
+        device_locks.release(serial, owner)
+
+def _run_yaml(ctx, yaml_content, filename, base_dir=None, memory=None, mode=None):
     try:
-        docs = list(yaml.safe_load_all(yaml_content))
-        header = docs[0] if len(docs) > 0 else {}
-        flow = docs[1] if len(docs) > 1 else (docs[0] if isinstance(docs[0], list) else [])
+        # Parsed, validated and selector-resolved once per content hash
+        compiled = compile_flow(yaml_content)
+        header = compiled.header
+        # runFlow and repeat-times inlined, so subflow steps get step memory and FAST traces
+        own_path = (os.path.abspath(os.path.join(base_dir, os.path.basename(filename)))
+                    if base_dir and filename else None)
+        flow = expand_steps(compiled.steps, base_dir=base_dir, env=header.get("env"),
+                            app_id=compiled.app_id, stack=(own_path,) if own_path else ())
         
         yield f"data: [STARTING] Test Run\n\n"
         
-        global_app_id = header.get("appId") if isinstance(header, dict) else None
+        global_app_id = compiled.app_id
         
         # AI RUN TRACKING: Start Run
         # Use filename (without .yaml) if no name in header
@@ -1457,17 +1804,18 @@ def run_yaml_custom(yaml_content, api_key=None, filename=""):
             default_name = filename if filename else "Unnamed Test"
         
         run_name = header.get("name", default_name)
+        if memory is not None:
+            ctx.memory = memory
+        memory = memory_registry.acquire(memory or select_memory(ctx, global_app_id))
         
         # Determine mode based on history
-        mode = "LEARN"
-        for r in sorted(intelligence.raw_data["runs"], key=lambda x: str(x.get("started_at", "")), reverse=True):
-             if r.get("test_name") == run_name and r.get("status") == "PASS":
-                 mode = "FAST"
-                 break
+        mode = mode or ("FAST" if ctx.memory.get_latest_passing_run(run_name) else "LEARN")
+        if isinstance(ctx.transport, adb_transport.RecordingTransport):
+            ctx.transport.start_run(mode, ctx.memory.snapshot(), _device_info.get(ctx.device, {}))
                  
-        run_id = intelligence.start_run(run_name, mode=mode)
-        global current_run_id
-        current_run_id = run_id
+        run_id = ctx.memory.start_run(run_name, mode=mode)
+        ctx.start_run(run_id, test_name=run_name, mode=mode, steps=len(flow))
+        yield f"data: [INFO] Run ID: {run_id}\n\n"
         start_time = time.time()
         
         # AI PLANNER: Analyze test flow before execution
@@ -1476,11 +1824,11 @@ def run_yaml_custom(yaml_content, api_key=None, filename=""):
             
             # Get memory stats for this test
             memory_stats = {
-                "previous_runs": len([r for r in intelligence.raw_data["runs"] if r.get("test_name") == run_name]),
+                "previous_runs": ctx.memory.count_runs(run_name),
                 "mode": mode
             }
             
-            plan = planner_agent.plan_execution(flow, memory_stats)
+            plan = planner_agent.plan_execution(compiled.raw_steps(), memory_stats, api_key=ctx.openai_key)
             if plan:
                 yield f"data: [AI-PLANNER] 🎯 Execution Plan Generated:\n\n"
                 yield f"data: [AI-PLANNER] - Risk Level: {plan.get('risk_level', 'UNKNOWN')} (Score: {plan.get('risk_score', 0)})\n\n"
@@ -1492,16 +1840,18 @@ def run_yaml_custom(yaml_content, api_key=None, filename=""):
             print(f"[DEBUG] Planner Agent failed: {e}")
         
         try:
-            for msg in execute_flow(flow, global_app_id, run_id=run_id):
+            trace_key = flow_trace_key(ctx, run_name, [step.raw for step in flow], global_app_id)
+            trace = ctx.memory.get_trace(trace_key) if mode == "FAST" else None
+            for msg in execute_flow(ctx, flow, trace_key=trace_key, trace=trace):
                 yield msg
             
             # AI RUN TRACKING: End Run (Pass)
             duration = int((time.time() - start_time) * 1000)
-            intelligence.end_run(run_id, "PASS", duration)
+            ctx.end_run("PASS", duration)
             
             # AI IMPROVER: Check for suggestions
             try:
-                suggestions = improver.analyze_memory(intelligence.storage_path)
+                suggestions = improver.analyze_memory(ctx.memory)
                 if suggestions:
                     yield f"data: [AI-IMPROVER] 💡 Found {len(suggestions)} Improvement Suggestions:\n\n"
                     for s in suggestions:
@@ -1514,62 +1864,24 @@ def run_yaml_custom(yaml_content, api_key=None, filename=""):
         except Exception as e:
             # AI RUN TRACKING: End Run (Fail)
             duration = int((time.time() - start_time) * 1000)
-            intelligence.end_run(run_id, "FAIL", duration)
+            ctx.end_run("FAIL", duration, error=str(e))
             yield f"data: [ERROR] {str(e)}\n\n"
             yield f"data: [DONE] EXIT_CODE: 1\n\n"
             yield f"data: [REPORT] Run ID: {run_id}\n\n"
+        finally:
+            memory_registry.release(memory)
         
+    except FlowCompileError as e:
+        yield f"data: [ERROR] {str(e)}\n\n"
+        yield f"data: [DONE] EXIT_CODE: 1\n\n"
     except Exception as e:
         yield f"data: [ERROR] {str(e)}\n\n"
 
-def run_folder_custom(folder_path):
-    import os
-    try:
-        if not os.path.isdir(folder_path):
-             yield f"data: [ERROR] Not a folder: {folder_path}\n\n"
-             return
-
-        files = sorted([f for f in os.listdir(folder_path) if f.endswith('.yaml') or f.endswith('.yml')])
-        
-        if not files:
-            yield f"data: [ERROR] No YAML files found in {folder_path}\n\n"
-            return
-
-        yield f"data: [INFO] Found {len(files)} tests in folder\n\n"
-        
-        failures = 0
-
-        for idx, filename in enumerate(files):
-            yield f"data: [INFO] === Running {filename} ({idx+1}/{len(files)}) ===\n\n"
-            full_path = os.path.join(folder_path, filename)
-            
-            with open(full_path, 'r') as f:
-                content = f.read()
-            
-            try:
-                docs = list(yaml.safe_load_all(content))
-                header = docs[0] if len(docs) > 0 else {}
-                flow = docs[1] if len(docs) > 1 else (docs[0] if isinstance(docs[0], list) else [])
-                global_app_id = header.get("appId") if isinstance(header, dict) else None
-                
-                for msg in execute_flow(flow, global_app_id):
-                    yield msg
-                
-                yield f"data: [SUCCESS] {filename} passed\n\n"
-            except Exception as e:
-                failures += 1
-                yield f"data: [ERROR] {filename} failed: {str(e)}\n\n"
-                # Continue to next test or stop? Usually continue in bulk run is better.
-                # But user flow might depend on previous.
-                # I'll continue for now.
-        
-        if failures == 0:
-            yield f"data: [DONE] EXIT_CODE: 0\n\n"
-        else:
-            yield f"data: [DONE] EXIT_CODE: 1\n\n"
+def run_folder_custom(folder_path, devices=None):
+    """Run every YAML file of a folder, sharded across the connected devices by the suite scheduler."""
+    from scheduler import run_suite
+    yield from run_suite(folder_path, devices=devices)
 
-    except Exception as e:
-        yield f"data: [ERROR] {str(e)}\n\n"
 def run_goal_autonomous(goal: str, app_id: Optional[str] = None, api_key: Optional[str] = None):
     """
     Autonomous loop: 
@@ -1578,14 +1890,16 @@ def run_goal_autonomous(goal: str, app_id: Optional[str] = None, api_key: Option
     3. Execute
     4. Repeat until Goal Reached or Max Steps (15)
     """
-    if api_key:
-        os.environ["RATT_OPENAI_KEY"] = api_key
+    ctx = ExecutionContext(api_key=api_key)
+    yield from ctx.published(_run_goal(ctx, goal, app_id))
 
+def _run_goal(ctx, goal, app_id):
     history = []
     max_steps = 15
-    run_id = intelligence.start_run(f"Goal: {goal[:20]}...", mode="LEARN")
-    global current_run_id
-    current_run_id = run_id
+    select_memory(ctx, app_id)
+    run_id = ctx.memory.start_run(f"Goal: {goal[:20]}...", mode="LEARN")
+    ctx.start_run(run_id, test_name=f"Goal: {goal[:20]}...", mode="LEARN", goal=goal)
+    yield f"data: [INFO] Run ID: {run_id}\n\n"
     
     yield f"data: [STARTING] Autonomous Goal Run: '{goal}'\n\n"
     
@@ -1593,28 +1907,28 @@ def run_goal_autonomous(goal: str, app_id: Optional[str] = None, api_key: Option
         yield f"data: [INFO] Launching app '{app_id}'...\n\n"
         # Use run_test_step to launch properly
         launch_step = {"launchApp": {"appId": app_id, "clearState": True}}
-        for msg in run_test_step(launch_step, run_id=run_id):
+        for msg in run_test_step(ctx, launch_step):
             if not msg.startswith("RETURN:"):
                 yield f"data: {msg}\n\n"
     
     for i in range(max_steps):
         yield f"data: [GOAL-AGENT] Step {i+1}: Observing screen...\n\n"
-        hierarchy = get_hierarchy(force_refresh=True)
+        hierarchy = get_hierarchy(ctx, force_refresh=True)
         
-        plan_res = goal_agent.plan_steps(goal, hierarchy, history)
+        plan_res = goal_agent.plan_steps(goal, hierarchy, history, api_key=ctx.openai_key)
         explanation = plan_res.get("explanation", "Thinking...")
         yield f"data: [GOAL-AGENT] 🧠 {explanation}\n\n"
         
         if plan_res.get("is_goal_reached"):
             yield f"data: [SUCCESS] Goal Reached! 🎉\n\n"
-            intelligence.end_run(run_id, "PASS", 0)
+            ctx.end_run("PASS", 0)
             yield f"data: [DONE] EXIT_CODE: 0\n\n"
             return
 
         steps = plan_res.get("plan", [])
         if not steps:
             yield f"data: [ERROR] Goal Agent stuck: No steps generated.\n\n"
-            intelligence.end_run(run_id, "FAIL", 0)
+            ctx.end_run("FAIL", 0)
             yield f"data: [DONE] EXIT_CODE: 1\n\n"
             return
 
@@ -1625,7 +1939,7 @@ def run_goal_autonomous(goal: str, app_id: Optional[str] = None, api_key: Option
             
             try:
                 res_msg = "Completed"
-                for msg in run_test_step(step, run_id=run_id, step_index=i, history=history):
+                for msg in run_test_step(ctx, step, step_index=i, history=history):
                     if msg.startswith("RETURN:"):
                         res_msg = msg.replace("RETURN:", "", 1)
                     else:
@@ -1640,10 +1954,10 @@ def run_goal_autonomous(goal: str, app_id: Optional[str] = None, api_key: Option
 
             except Exception as e:
                 yield f"data: [ERROR] Step failed: {str(e)}\n\n"
-                intelligence.end_run(run_id, "FAIL", 0)
+                ctx.end_run("FAIL", 0)
                 yield f"data: [DONE] EXIT_CODE: 1\n\n"
                 return
 
     yield f"data: [ERROR]Reached max steps ({max_steps}) without hitting goal.\n\n"
-    intelligence.end_run(run_id, "FAIL", 0)
+    ctx.end_run("FAIL", 0)
     yield f"data: [DONE] EXIT_CODE: 1\n\n"
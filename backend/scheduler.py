@@ -0,0 +1,270 @@
+import os
+import time
+import heapq
+import queue
+import subprocess
+import statistics
+import threading
+import multiprocessing
+from collections import deque
+from typing import Dict, List, Optional
+from flow_compiler import FlowCompileError, compile_flow
+from intelligence import memory_registry
+
+# Estimate for tests that have never finished a run
+DEFAULT_TEST_DURATION_MS = 60000
+
+def connected_devices() -> List[str]:
+    """Serials of devices/emulators that adb reports as ready."""
+    result = subprocess.run(["adb", "devices"], capture_output=True, text=True)
+    serials = []
+    for line in result.stdout.splitlines()[1:]:
+        parts = line.split()
+        if len(parts) >= 2 and parts[1] == "device":
+            serials.append(parts[0])
+    return serials
+
+class DeviceLocks:
+    """
+    Which run is driving each device. Queued jobs, direct runs and suites take a device before
+    sending it input, so two of them never drive the same device at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owners: Dict[Optional[str], str] = {}
+
+    def try_acquire(self, serial: Optional[str], owner: str) -> bool:
+        with self._lock:
+            if self._owners.get(serial, owner) != owner:
+                return False
+            self._owners[serial] = owner
+            return True
+
+    def release(self, serial: Optional[str], owner: str):
+        with self._lock:
+            if self._owners.get(serial) == owner:
+                del self._owners[serial]
+
+    def owner(self, serial: Optional[str]) -> Optional[str]:
+        return self._owners.get(serial)
+
+device_locks = DeviceLocks()
+
+def device_key(device: Optional[str]) -> Optional[str]:
+    """The serial a run drives: the one asked for, else the only connected device (None if there isn't exactly one)."""
+    if device:
+        return device
+    try:
+        serials = connected_devices()
+    except Exception:
+        return None
+    return serials[0] if len(serials) == 1 else None
+
+def test_name_for(filename: str, content: str) -> str:
+    """The run name run_yaml_custom will record for this file."""
+    default_name = filename[:-5] if filename.endswith(".yaml") else filename
+    try:
+        # Compiled (and cached on disk) here once; the device workers reuse it
+        header = compile_flow(content).header
+    except FlowCompileError:
+        return default_name
+    return header.get("name", default_name)
+
+def estimate_durations(tests: Dict[str, str]) -> Dict[str, int]:
+    """Expected duration (ms) per file from the test_stats history; unknown tests get the median."""
+    known = {}
+    for filename, test_name in tests.items():
+        stats = memory_registry.history.get_test_stats(test_name)
+        if stats and stats["runs"]:
+            known[filename] = stats["avg_ms"]
+    fallback = int(statistics.median(known.values())) if known else DEFAULT_TEST_DURATION_MS
+    return {filename: known.get(filename, fallback) for filename in tests}
+
+class SuiteScheduler:
+    """
+    Longest-processing-time-first sharding with work stealing. Files are dealt, longest first,
+    to the device with the least expected load. Each device takes its own longest remaining file;
+    an idle device steals the shortest file from the device with the most remaining work.
+    """
+
+    def __init__(self, durations: Dict[str, int], devices: List[str]):
+        self.durations = durations
+        self.queues: Dict[str, deque] = {serial: deque() for serial in devices}
+        loads = [(0, serial) for serial in devices]
+        heapq.heapify(loads)
+        for filename in sorted(durations, key=lambda f: (-durations[f], f)):
+            load, serial = heapq.heappop(loads)
+            self.queues[serial].append(filename)
+            heapq.heappush(loads, (load + durations[filename], serial))
+
+    def remaining_ms(self, serial: str) -> int:
+        return sum(self.durations[f] for f in self.queues[serial])
+
+    def next_for(self, serial: str) -> Optional[str]:
+        own = self.queues.get(serial)
+        if own:
+            return own.popleft()
+        victims = [s for s in self.queues if s != serial and self.queues[s]]
+        if not victims:
+            return None
+        victim = max(victims, key=self.remaining_ms)
+        return self.queues[victim].pop()
+
+    def retire(self, serial: str) -> List[str]:
+        """Stop dealing files to a device that was told to exit. Returns files still queued for it."""
+        return list(self.queues.pop(serial, deque()))
+
+    def drop_device(self, serial: str) -> int:
+        """Hand a lost device's queued files to the least loaded device left. Returns how many found no device."""
+        orphaned = self.queues.pop(serial, deque())
+        if not self.queues:
+            return len(orphaned)
+        target = min(self.queues, key=self.remaining_ms)
+        self.queues[target].extend(orphaned)
+        return 0
+
+    def plan(self) -> Dict[str, List[str]]:
+        return {serial: list(files) for serial, files in self.queues.items()}
+
+def _device_worker(serial: str, folder_path: str, tasks, results):
+    """Worker process: owns one device and its own runner module state."""
+    import runner
+    results.put(("ready", serial))
+    while True:
+        filename = tasks.get()
+        if filename is None:
+            break
+        start = time.time()
+        passed = False
+        try:
+            with open(os.path.join(folder_path, filename), "r") as f:
+                content = f.read()
+            for msg in runner.run_yaml_custom(content, filename=filename, device=serial, base_dir=folder_path):
+                text = msg[len("data: "):] if msg.startswith("data: ") else msg
+                text = text.rstrip("\n")
+                if text.startswith("[DONE] EXIT_CODE:"):
+                    passed = text.endswith("0")
+                results.put(("event", serial, text))
+        except Exception as e:
+            results.put(("event", serial, f"[ERROR] {e}"))
+        results.put(("done", serial, filename, passed, int((time.time() - start) * 1000)))
+        results.put(("ready", serial))
+    results.put(("exit", serial))
+
+def _release_after(process, serial: str, owner: str):
+    process.join()
+    device_locks.release(serial, owner)
+
+def run_suite(folder_path: str, devices: Optional[List[str]] = None):
+    """Run a folder of flows across devices, one worker process per device, merging their SSE events."""
+    workers = {}
+    owner = f"suite {os.path.basename(folder_path)} {os.urandom(3).hex()}"
+    held = []
+    try:
+        if not os.path.isdir(folder_path):
+            yield f"data: [ERROR] Not a folder: {folder_path}\n\n"
+            return
+
+        files = sorted([f for f in os.listdir(folder_path) if f.endswith('.yaml') or f.endswith('.yml')])
+        if not files:
+            yield f"data: [ERROR] No YAML files found in {folder_path}\n\n"
+            return
+
+        devices = devices or connected_devices()
+        if not devices:
+            yield f"data: [ERROR] No connected devices\n\n"
+            return
+        held = [serial for serial in devices if device_locks.try_acquire(serial, owner)]
+        for serial in devices:
+            if serial not in held:
+                yield f"data: [INFO] [{serial}] busy with {device_locks.owner(serial)}, not used for this suite\n\n"
+        devices = held
+        if not devices:
+            yield f"data: [ERROR] All devices are busy\n\n"
+            return
+
+        tests = {}
+        for filename in files:
+            with open(os.path.join(folder_path, filename), "r") as f:
+                tests[filename] = test_name_for(filename, f.read())
+        scheduler = SuiteScheduler(estimate_durations(tests), devices)
+
+        yield f"data: [INFO] Found {len(files)} tests in folder, sharding across {len(devices)} device(s)\n\n"
+        for serial, planned in scheduler.plan().items():
+            yield f"data: [INFO] [{serial}] planned {len(planned)} tests (~{scheduler.remaining_ms(serial) // 1000}s)\n\n"
+
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        for serial in devices:
+            tasks = ctx.Queue()
+            process = ctx.Process(target=_device_worker, args=(serial, folder_path, tasks, results), daemon=True)
+            process.start()
+            workers[serial] = {"process": process, "tasks": tasks, "current": None}
+
+        failures = 0
+        started = 0
+        while workers:
+            try:
+                msg = results.get(timeout=1.0)
+            except queue.Empty:
+                # A worker that died without saying goodbye fails its current file; its queue is stolen
+                for serial, worker in list(workers.items()):
+                    if not worker["process"].is_alive():
+                        if worker["current"]:
+                            failures += 1
+                            yield f"data: [ERROR] [{serial}] {worker['current']} failed: worker exited ({worker['process'].exitcode})\n\n"
+                        del workers[serial]
+                        unassigned = scheduler.drop_device(serial)
+                        if unassigned:
+                            failures += unassigned
+                            yield f"data: [ERROR] No devices left for {unassigned} tests\n\n"
+                continue
+
+            kind, serial = msg[0], msg[1]
+            worker = workers.get(serial)
+            if kind == "event":
+                yield f"data: [{serial}] {msg[2]}\n\n"
+            elif kind == "ready" and worker:
+                filename = scheduler.next_for(serial)
+                worker["current"] = filename
+                worker["tasks"].put(filename)
+                if filename is None:
+                    # Told to exit: files of a device lost later must go to a worker still taking them
+                    scheduler.retire(serial)
+                if filename:
+                    started += 1
+                    yield f"data: [INFO] [{serial}] === Running {filename} ({started}/{len(files)}) ===\n\n"
+            elif kind == "done" and worker:
+                _, _, filename, passed, duration_ms = msg
+                worker["current"] = None
+                if passed:
+                    yield f"data: [SUCCESS] [{serial}] {filename} passed in {duration_ms / 1000:.1f}s\n\n"
+                else:
+                    failures += 1
+                    yield f"data: [ERROR] [{serial}] {filename} failed\n\n"
+            elif kind == "exit" and worker:
+                worker["process"].join(timeout=5)
+                del workers[serial]
+                left = scheduler.retire(serial)
+                if left:
+                    failures += len(left)
+                    yield f"data: [ERROR] [{serial}] exited with {len(left)} tests not run: {', '.join(left)}\n\n"
+
+        if failures == 0:
+            yield f"data: [DONE] EXIT_CODE: 0\n\n"
+        else:
+            yield f"data: [DONE] EXIT_CODE: 1\n\n"
+
+    except Exception as e:
+        yield f"data: [ERROR] {str(e)}\n\n"
+    finally:
+        # Client went away or we failed: let workers finish their current file and exit
+        for worker in workers.values():
+            worker["tasks"].put(None)
+        for serial in held:
+            if serial in workers:
+                # Still finishing its file: the device is free once the worker exits
+                threading.Thread(target=_release_after, args=(workers[serial]["process"], serial, owner), daemon=True).start()
+            else:
+                device_locks.release(serial, owner)
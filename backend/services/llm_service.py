@@ -2,58 +2,59 @@ import os
 import json
 from openai import OpenAI
 from typing import Dict, Any, Optional
+import metrics
 
-# Initialize client
-client = None
+# One client per API key, so runs with their own keys don't reinitialize each other's
+_clients: Dict[str, OpenAI] = {}
+
+def get_client(api_key: Optional[str] = None):
+    # Priority: explicit key (from the run's context), then RATT_OPENAI_KEY, then OPENAI_API_KEY
+    if api_key:
+        source = "run context"
+    else:
+        api_key = os.getenv("RATT_OPENAI_KEY") or os.getenv("OPENAI_API_KEY")
+        source = "RATT_OPENAI_KEY" if os.getenv("RATT_OPENAI_KEY") else "OPENAI_API_KEY"
 
-def get_client():
-    global client
-    # Priority: RATT_OPENAI_KEY then OPENAI_API_KEY
-    api_key = os.getenv("RATT_OPENAI_KEY") or os.getenv("OPENAI_API_KEY")
-    
     if not api_key:
         print("[DEBUG] LLM Client: No API Key found in RATT_OPENAI_KEY or OPENAI_API_KEY")
         return None
-    else:
-        source = "RATT_OPENAI_KEY" if os.getenv("RATT_OPENAI_KEY") else "OPENAI_API_KEY"
-        print(f"[DEBUG] LLM Client: Using API Key from {source}")
-        
-    # Re-initialize if key changed or client is None
-    if client is None or getattr(client, "_api_key", None) != api_key:
-        client = OpenAI(api_key=api_key)
-        client._api_key = api_key # Store for comparison
+    print(f"[DEBUG] LLM Client: Using API Key from {source}")
 
+    client = _clients.get(api_key)
+    if client is None:
+        client = _clients[api_key] = OpenAI(api_key=api_key)
     return client
 
-def ask_llm(system_prompt: str, user_content: str, model: str = "gpt-4o") -> Optional[str]:
+def ask_llm(system_prompt: str, user_content: str, model: str = "gpt-4o", api_key: Optional[str] = None) -> Optional[str]:
     """
     Generic function to query the LLM.
     Returns the raw string content of the response.
     """
-    client = get_client()
+    client = get_client(api_key)
     if not client:
         return None
 
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_content}
-            ],
-            temperature=0.2
-        )
+        with metrics.llm_call("chat", model):
+            response = client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_content}
+                ],
+                temperature=0.2
+            )
         return response.choices[0].message.content
     except Exception as e:
         print(f"[ERROR] LLM Query Failed: {e}")
         return None
 
-def ask_llm_json(system_prompt: str, user_content: str, model: str = "gpt-4o") -> Optional[Dict[str, Any]]:
+def ask_llm_json(system_prompt: str, user_content: str, model: str = "gpt-4o", api_key: Optional[str] = None) -> Optional[Dict[str, Any]]:
     """
     Queries the LLM and expects a JSON response.
     Handles parsing and basic error checking.
     """
-    content = ask_llm(system_prompt, user_content, model)
+    content = ask_llm(system_prompt, user_content, model, api_key=api_key)
     if not content:
         return None
         
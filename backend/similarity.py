@@ -0,0 +1,107 @@
+import re
+import random
+import zlib
+from typing import Dict, List, Optional, Set, Tuple
+
+# MinHash / LSH parameters. 16 bands of 4 rows make screens with Jaccard >= 0.8
+# near-certain LSH candidates (~99.9%) while screens below 0.4 rarely collide.
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+_rng = random.Random(1) # Fixed seed: signatures must be stable across processes and restarts
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+_DIGITS = re.compile(r"\d+")
+
+def _normalize(value: Optional[str]) -> str:
+    # Prices, counters and clocks change between visits; their shape does not
+    return _DIGITS.sub("#", value or "").strip().lower()
+
+def screen_features(hierarchy: Dict) -> Set[str]:
+    """Shingles describing a screen: element identities plus parent>child structure."""
+    features = set()
+
+    def walk(node, parent_class):
+        attrs = node.get("attributes", {})
+        cls = attrs.get("class") or ""
+        rid = attrs.get("resource-id")
+        text = _normalize(attrs.get("text"))
+        desc = _normalize(attrs.get("content-desc"))
+        features.add(f"s:{parent_class}>{cls}")
+        if rid:
+            features.add(f"r:{cls}|{rid}")
+        if text:
+            features.add(f"t:{cls}|{text}")
+        if desc:
+            features.add(f"d:{cls}|{desc}")
+        for child in node.get("children", []):
+            walk(child, cls)
+
+    if hierarchy:
+        walk(hierarchy, "")
+    return features
+
+def minhash(features: Set[str]) -> List[int]:
+    if not features:
+        return [_MAX_HASH] * NUM_PERM
+    values = [zlib.crc32(f.encode()) for f in features]
+    return [min(((a * v + b) % _PRIME) & _MAX_HASH for v in values) for a, b in _PERMUTATIONS]
+
+def encode_signature(signature: List[int]) -> str:
+    return "".join(f"{v:08x}" for v in signature)
+
+def decode_signature(encoded: str) -> List[int]:
+    return [int(encoded[i:i + 8], 16) for i in range(0, len(encoded), 8)]
+
+def estimate_similarity(a: List[int], b: List[int]) -> float:
+    """Estimated Jaccard similarity of the feature sets behind two signatures."""
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+class LSHIndex:
+    """Banded LSH over MinHash signatures of known screens."""
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], Set[str]] = {}
+        self._signatures: Dict[str, List[int]] = {}
+
+    def __len__(self):
+        return len(self._signatures)
+
+    @staticmethod
+    def _bands(signature: List[int]):
+        for band in range(BANDS):
+            yield band, tuple(signature[band * ROWS:(band + 1) * ROWS])
+
+    def add(self, key: str, signature: List[int]):
+        self.remove(key)
+        self._signatures[key] = signature
+        for band in self._bands(signature):
+            self._buckets.setdefault(band, set()).add(key)
+
+    def remove(self, key: str):
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            return
+        for band in self._bands(signature):
+            bucket = self._buckets.get(band)
+            if bucket:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band]
+
+    def query(self, signature: List[int], threshold: float, exclude: Optional[str] = None) -> Optional[Tuple[str, float]]:
+        """Closest indexed screen with estimated similarity >= threshold, as (key, similarity)."""
+        candidates = set()
+        for band in self._bands(signature):
+            candidates |= self._buckets.get(band, set())
+        candidates.discard(exclude)
+
+        best = None
+        for key in candidates:
+            score = estimate_similarity(signature, self._signatures[key])
+            if score >= threshold and (best is None or score > best[1]):
+                best = (key, score)
+        return best
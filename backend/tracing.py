@@ -0,0 +1,175 @@
+import os
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# Spans kept per run; later ones are counted as dropped so a long polling loop can't grow a run without bound
+MAX_SPANS_PER_RUN = int(os.getenv("RATT_MAX_TRACE_SPANS", "20000"))
+
+_local = threading.local()
+
+class Tracer:
+    """
+    Timed spans of one run. Times are offsets from the start of the run in milliseconds; each span
+    carries the step it ran in and its lane: "run" for the run's own code (which the server may move
+    between worker threads), else the thread name, so probe threads show up on their own.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.started_at = time.time()
+        self.spans: List[Dict] = []
+        self.dropped = 0
+        self.step: Optional[int] = None # Index of the step being run, set by the runner
+        self._lock = threading.Lock()
+
+    def record(self, name: str, start: float, end: float, attrs: Optional[Dict] = None):
+        """Add a finished span; start and end are time.perf_counter() values."""
+        span = {
+            "name": name,
+            "start_ms": round((start - self.origin) * 1000, 3),
+            "ms": round((end - start) * 1000, 3),
+            "step": self.step,
+            "thread": "run" if current() is self else threading.current_thread().name
+        }
+        if attrs:
+            span["attrs"] = attrs
+        with self._lock:
+            if len(self.spans) < MAX_SPANS_PER_RUN:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Time the block. Yields the attrs dict so the block can add what it learns (provider, result)."""
+        start = time.perf_counter()
+        try:
+            yield attrs
+        except Exception as e:
+            attrs["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(name, start, time.perf_counter(), attrs)
+
+    def export(self) -> Dict:
+        with self._lock:
+            return {"started_at": self.started_at, "spans": list(self.spans), "dropped": self.dropped}
+
+@contextmanager
+def _untraced(**attrs):
+    yield attrs
+
+def current() -> Optional[Tracer]:
+    """The tracer of the run executing on this thread, if any."""
+    return getattr(_local, "tracer", None)
+
+@contextmanager
+def activate(tracer: Optional[Tracer]):
+    """Make tracer current on this thread for code that has no ExecutionContext at hand."""
+    previous = current()
+    _local.tracer = tracer
+    try:
+        yield tracer
+    finally:
+        _local.tracer = previous
+
+def span(name: str, tracer: Optional[Tracer] = None, **attrs):
+    """A span on the given tracer, else the current one; a no-op outside a traced run."""
+    tracer = tracer or current()
+    if tracer is None:
+        return _untraced(**attrs)
+    return tracer.span(name, **attrs)
+
+def traced(name: str):
+    """Decorator: time every call of the function as a span on the current tracer."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = current()
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def sleep(seconds: float, tracer: Optional[Tracer] = None, wait=time.sleep):
+    """time.sleep (or `wait`) that shows up in the waterfall, so waiting is told apart from device time."""
+    with span("sleep", tracer, seconds=seconds):
+        wait(seconds)
+
+# --- Views ---
+
+def _with_depth(spans: List[Dict]) -> List[Dict]:
+    """Sort spans by start and set each one's nesting depth within its thread from time containment."""
+    ordered = sorted(spans, key=lambda s: (s["start_ms"], -s["ms"]))
+    open_by_thread: Dict[str, List[float]] = {} # thread -> end offsets of the enclosing spans
+    result = []
+    for s in ordered:
+        stack = open_by_thread.setdefault(s["thread"], [])
+        # The tolerance absorbs the rounding of start and duration
+        while stack and stack[-1] + 0.002 < s["start_ms"] + s["ms"]:
+            stack.pop()
+        result.append({**s, "depth": len(stack)})
+        stack.append(s["start_ms"] + s["ms"])
+    return result
+
+def waterfall(spans: List[Dict]) -> List[Dict]:
+    """
+    Spans grouped by step, with offsets relative to the step's first span, and the self time per
+    span name (time not covered by nested spans), which is where a slow step's time actually went.
+    """
+    by_step: Dict = {}
+    for s in _with_depth(spans):
+        by_step.setdefault(s["step"], []).append(s)
+
+    steps = []
+    for step, items in sorted(by_step.items(), key=lambda kv: (kv[0] is not None, kv[0] or 0)):
+        origin = items[0]["start_ms"]
+        end = max(s["start_ms"] + s["ms"] for s in items)
+        self_ms: Dict[str, float] = {}
+        for i, s in enumerate(items):
+            children = 0.0
+            for c in items[i + 1:]:
+                if c["start_ms"] >= s["start_ms"] + s["ms"]:
+                    break
+                if c["thread"] == s["thread"] and c["depth"] == s["depth"] + 1:
+                    children += c["ms"]
+            self_ms[s["name"]] = self_ms.get(s["name"], 0.0) + max(s["ms"] - children, 0.0)
+        steps.append({
+            "step": step,
+            "start_ms": origin,
+            "duration_ms": round(end - origin, 3),
+            "self_ms": {name: round(ms, 3) for name, ms in sorted(self_ms.items(), key=lambda kv: -kv[1])},
+            "spans": [
+                {"name": s["name"], "offset_ms": round(s["start_ms"] - origin, 3), "ms": s["ms"],
+                 "depth": s["depth"], "thread": s["thread"], **({"attrs": s["attrs"]} if s.get("attrs") else {})}
+                for s in items
+            ]
+        })
+    return steps
+
+def chrome_trace(trace: Dict, run_id: str) -> Dict:
+    """Chrome trace-event JSON (chrome://tracing, Perfetto): one complete event per span."""
+    threads = {}
+    events = []
+    for s in trace.get("spans", []):
+        tid = threads.setdefault(s["thread"], len(threads) + 1)
+        args = dict(s.get("attrs") or {})
+        if s.get("step") is not None:
+            args["step"] = s["step"] + 1
+        events.append({
+            "name": s["name"], "cat": s["name"].split(".")[0], "ph": "X", "pid": 1, "tid": tid,
+            "ts": round(s["start_ms"] * 1000, 1), "dur": round(s["ms"] * 1000, 1), "args": args
+        })
+    events.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": f"run {run_id}"}})
+    for name, tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}})
+    return {
+        "traceEvents": events,
+        "displayTimeUnit": "ms",
+        "otherData": {"run_id": run_id, "started_at": trace.get("started_at"), "dropped_spans": trace.get("dropped", 0)}
+    }
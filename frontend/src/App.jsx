@@ -311,11 +311,13 @@ function App() {
     }, [deviceConnected]);
 
 
-    // Sequential polling handler: Only fetch next frame after current one is loaded
-    const onScreenLoad = () => {
-        if (deviceConnected) {
-            setRefreshKey(prev => prev + 1);
-        }
+    // The mirror stream pushes changed frames; reconnect after an error once a device is back
+    const onScreenError = () => {
+        setTimeout(() => {
+            if (deviceConnected) {
+                setRefreshKey(Date.now());
+            }
+        }, 1000);
     };
 
     // Only fetch hierarchy if inspector is ON and device is connected
@@ -906,9 +908,8 @@ function App() {
             const data = await res.json();
             if (data.status === 'success') {
                 addLog('success', `Executed: ${data.log}`);
-                // Sequential refresh
+                // The mirror stream shows the new screen by itself; refresh the hierarchy
                 setTimeout(() => {
-                    setRefreshKey(Date.now());
                     setHierarchyRefreshKey(prev => prev + 1);
                 }, 800);
             } else {
@@ -1578,52 +1579,46 @@ function App() {
         addLog('info', customInstruction ? 'Generating bulk tests...' : 'Asking AI to generate step...');
 
         try {
-            // 1. Capture Screenshot (Fetch from backend endpoint)
-            const snapRes = await fetch(`${apiBaseUrl}/screenshot?t=${Date.now()}`);
-            const blob = await snapRes.blob();
-
-            // Convert Blob to Base64
-            const reader = new FileReader();
-            reader.onloadend = async () => {
-                const base64data = reader.result.split(',')[1];
-
-                // 2. Hierarchy
-                const hierarchyStr = JSON.stringify(hierarchy || {});
-
-                // 3. Context
-                const elementCtx = (selectedElement && selectedElement.isPoint)
-                    ? `User clicked point at ${Math.round(popupPosition?.x || 0)}%, ${Math.round(popupPosition?.y || 0)}%`
-                    : `User selected element: ${JSON.stringify(selectedElement)}`;
-
-                const fullContext = `${elementCtx}\nAvailable Packages: ${packages.join(', ')}`;
-
-                const payload = {
-                    screenshot: base64data,
-                    hierarchy: hierarchyStr,
-                    context: fullContext,
-                    apiKey: apiKey,
-                    instruction: customInstruction
-                };
-
-                // 4. Call API
-                const res = await fetch(`${apiBaseUrl}/api/ai/generate`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(payload)
-                });
-
-                const data = await res.json();
-                if (data.success) {
-                    const stepCount = (editorContent.match(/^\s*-\s+/gm) || []).length + 1;
-                    const cmd = `# ${stepCount}. ${customInstruction ? 'Bulk Assertions' : 'AI Step'}\n${data.yaml}`;
-                    setEditorContent(prev => prev + (prev.endsWith('\n') ? '' : '\n') + cmd + '\n');
-                    addLog('success', 'AI Generated Code successfully!');
-                } else {
-                    addLog('error', `AI Error: ${data.error}`);
-                }
-                setIsGeneratingAI(false);
+            // 1. Capture Screenshot into the backend's frame cache; the image itself never leaves the server
+            const snapRes = await fetch(`${apiBaseUrl}/screenshot/frame`);
+            if (!snapRes.ok) throw new Error(`Screenshot failed (${snapRes.status})`);
+            const frame = await snapRes.json();
+
+            // 2. Hierarchy
+            const hierarchyStr = JSON.stringify(hierarchy || {});
+
+            // 3. Context
+            const elementCtx = (selectedElement && selectedElement.isPoint)
+                ? `User clicked point at ${Math.round(popupPosition?.x || 0)}%, ${Math.round(popupPosition?.y || 0)}%`
+                : `User selected element: ${JSON.stringify(selectedElement)}`;
+
+            const fullContext = `${elementCtx}\nAvailable Packages: ${packages.join(', ')}`;
+
+            const payload = {
+                frame: frame.id,
+                hierarchy: hierarchyStr,
+                context: fullContext,
+                apiKey: apiKey,
+                instruction: customInstruction
             };
-            reader.readAsDataURL(blob);
+
+            // 4. Call API
+            const res = await fetch(`${apiBaseUrl}/api/ai/generate`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(payload)
+            });
+
+            const data = await res.json();
+            if (data.success) {
+                const stepCount = (editorContent.match(/^\s*-\s+/gm) || []).length + 1;
+                const cmd = `# ${stepCount}. ${customInstruction ? 'Bulk Assertions' : 'AI Step'}\n${data.yaml}`;
+                setEditorContent(prev => prev + (prev.endsWith('\n') ? '' : '\n') + cmd + '\n');
+                addLog('success', 'AI Generated Code successfully!');
+            } else {
+                addLog('error', `AI Error: ${data.error}`);
+            }
+            setIsGeneratingAI(false);
 
         } catch (err) {
             addLog('error', `AI Request Failed: ${err.message}`);
@@ -2133,12 +2128,11 @@ function App() {
                                     flexShrink: 0
                                 }}>
                                     <img
-                                        src={`${apiBaseUrl}/screenshot?t=${refreshKey}`}
+                                        src={`${apiBaseUrl}/mirror/stream?format=jpeg&width=720&t=${refreshKey}`}
                                         className="device-screen"
                                         alt="Device Screen"
                                         onClick={handleScreenClick}
-                                        onLoad={onScreenLoad}
-                                        onError={() => setTimeout(onScreenLoad, 1000)} // Retry on error
+                                        onError={onScreenError}
                                     />
 
                                     {showInspector && deviceConnected && (
@@ -2423,7 +2417,6 @@ function App() {
                                                                 onClick={(e) => {
                                                                     e.stopPropagation();
                                                                     fetchHierarchy();
-                                                                    setRefreshKey(Date.now());
                                                                 }}
                                                                 className={isFetchingHierarchy ? 'spin' : ''}
                                                                 style={{ background: 'none', border: 'none', color: '#666', cursor: 'pointer', fontSize: '14px', padding: '4px', display: 'flex', alignItems: 'center' }}